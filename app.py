@@ -3,62 +3,1356 @@ import csv
 import json
 import requests
 import time
+import random
 import threading
 import io
+import sys
+import codecs
+import hashlib
+import hmac
+import shutil
+import tempfile
+import uuid
+import pickle
+import sqlite3
+import multiprocessing
+import math
+import queue
+import contextvars
+import asyncio
+import mmap
+import struct
+import zipfile
+import posixpath
+from collections import OrderedDict, deque
+from itertools import chain, islice
+from abc import ABC, abstractmethod
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from functools import wraps
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
-from flask import Flask, render_template, request, jsonify
+from urllib.parse import urlsplit
+from flask import Flask, Request, Response, g, render_template, request, jsonify, make_response, stream_with_context
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from urllib3 import PoolManager
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import chardet
+
+import image_preprocess
+import metrics
+import profiling
 
 # ==================== НАСТРОЙКА ====================
+# Размер куска при потоковой пересылке фото в VK
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 64 * 1024))
+# Предел для ZIP-архива задания со всеми фото (остальные запросы - MAX_CONTENT_LENGTH)
+ARCHIVE_MAX_SIZE = int(os.environ.get('ARCHIVE_MAX_SIZE', 4 * 1024 ** 3))
+
+class UploadRequest(Request):
+    """Входящие файлы держим в памяти не больше одного куска, остальное - на диске"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_CHUNK_SIZE, mode='rb+')
+    
+    def _load_form_data(self):
+        # Разбор multipart (и запись файлов во временные) - отдельная фаза Server-Timing
+        with profiling.phase('body'):
+            super()._load_form_data()
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'job_upload_archive':
+            return ARCHIVE_MAX_SIZE
+        return super().max_content_length
+
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.request_class = UploadRequest
 app.secret_key = os.environ.get('SECRET_KEY', 'proxy-secret-key')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
 app.config['JSON_AS_ASCII'] = False
 
 VK_API_VERSION = "5.131"
-sessions = {}
-session_lock = threading.Lock()
+VK_API_URL = os.environ.get('VK_API_URL', "https://api.vk.com/method")   # для тестов - bench/fake_vk.py
+metrics.API_HOSTS.add(urlsplit(VK_API_URL).hostname)
+
+# Серверный режим: файлы задания и пул обработчиков строк
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'vk_uploader_jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Сколько главных фото отправлять в альбом одним запросом (VK принимает до 5)
+ALBUM_BATCH_SIZE = max(1, min(int(os.environ.get('ALBUM_BATCH_SIZE', 5)), 5))
+# Фото для комментариев строки грузятся на стену параллельно в общем пуле
+# (держите HTTP_POOL_SIZE не меньше, иначе лишние соединения закрываются после запроса)
+WALL_UPLOAD_WORKERS = int(os.environ.get('WALL_UPLOAD_WORKERS', 8))
+
+# ==================== ЧЕСТНАЯ ОЧЕРЕДЬ СЕССИЙ ====================
+# Потоки, пулы соединений и серверы загрузки общие для всех пользователей.
+# Работа каждой сессии встает в свою очередь, очереди обслуживаются по весу
+# (WFQ со стартовыми метками), поэтому задание на 10 000 строк не задерживает
+# маленькие загрузки соседей. Вес сессии - PRIORITY из config.txt
+SCHEDULER_SLOTS = int(os.environ.get('SCHEDULER_SLOTS', 24))                   # одновременных обращений к VK
+SCHEDULER_SESSION_SLOTS = int(os.environ.get('SCHEDULER_SESSION_SLOTS', 16))   # из них у одной сессии
+# Одна сессия не занимает все обработчики: новое задание соседа начинается сразу
+JOB_SESSION_WORKERS = int(os.environ.get('JOB_SESSION_WORKERS', max(1, JOB_WORKERS - 1)))
+WALL_SESSION_WORKERS = int(os.environ.get('WALL_SESSION_WORKERS', max(1, WALL_UPLOAD_WORKERS * 3 // 4)))
+SCHEDULER_COST_BYTES = 1024 * 1024   # загрузка стоит 1 за каждый МБ тела, вызов API - 1
+PRIORITY_MIN = 0.1
+PRIORITY_MAX = float(os.environ.get('PRIORITY_MAX', 10))
+ANONYMOUS_FLOW = '-'                 # запросы без сессии (тест токена)
+SCHEDULER_STATS_MAX = 1000           # сессий в статистике очередей
+
+_flow = contextvars.ContextVar('scheduler_flow', default=(ANONYMOUS_FLOW, 1.0))
+
+def set_flow(session_id, priority=1.0):
+    """Дальнейшая работа потока (и отправленная им в пулы) идет в очередь этой сессии"""
+    _flow.set((session_id or ANONYMOUS_FLOW, priority))
+
+def config_priority(config):
+    """Вес сессии в очередях: PRIORITY из config.txt (по умолчанию 1)"""
+    return min(max(float(config.get('PRIORITY', 1)), PRIORITY_MIN), PRIORITY_MAX)
+
+class Flow:
+    """Очередь заявок одной сессии"""
+    __slots__ = ('queue', 'active', 'finish', 'weight')
+    
+    def __init__(self, weight):
+        self.queue = deque()   # (стартовая метка, время постановки, grant)
+        self.active = 0
+        self.finish = 0.0      # метка окончания последней заявки
+        self.weight = weight
+
+class FairScheduler:
+    """Честная очередь к общему ресурсу из capacity мест. Заявка сессии получает
+    стартовую метку max(виртуальное время, конец предыдущей заявки сессии) и
+    стоит cost / вес. Освободившееся место достается заявке с наименьшей меткой
+    среди сессий, не достигших session_cap: сессия с редкими заявками проходит
+    почти сразу, сколько бы заявок ни стояло у соседней"""
+    def __init__(self, name, capacity, session_cap):
+        self.name = name
+        self.capacity = capacity
+        self.session_cap = max(1, min(session_cap, capacity))
+        self.lock = threading.Lock()
+        self.free = capacity
+        self.virtual = 0.0
+        self.flows = {}
+        self.stats = OrderedDict()   # сессия -> счетчики, последние SCHEDULER_STATS_MAX
+        metrics.scheduler_queue_depth.labels(name).set_function(self.depth)
+        metrics.scheduler_busy.labels(name).set_function(lambda: self.capacity - self.free)
+    
+    def depth(self):
+        with self.lock:
+            return sum(len(flow.queue) for flow in self.flows.values())
+    
+    def enqueue(self, key, weight, cost, grant):
+        """Поставить заявку; grant() вызывается, когда ей досталось место"""
+        with self.lock:
+            flow = self.flows.get(key)
+            if flow is None:
+                flow = self.flows[key] = Flow(weight)
+            flow.weight = weight
+            start = max(self.virtual, flow.finish)
+            flow.finish = start + cost / weight
+            flow.queue.append((start, time.monotonic(), grant))
+            granted = self.dispatch()
+        for grant in granted:
+            grant()
+    
+    def release(self, key):
+        with self.lock:
+            flow = self.flows[key]
+            flow.active -= 1
+            self.free += 1
+            if not flow.queue and not flow.active:
+                del self.flows[key]
+            granted = self.dispatch()
+        for grant in granted:
+            grant()
+    
+    def dispatch(self):
+        """Раздать свободные места (под self.lock), вернуть grant для вызова вне блокировки"""
+        granted = []
+        while self.free > 0:
+            best = None
+            for key, flow in self.flows.items():
+                if flow.queue and flow.active < self.session_cap and (
+                        best is None or flow.queue[0][0] < best[1].queue[0][0]):
+                    best = (key, flow)
+            if best is None:
+                break
+            key, flow = best
+            start, enqueued, grant = flow.queue.popleft()
+            self.virtual = max(self.virtual, start)
+            flow.active += 1
+            self.free -= 1
+            waited = time.monotonic() - enqueued
+            self.count_wait(key, waited)
+            metrics.scheduler_wait_seconds.labels(self.name).observe(waited)
+            granted.append(grant)
+        return granted
+    
+    def count_wait(self, key, waited):
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = {'dispatched': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            if len(self.stats) > SCHEDULER_STATS_MAX:
+                self.stats.popitem(last=False)
+        self.stats.move_to_end(key)
+        stats['dispatched'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+    
+    @contextmanager
+    def slot(self, cost=1):
+        """Место для одного обращения к VK от сессии текущего потока"""
+        key, weight = _flow.get()
+        event = threading.Event()
+        self.enqueue(key, weight, cost, event.set)
+        with profiling.phase(f'queue.{self.name}'):
+            event.wait()
+        try:
+            yield
+        finally:
+            self.release(key)
+    
+    @asynccontextmanager
+    async def aslot(self, cost=1):
+        """То же для asyncio: ожидание места не занимает поток и цикл событий"""
+        key, weight = _flow.get()
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        
+        def wake():
+            # Отмененный ожидающий место уже не займет - отдаем его следующему
+            if waiter.cancelled():
+                self.release(key)
+            else:
+                waiter.set_result(None)
+        
+        # Место освобождается и из потоков Flask - будим цикл событий потокобезопасно
+        self.enqueue(key, weight, cost, lambda: loop.call_soon_threadsafe(wake))
+        with profiling.phase(f'queue.{self.name}'):
+            await waiter
+        try:
+            yield
+        finally:
+            self.release(key)
+    
+    def session_stats(self, key):
+        """Очередь и ожидание одной сессии: сколько ждет, выполняется, прошло и сколько ждали"""
+        with self.lock:
+            flow = self.flows.get(key)
+            stats = self.stats.get(key, {'dispatched': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+            return {
+                'queued': len(flow.queue) if flow else 0,
+                'active': flow.active if flow else 0,
+                'weight': flow.weight if flow else None,
+                'dispatched': stats['dispatched'],
+                'wait_avg': round(stats['wait_total'] / stats['dispatched'], 3) if stats['dispatched'] else 0.0,
+                'wait_max': round(stats['wait_max'], 3)
+            }
+    
+    def report(self):
+        with self.lock:
+            keys = list(dict.fromkeys([*self.flows, *reversed(self.stats)]))
+            busy = self.capacity - self.free
+        return {
+            'capacity': self.capacity,
+            'session_cap': self.session_cap,
+            'busy': busy,
+            'sessions': {key: self.session_stats(key) for key in keys}
+        }
+
+class FairExecutor(FairScheduler):
+    """Пул потоков с честной очередью вместо общей FIFO: задача попадает в пул,
+    только когда для нее есть свободный поток, поэтому в самом пуле очереди нет.
+    inherit_context - выполнять в контексте отправителя (фазы Server-Timing запроса)"""
+    def __init__(self, name, workers, session_cap, inherit_context=False):
+        super().__init__(name, workers, session_cap)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.inherit_context = inherit_context
+    
+    def submit(self, fn, *args):
+        key, weight = _flow.get()
+        context = contextvars.copy_context() if self.inherit_context else contextvars.Context()
+        future = Future()
+        
+        def run():
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(context.run(self.call, key, weight, fn, args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self.release(key)
+        
+        self.enqueue(key, weight, 1, lambda: self.pool.submit(run))
+        return future
+    
+    @staticmethod
+    def call(key, weight, fn, args):
+        _flow.set((key, weight))
+        return fn(*args)
+
+job_executor = FairExecutor('job', JOB_WORKERS, JOB_SESSION_WORKERS)
+metrics.job_queue_depth.set_function(job_executor.depth)
+# Фото для комментариев строки грузятся на стену параллельно в общем пуле
+wall_executor = FairExecutor('wall', WALL_UPLOAD_WORKERS, WALL_SESSION_WORKERS, inherit_context=True)
+# Все обращения к API и серверам загрузки VK
+proxy_scheduler = FairScheduler('vk', SCHEDULER_SLOTS, SCHEDULER_SESSION_SLOTS)
+
 
 # ==================== ОПТИМИЗАЦИЯ ЗАПРОСОВ ====================
-def create_session_with_retries():
+def parse_pool_sizes(value):
+    """'pu.vk.com=64,userapi.com=32' -> {'pu.vk.com': 64, 'userapi.com': 32}"""
+    sizes = {}
+    for item in value.split(','):
+        host, _, size = item.strip().partition('=')
+        if host and size:
+            sizes[host.strip().lower()] = int(size)
+    return sizes
+
+# Соединений на хост: по умолчанию и для отдельных хостов (совпадение по окончанию
+# имени, "userapi.com=64" действует на все его поддомены)
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+HTTP_POOL_SIZES = parse_pool_sizes(os.environ.get('HTTP_POOL_SIZES', ''))
+# Скольким хостам держать пулы открытыми: серверов загрузки у VK много, и при
+# нехватке места пул закрывается, а соединения к нему потом открываются заново
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 64))
+# Сколько соединений открывать к серверу загрузки заранее, как только выдан его URL
+UPLOAD_PREWARM = int(os.environ.get('UPLOAD_PREWARM', 2))
+
+def pool_size_for(host):
+    """Размер пула для хоста: самое длинное подходящее правило из HTTP_POOL_SIZES"""
+    host = (host or '').lower()
+    matches = [suffix for suffix in HTTP_POOL_SIZES if host == suffix or host.endswith('.' + suffix)]
+    return HTTP_POOL_SIZES[max(matches, key=len)] if matches else HTTP_POOL_SIZE
+
+class CountingPoolMixin:
+    """Считает запросы по уже открытому соединению (hit) и с новым подключением,
+    то есть с TCP и TLS заново (miss)"""
+    pool_name = ''
+    
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        result = 'miss' if getattr(conn, 'sock', None) is None else 'hit'
+        metrics.http_pool_requests.labels(self.pool_name, metrics.host_class(self.host), result).inc()
+        return conn
+    
+    def _put_conn(self, conn):
+        if conn is not None and self.pool is not None and self.pool.full():
+            # Пул хоста полон - соединение будет закрыто
+            metrics.http_pool_discarded.labels(self.pool_name, metrics.host_class(self.host)).inc()
+        super()._put_conn(conn)
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+class HostPoolManager(PoolManager):
+    """PoolManager с размером пула по хосту и счетчиками соединений"""
+    def __init__(self, pool_name, num_pools=10, **kwargs):
+        super().__init__(num_pools, **kwargs)
+        self.pool_name = pool_name
+        self.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+        dispose = self.pools.dispose_func
+        
+        def evict(pool):
+            metrics.http_pool_evictions.labels(pool_name).inc()
+            dispose(pool)
+        self.pools.dispose_func = evict
+    
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+        request_context['maxsize'] = pool_size_for(host)
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.pool_name = self.pool_name
+        return pool
+
+class HostPoolAdapter(HTTPAdapter):
+    """HTTPAdapter на HostPoolManager; умеет заранее открывать соединения к хосту"""
+    def __init__(self, pool_name, **kwargs):
+        self.pool_name = pool_name
+        super().__init__(**kwargs)
+    
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = HostPoolManager(self.pool_name, connections, maxsize=maxsize, block=block, **pool_kwargs)
+    
+    def prewarm(self, url, count):
+        """Довести число открытых свободных соединений к хосту url до count.
+        Занятые соединения не ждем: если свободных нет, хост и так горячий"""
+        pool = self.poolmanager.connection_from_url(url)
+        taken = []
+        try:
+            for _ in range(min(count, pool.pool.maxsize)):
+                try:
+                    taken.append(pool.pool.get(block=False))
+                except queue.Empty:
+                    break
+            for i, conn in enumerate(taken):
+                if conn is not None and conn.sock is not None:
+                    continue
+                conn = conn or pool._new_conn()
+                try:
+                    conn.connect()
+                    taken[i] = conn
+                    metrics.http_pool_prewarmed.labels(self.pool_name, metrics.host_class(pool.host)).inc()
+                except Exception as e:
+                    conn.close()
+                    print(f"⚠️ Не удалось заранее подключиться к {pool.host}: {e}")
+                    break
+        finally:
+            for conn in taken:
+                pool._put_conn(conn)
+
+def create_session_with_retries(pool_name):
     """Создает сессию с повторными попытками и keep-alive"""
     session = requests.Session()
-    retry = Retry(
+    retry = metrics.CountingRetry(
         total=2,
         read=2,
         connect=2,
         backoff_factor=0.2,
         status_forcelist=(500, 502, 503, 504)
     )
-    adapter = HTTPAdapter(
+    adapter = HostPoolAdapter(
+        pool_name,
         max_retries=retry,
-        pool_connections=10,
-        pool_maxsize=10
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_SIZE
     )
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 # Сессии для разных целей
-vk_session = create_session_with_retries()
-upload_session = create_session_with_retries()
+vk_session = create_session_with_retries('vk')
+upload_session = create_session_with_retries('upload')
+
+# Заранее открытые соединения к серверам загрузки: один прогрев на хост за раз
+prewarm_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prewarm')
+prewarming = set()
+prewarming_lock = threading.Lock()
+
+def prewarm_upload_hosts(*upload_urls):
+    """Открыть в фоне соединения к серверам загрузки, чьи URL только что выданы"""
+    if UPLOAD_PREWARM <= 0:
+        return
+    for url in upload_urls:
+        if not url:
+            continue
+        host = url.split('/', 3)[2] if '://' in url else url
+        with prewarming_lock:
+            if host in prewarming:
+                continue
+            prewarming.add(host)
+        prewarm_executor.submit(prewarm_upload_host, host, url)
+
+def prewarm_upload_host(host, url):
+    try:
+        upload_session.get_adapter(url).prewarm(url, UPLOAD_PREWARM)
+    except Exception as e:
+        print(f"⚠️ Прогрев соединений к {host}: {e}")
+    finally:
+        with prewarming_lock:
+            prewarming.discard(host)
+
+# ==================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ К VK ====================
+VK_RATE_LIMIT = float(os.environ.get('VK_RATE_LIMIT', 3))   # запросов в секунду на токен
+VK_RATE_BURST = int(os.environ.get('VK_RATE_BURST', 3))
+VK_MAX_RETRIES = int(os.environ.get('VK_MAX_RETRIES', 5))
+# Код ошибки VK -> базовая пауза перед повтором (6 - слишком много запросов, 9 - flood control)
+VK_RETRY_CODES = {6: 0.5, 9: 3.0}
+
+class VKError(Exception):
+    """Ошибка, которую вернул API VK (HTTP 200 с полем error)"""
+    def __init__(self, code, message):
+        super().__init__(f"VK Error: {message}")
+        self.code = code
+        self.message = message
+
+class TokenBucket:
+    """Корзина токенов: rate запросов в секунду, не более burst подряд"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self):
+        """Занять место в очереди, вернуть сколько нужно подождать"""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def penalize(self, delay):
+        """Сдвинуть все следующие запросы минимум на delay секунд.
+        Повторные штрафы не складываются: на одну ошибку execute жалуются все его вызовы"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -delay * self.rate)
+
+class RateLimiter:
+    """Общий для процесса ограничитель, отдельная корзина на каждый access_token"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    def bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rate, self.burst)
+            return self.buckets[key]
+    
+    def acquire(self, key):
+        delay = self.bucket(key).reserve()
+        if delay > 0:
+            with profiling.phase('rate_limit'):
+                time.sleep(delay)
+    
+    def penalize(self, key, delay):
+        self.bucket(key).penalize(delay)
+
+vk_rate_limiter = RateLimiter(VK_RATE_LIMIT, VK_RATE_BURST)
+
+def vk_request(method, params, http_method='GET', timeout=30):
+    """Один HTTP-вызов метода VK через общий ограничитель, возвращает весь ответ"""
+    vk_rate_limiter.acquire(params.get('access_token'))
+    url = f"{VK_API_URL}/{method}"
+    with metrics.vk_request_seconds.labels(method).time():
+        if http_method == 'POST':
+            response = vk_session.post(url, data=params, timeout=timeout)
+        else:
+            response = vk_session.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    result = response.json()
+    if 'error' in result:
+        raise VKError(result['error'].get('error_code'), result['error'].get('error_msg'))
+    return result
+
+# ==================== ПАКЕТНЫЕ ВЫЗОВЫ (EXECUTE) ====================
+VK_BATCH_SIZE = min(int(os.environ.get('VK_BATCH_SIZE', 25)), 25)  # execute принимает до 25 вызовов
+VK_BATCH_WINDOW = float(os.environ.get('VK_BATCH_WINDOW', 0.05))    # секунд ожидания попутчиков
+
+class VKBatcher:
+    """Собирает вызовы с одним токеном за короткое окно и отправляет их одним execute"""
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}   # access_token -> [(method, params, http_method, timeout, future)]
+        self.timers = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, method, params, http_method='GET', timeout=30):
+        token = params.get('access_token')
+        future = Future()
+        ready = None
+        with self.lock:
+            batch = self.pending.setdefault(token, [])
+            batch.append((method, params, http_method, timeout, future))
+            if len(batch) >= self.max_size:
+                ready = self._take(token)
+            elif token not in self.timers:
+                timer = threading.Timer(self.window, self.flush, args=(token,))
+                timer.daemon = True
+                self.timers[token] = timer
+                timer.start()
+        if ready:
+            self._send(token, ready)
+        return future
+    
+    def _take(self, token):
+        timer = self.timers.pop(token, None)
+        if timer:
+            timer.cancel()
+        return self.pending.pop(token, [])
+    
+    def flush(self, token):
+        with self.lock:
+            batch = self._take(token)
+        if batch:
+            self._send(token, batch)
+    
+    def _send(self, token, batch):
+        if len(batch) == 1:
+            # Одиночный вызов отправляем как есть, без обертки execute
+            method, params, http_method, timeout, future = batch[0]
+            try:
+                future.set_result(vk_request(method, params, http_method, timeout)['response'])
+            except Exception as e:
+                future.set_exception(e)
+            return
+        
+        calls = []
+        for method, params, _, _, _ in batch:
+            args = {k: v for k, v in params.items() if k not in ('access_token', 'v')}
+            calls.append(f"API.{method}({json.dumps(args, ensure_ascii=False)})")
+        params = {
+            'access_token': token,
+            'v': VK_API_VERSION,
+            'code': f"return [{','.join(calls)}];"
+        }
+        
+        try:
+            result = vk_request('execute', params, 'POST', max(item[3] for item in batch))
+        except Exception as e:
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+        
+        # Неудачный вызов внутри execute дает false, а его ошибка идет
+        # в execute_errors в том же порядке
+        errors = iter(result.get('execute_errors', []))
+        values = result['response'] or []
+        for i, (method, _, _, _, future) in enumerate(batch):
+            value = values[i] if i < len(values) else False
+            if value is False:
+                error = next(errors, {})
+                future.set_exception(VKError(error.get('error_code'), error.get('error_msg', f'{method} не выполнен')))
+            else:
+                future.set_result(value)
+        print(f"📦 execute: {len(batch)} вызовов одним запросом")
+
+vk_batcher = VKBatcher(VK_BATCH_WINDOW, VK_BATCH_SIZE) if VK_BATCH_SIZE > 1 and VK_BATCH_WINDOW > 0 else None
+
+def vk_send(method, params, http_method='GET', timeout=30):
+    """Вызов метода VK: через пакет execute, если он включен, иначе напрямую"""
+    if vk_batcher:
+        return vk_batcher.submit(method, params, http_method, timeout).result()
+    return vk_request(method, params, http_method, timeout)['response']
+
+def vk_call(method, params, http_method='GET', timeout=30):
+    """Вызов метода VK с повтором и паузой при ошибках 6 и 9 (в очереди сессии потока)"""
+    with proxy_scheduler.slot(), metrics.vk_call_seconds.labels(method).time(), profiling.phase(f'vk.{method}'):
+        return vk_call_with_retries(method, params, http_method, timeout)
+
+# Независимые вызовы одного запроса идут из разных потоков, чтобы попасть
+# в одно окно VKBatcher, а не в execute по одному
+vk_parallel_executor = ThreadPoolExecutor(max_workers=max(1, VK_BATCH_SIZE), thread_name_prefix='vk')
+
+def vk_call_parallel(calls):
+    """calls - [(функция, аргументы)], результат - в том же порядке.
+    Ошибка первого неудачного вызова пробрасывается, когда завершатся все"""
+    futures = [vk_parallel_executor.submit(profiling.in_request_context(fn), *args) for fn, args in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+def replacement_token(token, code):
+    """Рабочий токен пула вместо token, если ошибка code вывела его из работы"""
+    if code not in TOKEN_AUTH_ERRORS | TOKEN_FLOOD_ERRORS:
+        return None
+    return token_health.alternative(token)
+
+def vk_call_with_retries(method, params, http_method, timeout):
+    for attempt in range(VK_MAX_RETRIES + 1):
+        try:
+            result = vk_send(method, params, http_method, timeout)
+            token_health.record_success(params.get('access_token'))
+            return result
+        except VKError as e:
+            metrics.vk_errors.labels(method, str(e.code)).inc()
+            token_health.record_error(params.get('access_token'), e.code)
+            # Повтор выведенным токеном ждал бы паузу flood control - переходим на соседний
+            alternative = replacement_token(params.get('access_token'), e.code)
+            if alternative and method in TOKEN_BOUND_METHODS:
+                raise
+            if alternative:
+                print(f"🔀 {method}: токен {token_label(params['access_token'])} выведен, повтор с {token_label(alternative)}")
+                params = dict(params, access_token=alternative)
+                continue
+            base_delay = VK_RETRY_CODES.get(e.code)
+            if base_delay is None or attempt == VK_MAX_RETRIES:
+                raise
+            delay = base_delay * (2 ** attempt) * random.uniform(0.8, 1.2)
+            # Штраф сдвигает очередь всех потоков с этим токеном, поэтому повтор
+            # просто встает в нее заново и дождется паузы в vk_request
+            vk_rate_limiter.penalize(params.get('access_token'), delay)
+            print(f"⏳ {method}: код VK {e.code}, повтор через {delay:.1f}с")
+
+# ==================== ПУЛ ТОКЕНОВ ====================
+# В config.txt можно указать несколько токенов с весами: ACCESS_TOKENS=токен1:3,токен2,токен3:2.
+# Строки раскладываются по токенам пропорционально весам, у каждого токена свой лимит VK.
+# Коды VK, после которых токен выводится из работы: 5, 27, 28 - токен недействителен,
+# 9 и 29 - flood control и дневной лимит метода
+TOKEN_AUTH_ERRORS = {5, 27, 28}
+TOKEN_FLOOD_ERRORS = {9, 29}
+TOKEN_EJECT_AUTH = int(os.environ.get('TOKEN_EJECT_AUTH', 3600))    # секунд
+TOKEN_EJECT_FLOOD = int(os.environ.get('TOKEN_EJECT_FLOOD', 60))    # секунд, удваивается при повторах
+# Методы, чей результат привязан к пользователю токена: URL загрузки и сохранение
+# по нему. Другим токеном их не повторить, поэтому при выводе токена (если в пуле
+# есть рабочий) они сразу завершаются ошибкой, а строка при повторе получит рабочий
+TOKEN_BOUND_METHODS = {'photos.getUploadServer', 'photos.getWallUploadServer', 'photos.save', 'photos.saveWallPhoto'}
+
+def config_tokens(config):
+    """[(токен, вес)] из ACCESS_TOKENS (вес по умолчанию 1) или единственный ACCESS_TOKEN"""
+    tokens = []
+    for item in (config.get('ACCESS_TOKENS') or '').split(','):
+        token, _, weight = item.strip().partition(':')
+        if token:
+            tokens.append((token, float(weight) if weight else 1.0))
+    if not tokens and config.get('ACCESS_TOKEN'):
+        tokens.append((config['ACCESS_TOKEN'], 1.0))
+    return tokens
+
+def token_label(token):
+    """Токен для логов и ответов: только конец"""
+    return f"...{token[-6:]}"
+
+def rendezvous_score(token, weight, key):
+    """Взвешенное рандеву-хэширование: ключ всегда попадает на один и тот же токен,
+    а при выводе токена из работы переезжают только его ключи"""
+    digest = hashlib.blake2b(f"{token}:{key}".encode(), digest_size=8).digest()
+    h = (int.from_bytes(digest, 'big') + 1) / (2 ** 64 + 1)
+    return weight / -math.log(h)
+
+class TokenHealth:
+    """Состояние токенов процесса: ошибки подряд и до какого времени токен выведен из работы"""
+    def __init__(self, auth_eject, flood_eject):
+        self.auth_eject = auth_eject
+        self.flood_eject = flood_eject
+        self.states = {}   # токен -> {'errors': n, 'until': monotonic, 'code': код VK}
+        self.pools = {}    # токен -> [(токен, вес)] его пула из config.txt
+        self.lock = threading.Lock()
+    
+    def register(self, tokens):
+        """Запомнить пул, чтобы повтор вызова мог перейти на соседний токен"""
+        for token, _ in tokens:
+            self.pools[token] = tokens
+    
+    def alternative(self, token):
+        """Рабочий токен из пула token вместо выведенного token, None - если замены нет"""
+        now = time.monotonic()
+        healthy = [(other, weight) for other, weight in self.pools.get(token, ())
+                   if other != token and self.ejected_until(other) <= now]
+        if not healthy:
+            return None
+        return max(healthy, key=lambda item: rendezvous_score(item[0], item[1], token))[0]
+    
+    def ejected_until(self, token):
+        state = self.states.get(token)
+        return state['until'] if state else 0.0
+    
+    def record_success(self, token):
+        if token in self.states:
+            with self.lock:
+                state = self.states.get(token)
+                if state and state['until'] <= time.monotonic():
+                    del self.states[token]
+    
+    def record_error(self, token, code):
+        if not token or code not in TOKEN_AUTH_ERRORS | TOKEN_FLOOD_ERRORS:
+            return
+        with self.lock:
+            state = self.states.setdefault(token, {'errors': 0, 'until': 0.0, 'code': None})
+            state['errors'] += 1
+            if code in TOKEN_AUTH_ERRORS:
+                delay = self.auth_eject
+            else:
+                delay = min(self.flood_eject * 2 ** (state['errors'] - 1), self.auth_eject)
+            state['until'] = max(state['until'], time.monotonic() + delay)
+            state['code'] = code
+        reason = 'auth' if code in TOKEN_AUTH_ERRORS else 'flood'
+        metrics.vk_token_ejections.labels(reason).inc()
+        print(f"🚫 Токен {token_label(token)} выведен из работы на {delay:.0f}с: код VK {code}")
+    
+    def choose(self, tokens, key):
+        """Токен для ключа среди рабочих; если выведены все - тот, что вернется раньше"""
+        if len(tokens) == 1:
+            return tokens[0][0]
+        now = time.monotonic()
+        healthy = [(token, weight) for token, weight in tokens if self.ejected_until(token) <= now]
+        if not healthy:
+            return min(tokens, key=lambda item: self.ejected_until(item[0]))[0]
+        return max(healthy, key=lambda item: rendezvous_score(item[0], item[1], key))[0]
+    
+    def ejected_count(self):
+        now = time.monotonic()
+        return sum(1 for state in list(self.states.values()) if state['until'] > now)
+    
+    def report(self, tokens):
+        """Состояние токенов конфига без самих токенов"""
+        now = time.monotonic()
+        return [{
+            'token': token_label(token),
+            'weight': weight,
+            'ejected_for': max(0, round(self.ejected_until(token) - now)),
+            'last_error': (self.states.get(token) or {}).get('code')
+        } for token, weight in tokens]
+
+token_health = TokenHealth(TOKEN_EJECT_AUTH, TOKEN_EJECT_FLOOD)
+metrics.vk_tokens_ejected.set_function(token_health.ejected_count)
+
+def token_config(config, key):
+    """Конфиг с одним токеном из пула для ключа (строка CSV, комментарий).
+    Все вызовы с этим конфигом идут от одного пользователя, а кэш URL загрузки,
+    ограничитель и пакеты execute и так разделены по токенам"""
+    tokens = config_tokens(config)
+    if len(tokens) <= 1:
+        return config
+    token_health.register(tokens)
+    return dict(config, ACCESS_TOKEN=token_health.choose(tokens, key))
+
+def row_config(config, row_index):
+    return token_config(config, f"row:{row_index}")
+
+def upload_config(config, upload_url, key):
+    """Конфиг с токеном, которым получен upload_url: photos.save принимает файл
+    только от того же пользователя. Если URL выдан не этим процессом или уже
+    выброшен из кэша, берем токен по ключу, и URL запрашивается заново"""
+    tokens = config_tokens(config)
+    if len(tokens) <= 1:
+        return config, upload_url
+    token_health.register(tokens)
+    owner = upload_url_cache.owner(upload_url) if upload_url else None
+    if owner in dict(tokens):
+        return dict(config, ACCESS_TOKEN=owner), upload_url
+    return token_config(config, key), None
 
 # ==================== ХРАНЕНИЕ СЕССИЙ ====================
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')     # memory или sqlite
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', os.path.join(JOBS_DIR, 'sessions.db'))
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 3600))   # секунд без изменений
+SESSION_MAX = int(os.environ.get('SESSION_MAX', 200))         # только для memory
+SESSION_SWEEP_INTERVAL = 60
+
+# Поля-коллекции пополняются по элементу, не переписывая сессию целиком
+SESSION_COLLECTIONS = {'results': list, 'uploaded_files': set, 'missing_files': set}
+# Поля, которые не меняются после создания сессии, а читаются на каждую строку
+# (в SQLite каждое чтение - разбор всего CSV): последние держим в памяти процесса
+SESSION_CONSTANT_FIELDS = {'csv_data', 'plan'}
+SESSION_FIELD_CACHE_SIZE = int(os.environ.get('SESSION_FIELD_CACHE_SIZE', 64))
+
+class SessionStore(ABC):
+    """Интерфейс хранилища сессий.
+    Сессия - словарь полей; поля из SESSION_COLLECTIONS пополняются через append"""
+    def __init__(self, ttl, on_evict=None):
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.last_sweep = 0.0
+    
+    @abstractmethod
+    def get(self, session_id):
+        """Вся сессия или {} если ее нет"""
+    
+    @abstractmethod
+    def get_field(self, session_id, key, default=None):
+        pass
+    
+    @abstractmethod
+    def set(self, session_id, data):
+        pass
+    
+    @abstractmethod
+    def update_field(self, session_id, key, fn):
+        """Атомарно заменить поле на fn(текущее значение), вернуть новое значение.
+        Для несуществующей сессии ничего не делает и возвращает None"""
+    
+    @abstractmethod
+    def append(self, session_id, key, *items):
+        """Добавить элементы в поле-коллекцию, вернуть сколько добавлено
+        (в множество не попадают уже имеющиеся)"""
+    
+    @abstractmethod
+    def discard(self, session_id, key, *items):
+        """Убрать элементы из поля-множества, вернуть сколько убрано"""
+    
+    @abstractmethod
+    def collection(self, session_id, key):
+        """Поле-коллекция целиком (копия)"""
+    
+    @abstractmethod
+    def page(self, session_id, key, offset, limit):
+        """Элементы поля-списка [offset, offset + limit) в порядке добавления"""
+    
+    @abstractmethod
+    def head(self, session_id, key, limit):
+        """Не больше limit элементов поля-коллекции, не читая остальные"""
+    
+    @abstractmethod
+    def delete(self, session_id):
+        pass
+    
+    @abstractmethod
+    def count(self):
+        pass
+    
+    def maybe_sweep(self):
+        now = time.time()
+        if now - self.last_sweep < SESSION_SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        for session_id in self.sweep(now - self.ttl):
+            print(f"🧹 Сессия {session_id} удалена по TTL")
+            if self.on_evict:
+                self.on_evict(session_id)
+    
+    @abstractmethod
+    def sweep(self, older_than):
+        """Удалить сессии, не менявшиеся с older_than, вернуть их id"""
+
+class MemorySessionStore(SessionStore):
+    """Сессии в памяти процесса с TTL и ограничением числа (вытесняются самые старые)"""
+    def __init__(self, ttl, max_sessions, on_evict=None):
+        super().__init__(ttl, on_evict)
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.lock = threading.Lock()
+    
+    def get(self, session_id):
+        self.maybe_sweep()
+        with self.lock:
+            return self.sessions.get(session_id, {})
+    
+    def get_field(self, session_id, key, default=None):
+        with self.lock:
+            return self.sessions.get(session_id, {}).get(key, default)
+    
+    def set(self, session_id, data):
+        evicted = []
+        with self.lock:
+            self.sessions[session_id] = data
+            data['_timestamp'] = time.time()
+            while len(self.sessions) > self.max_sessions:
+                oldest = min(self.sessions, key=lambda sid: self.sessions[sid]['_timestamp'])
+                del self.sessions[oldest]
+                evicted.append(oldest)
+        for session_id in evicted:
+            print(f"🧹 Сессия {session_id} вытеснена: превышен SESSION_MAX={self.max_sessions}")
+            if self.on_evict:
+                self.on_evict(session_id)
+        self.maybe_sweep()
+    
+    def update_field(self, session_id, key, fn):
+        with self.lock:
+            data = self.sessions.get(session_id)
+            if data is None:
+                return None
+            data[key] = fn(data.get(key))
+            data['_timestamp'] = time.time()
+            return data[key]
+    
+    def append(self, session_id, key, *items):
+        with self.lock:
+            data = self.sessions.get(session_id)
+            if data is None:
+                return 0
+            collection = data.setdefault(key, SESSION_COLLECTIONS[key]())
+            size = len(collection)
+            if isinstance(collection, set):
+                collection.update(items)
+            else:
+                collection.extend(items)
+            data['_timestamp'] = time.time()
+            return len(collection) - size
+    
+    def discard(self, session_id, key, *items):
+        with self.lock:
+            collection = self.sessions.get(session_id, {}).get(key)
+            if not collection:
+                return 0
+            size = len(collection)
+            collection.difference_update(items)
+            return size - len(collection)
+    
+    def collection(self, session_id, key):
+        with self.lock:
+            return SESSION_COLLECTIONS[key](self.sessions.get(session_id, {}).get(key, ()))
+    
+    def page(self, session_id, key, offset, limit):
+        with self.lock:
+            return self.sessions.get(session_id, {}).get(key, [])[offset:offset + limit]
+    
+    def head(self, session_id, key, limit):
+        with self.lock:
+            return list(islice(self.sessions.get(session_id, {}).get(key, ()), limit))
+    
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+    
+    def count(self):
+        with self.lock:
+            return len(self.sessions)
+    
+    def sweep(self, older_than):
+        with self.lock:
+            expired = [sid for sid, data in self.sessions.items() if data['_timestamp'] < older_than]
+            for session_id in expired:
+                del self.sessions[session_id]
+        return expired
+
+class SQLiteSessionStore(SessionStore):
+    """Сессии в SQLite (WAL): общие для нескольких процессов gunicorn.
+    Каждое поле хранится отдельно, поэтому обновление счетчика не переписывает csv_data"""
+    def __init__(self, path, ttl, on_evict=None):
+        super().__init__(ttl, on_evict)
+        self.path = path
+        self.local = threading.local()
+        with self.connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, updated REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+                CREATE TABLE IF NOT EXISTS session_fields (
+                    id TEXT, key TEXT, value BLOB, PRIMARY KEY (id, key));
+                CREATE TABLE IF NOT EXISTS session_lists (id TEXT, key TEXT, item BLOB);
+                CREATE INDEX IF NOT EXISTS session_lists_id ON session_lists (id, key);
+                CREATE TABLE IF NOT EXISTS session_sets (
+                    id TEXT, key TEXT, item BLOB, PRIMARY KEY (id, key, item));
+            """)
+    
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = open_db(self.path)
+            self.local.db = db
+        return db
+    
+    def exists(self, db, session_id):
+        return db.execute('SELECT 1 FROM sessions WHERE id = ?', (session_id,)).fetchone() is not None
+    
+    def touch(self, db, session_id):
+        db.execute('UPDATE sessions SET updated = ? WHERE id = ?', (time.time(), session_id))
+    
+    def get(self, session_id):
+        self.maybe_sweep()
+        db = self.connect()
+        if not self.exists(db, session_id):
+            return {}
+        data = {key: pickle.loads(value) for key, value in
+                db.execute('SELECT key, value FROM session_fields WHERE id = ?', (session_id,))}
+        for key, kind in SESSION_COLLECTIONS.items():
+            table = 'session_sets' if kind is set else 'session_lists'
+            rows = db.execute(f'SELECT item FROM {table} WHERE id = ? AND key = ? ORDER BY rowid', (session_id, key))
+            data[key] = kind(pickle.loads(item) for item, in rows)
+        return data
+    
+    def get_field(self, session_id, key, default=None):
+        row = self.connect().execute(
+            'SELECT value FROM session_fields WHERE id = ? AND key = ?', (session_id, key)).fetchone()
+        return pickle.loads(row[0]) if row else default
+    
+    def set(self, session_id, data):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._delete(db, session_id)
+            db.execute('INSERT INTO sessions (id, updated) VALUES (?, ?)', (session_id, time.time()))
+            for key, value in data.items():
+                if key in SESSION_COLLECTIONS:
+                    self._append(db, session_id, key, value)
+                else:
+                    db.execute('INSERT INTO session_fields (id, key, value) VALUES (?, ?, ?)',
+                               (session_id, key, pickle.dumps(value)))
+        self.maybe_sweep()
+    
+    def update_field(self, session_id, key, fn):
+        db = self.connect()
+        with db:
+            # BEGIN IMMEDIATE берет блокировку записи сразу: чтение-изменение-запись
+            # атомарно и между процессами
+            db.execute('BEGIN IMMEDIATE')
+            if not self.exists(db, session_id):
+                return None
+            row = db.execute('SELECT value FROM session_fields WHERE id = ? AND key = ?',
+                             (session_id, key)).fetchone()
+            value = fn(pickle.loads(row[0]) if row else None)
+            db.execute('INSERT OR REPLACE INTO session_fields (id, key, value) VALUES (?, ?, ?)',
+                       (session_id, key, pickle.dumps(value)))
+            self.touch(db, session_id)
+            return value
+    
+    def append(self, session_id, key, *items):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            if not self.exists(db, session_id):
+                return 0
+            added = self._append(db, session_id, key, items)
+            self.touch(db, session_id)
+            return added
+    
+    def _append(self, db, session_id, key, items):
+        if SESSION_COLLECTIONS[key] is set:
+            sql = 'INSERT OR IGNORE INTO session_sets (id, key, item) VALUES (?, ?, ?)'
+        else:
+            sql = 'INSERT INTO session_lists (id, key, item) VALUES (?, ?, ?)'
+        return db.executemany(sql, [(session_id, key, pickle.dumps(item)) for item in items]).rowcount
+    
+    def discard(self, session_id, key, *items):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            return db.executemany('DELETE FROM session_sets WHERE id = ? AND key = ? AND item = ?',
+                                  [(session_id, key, pickle.dumps(item)) for item in items]).rowcount
+    
+    def collection(self, session_id, key):
+        kind = SESSION_COLLECTIONS[key]
+        table = 'session_sets' if kind is set else 'session_lists'
+        rows = self.connect().execute(
+            f'SELECT item FROM {table} WHERE id = ? AND key = ? ORDER BY rowid', (session_id, key))
+        return kind(pickle.loads(item) for item, in rows)
+    
+    def page(self, session_id, key, offset, limit):
+        rows = self.connect().execute(
+            'SELECT item FROM session_lists WHERE id = ? AND key = ? ORDER BY rowid LIMIT ? OFFSET ?',
+            (session_id, key, limit, offset))
+        return [pickle.loads(item) for item, in rows]
+    
+    def head(self, session_id, key, limit):
+        table = 'session_sets' if SESSION_COLLECTIONS[key] is set else 'session_lists'
+        rows = self.connect().execute(
+            f'SELECT item FROM {table} WHERE id = ? AND key = ? ORDER BY rowid LIMIT ?', (session_id, key, limit))
+        return [pickle.loads(item) for item, in rows]
+    
+    def _delete(self, db, session_id):
+        for table in ('sessions', 'session_fields', 'session_lists', 'session_sets'):
+            db.execute(f'DELETE FROM {table} WHERE id = ?', (session_id,))
+    
+    def delete(self, session_id):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._delete(db, session_id)
+    
+    def count(self):
+        return self.connect().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+    
+    def sweep(self, older_than):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            expired = [sid for sid, in db.execute('SELECT id FROM sessions WHERE updated < ?', (older_than,))]
+            for session_id in expired:
+                self._delete(db, session_id)
+        return expired
+
+def open_db(path):
+    """Подключение SQLite в режиме WAL: читатели не ждут писателя"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+def evict_session(session_id):
+    """Сессия удалена хранилищем (TTL или SESSION_MAX): файлы задания и кэш ее полей"""
+    session_field_cache.discard(session_id)
+    cleanup_job_files(session_id)
+
+def create_session_store():
+    on_evict = evict_session
+    if SESSION_STORE == 'sqlite':
+        print(f"💾 Сессии в SQLite: {SESSION_DB_PATH}")
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_TTL, on_evict)
+    return MemorySessionStore(SESSION_TTL, SESSION_MAX, on_evict)
+
+session_store = create_session_store()
+metrics.active_sessions.set_function(lambda: session_store.count())
+
+class SessionFieldCache:
+    """Неизменяемые поля сессий (SESSION_CONSTANT_FIELDS) в памяти процесса, LRU"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()   # (сессия, поле) -> значение
+        self.lock = threading.Lock()
+    
+    def get(self, session_id, key, load):
+        with self.lock:
+            if (session_id, key) in self.entries:
+                self.entries.move_to_end((session_id, key))
+                return self.entries[(session_id, key)]
+        value = load()
+        if value is not None:
+            with self.lock:
+                self.entries[(session_id, key)] = value
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return value
+    
+    def discard(self, session_id):
+        with self.lock:
+            for key in SESSION_CONSTANT_FIELDS:
+                self.entries.pop((session_id, key), None)
+
+session_field_cache = SessionFieldCache(SESSION_FIELD_CACHE_SIZE)
+
 def get_session(session_id):
-    with session_lock:
-        return sessions.get(session_id, {})
+    with profiling.phase('session'):
+        return session_store.get(session_id)
+
+def get_session_field(session_id, key, default=None):
+    with profiling.phase('session'):
+        if key in SESSION_CONSTANT_FIELDS:
+            value = session_field_cache.get(session_id, key, lambda: session_store.get_field(session_id, key))
+            return default if value is None else value
+        return session_store.get_field(session_id, key, default)
+
+def get_session_fields(session_id, *keys):
+    """Только нужные поля сессии (отсутствующие пропускаются) - без чтения
+    результатов и множеств файлов"""
+    fields = {key: get_session_field(session_id, key) for key in keys}
+    return {key: value for key, value in fields.items() if value is not None}
 
 def set_session(session_id, data):
-    with session_lock:
-        sessions[session_id] = data
-        sessions[session_id]['_timestamp'] = time.time()
+    with profiling.phase('session'):
+        session_field_cache.discard(session_id)
+        session_store.set(session_id, data)
+
+def update_session_field(session_id, key, fn):
+    # Включает ожидание блокировки записи SQLite (BEGIN IMMEDIATE)
+    with profiling.phase('session'):
+        return session_store.update_field(session_id, key, fn)
+
+def append_session(session_id, key, *items):
+    with profiling.phase('session'):
+        return session_store.append(session_id, key, *items)
+
+def discard_session(session_id, key, *items):
+    with profiling.phase('session'):
+        return session_store.discard(session_id, key, *items)
 
 def delete_session(session_id):
-    with session_lock:
-        if session_id in sessions:
-            del sessions[session_id]
+    with profiling.phase('session'):
+        session_field_cache.discard(session_id)
+        session_store.delete(session_id)
+
+# ==================== КОНТРОЛЬНЫЕ ТОЧКИ И ИДЕМПОТЕНТНОСТЬ ====================
+CHECKPOINT_DB_PATH = os.environ.get('CHECKPOINT_DB_PATH', os.path.join(JOBS_DIR, 'checkpoints.db'))
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 7 * 24 * 3600))   # секунд
+# Задание без признаков жизни дольше этого считается упавшим, его можно продолжить
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 300))
+
+class CheckpointStore:
+    """Долговечные шаги обработки строк и ответы по ключам идемпотентности (SQLite).
+    Шаги строки: album - фото в альбоме, wall:<файл> - фото для стены,
+    comment:<номер группы> - созданный комментарий"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.last_sweep = 0.0
+        self.connect().executescript("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                session_id TEXT, row_index INTEGER, step TEXT, value TEXT, created REAL,
+                PRIMARY KEY (session_id, row_index, step));
+            CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY, status INTEGER, body TEXT, created REAL);
+        """)
+    
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = open_db(self.path)
+            self.local.db = db
+        return db
+    
+    def load(self, session_id, row_index):
+        rows = self.connect().execute(
+            'SELECT step, value FROM checkpoints WHERE session_id = ? AND row_index = ?', (session_id, row_index))
+        return {step: json.loads(value) for step, value in rows}
+    
+    def save(self, session_id, row_index, step, value):
+        self.connect().execute(
+            'INSERT OR REPLACE INTO checkpoints (session_id, row_index, step, value, created) VALUES (?, ?, ?, ?, ?)',
+            (session_id, row_index, step, json.dumps(value, ensure_ascii=False), time.time()))
+    
+    def delete_session(self, session_id):
+        self.connect().execute('DELETE FROM checkpoints WHERE session_id = ?', (session_id,))
+    
+    def get_response(self, key):
+        row = self.connect().execute('SELECT status, body FROM idempotency WHERE key = ?', (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+    
+    def save_response(self, key, status, body):
+        db = self.connect()
+        db.execute('INSERT OR REPLACE INTO idempotency (key, status, body, created) VALUES (?, ?, ?, ?)',
+                   (key, status, json.dumps(body, ensure_ascii=False), time.time()))
+        if time.time() - self.last_sweep > 3600:
+            self.last_sweep = time.time()
+            db.execute('DELETE FROM idempotency WHERE created < ?', (time.time() - IDEMPOTENCY_TTL,))
+
+checkpoint_store = CheckpointStore(CHECKPOINT_DB_PATH)
+
+class KeyedLocks:
+    """Блокировка на каждый ключ; запись удаляется, когда ключ никто не держит"""
+    def __init__(self):
+        self.locks = {}   # ключ -> [lock, число владельцев]
+        self.lock = threading.Lock()
+    
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with profiling.phase('lock_wait'):
+                entry[0].acquire()
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+idempotency_locks = KeyedLocks()
+
+def save_idempotent_response(key, status, data):
+    """Сохранить успешный ответ для повторов. Ответ с partial (часть файлов не
+    загрузилась) повтору не отдается - повтор догружает файлы; он хранится
+    отдельно, чтобы повтор не создал заново то, что уже создано"""
+    if isinstance(data, dict) and data.get('partial'):
+        checkpoint_store.save_response(f"{key}:partial", status, data)
+    else:
+        checkpoint_store.save_response(key, status, data)
+
+def previous_partial_response(key):
+    """Ответ прошлой попытки с partial или None"""
+    saved = checkpoint_store.get_response(f"{key}:partial")
+    return saved[1] if saved else None
+
+def idempotent(view):
+    """Повтор запроса с тем же заголовком Idempotency-Key возвращает сохраненный
+    успешный ответ вместо повторной загрузки. Неуспешные ответы не сохраняются,
+    ответ с partial достается обработчику повтора в g.idempotent_previous"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        
+        key = f"{request.path}:{key}"
+        # Параллельный дубль ждет первый запрос, а не загружает файл второй раз
+        with idempotency_locks.hold(key):
+            saved = checkpoint_store.get_response(key)
+            if saved:
+                response = make_response(jsonify(saved[1]), saved[0])
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            
+            g.idempotent_previous = previous_partial_response(key)
+            response = make_response(view(*args, **kwargs))
+            if 200 <= response.status_code < 300 and response.is_json:
+                save_idempotent_response(key, response.status_code, response.get_json())
+            return response
+    return wrapper
 
 # ==================== ПАРСИНГ ====================
 def parse_config(content):
@@ -73,183 +1367,1946 @@ def parse_config(content):
         if '=' in line:
             key, value = line.split('=', 1)
             config[key.strip().upper()] = value.strip()
+    
+    tokens = config_tokens(config)
+    if tokens and not config.get('ACCESS_TOKEN'):
+        config['ACCESS_TOKEN'] = tokens[0][0]
     return config
 
+# Сколько байт с начала CSV смотреть при определении кодировки
+CSV_ENCODING_SAMPLE = 64 * 1024
+
+class CsvRow:
+    """Строка CSV. Слоты вместо словаря и общие (intern) строки имен файлов
+    заметно уменьшают сессию на больших каталогах"""
+    __slots__ = ('main_photo', 'description', 'comment_photos')
+    
+    def __init__(self, main_photo, description, comment_photos):
+        self.main_photo = sys.intern(main_photo)
+        self.description = description
+        self.comment_photos = tuple(sys.intern(p) for p in comment_photos)
+    
+    def __reduce__(self):
+        # После загрузки из SQLite имена снова проходят через intern
+        return CsvRow, (self.main_photo, self.description, self.comment_photos)
+    
+    def __repr__(self):
+        return f"CsvRow({self.main_photo!r}, {self.description!r}, {self.comment_photos!r})"
+
+# chardet на коротких выборках путает windows-1251 с ISO-8859-5, ISO-8859-8 и
+# MacCyrillic, поэтому по умолчанию windows-1251, а chardet может выбрать только
+# другую кириллическую кодировку и только на достаточно длинной выборке
+CSV_CHARDET_ENCODINGS = {'koi8-r'}
+CSV_CHARDET_MIN_SAMPLE = 1024       # байт
+CSV_CHARDET_CONFIDENCE = 0.9
+
+def detect_encoding(sample):
+    """Кодировка по началу файла: BOM, затем UTF-8, затем KOI8-R по chardet,
+    иначе windows-1251"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        # Выборка может оборвать последний символ посередине - это не ошибка
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if len(sample) >= CSV_CHARDET_MIN_SAMPLE:
+        guess = chardet.detect(sample)
+        encoding = (guess['encoding'] or '').lower()
+        if encoding in CSV_CHARDET_ENCODINGS and guess['confidence'] >= CSV_CHARDET_CONFIDENCE:
+            return encoding
+    return 'windows-1251'
+
 def parse_csv(content):
-    """Парсинг CSV с поддержкой Windows-1251 и UTF-8"""
-    if isinstance(content, bytes):
-        try:
-            content = content.decode('windows-1251')
-            print("✅ CSV в кодировке Windows-1251")
-        except UnicodeDecodeError:
-            try:
-                content = content.decode('utf-8-sig')
-                print("✅ CSV в кодировке UTF-8 with BOM")
-            except UnicodeDecodeError:
-                content = content.decode('utf-8')
-                print("✅ CSV в кодировке UTF-8")
-    
-    lines = [line.rstrip('\r') for line in content.split('\n') if line.strip()]
-    if not lines:
+    """Потоковый разбор CSV (байты, текст или двоичный файл) модулем csv:
+    строки читаются по одной, кавычки разбираются по правилам CSV"""
+    if isinstance(content, str):
+        text = io.StringIO(content, newline='')
+    else:
+        stream = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+        stream.seek(0)
+        encoding = detect_encoding(stream.read(CSV_ENCODING_SAMPLE))
+        stream.seek(0)
+        print(f"✅ CSV в кодировке {encoding}")
+        text = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+    
+    first = next((line for line in text if line.strip()), None)
+    if first is None:
         return []
     
     delimiter = '|'
-    start_idx = 0
-    
-    if lines[0].startswith('sep='):
-        delimiter = lines[0].split('=')[1].strip()
-        start_idx = 1
+    if first.startswith('sep='):
+        delimiter = first[4:].strip('\r\n') or delimiter
+        if len(delimiter) != 1:
+            raise ValueError(f"Разделитель должен быть одним символом: '{delimiter}'")
         print(f"✅ Разделитель: '{delimiter}'")
+        first = next((line for line in text if line.strip()), None)
+    
+    if first is not None:
+        header = first.lower()
+        if any(x in header for x in ['файл изображения', 'файл', 'image']):
+            print(f"✅ Пропущен заголовок: {first[:50].strip()}...")
+            first = None
+    
+    lines = text if first is None else chain([first], text)
+    csv_data = []
+    for parts in csv.reader(lines, delimiter=delimiter):
+        main_photo = parts[0].strip() if parts else ''
+        if not main_photo:
+            continue
+        description = parts[1].strip() if len(parts) > 1 else ''
+        comment_photos = parts[2].split(';') if len(parts) > 2 else []
+        csv_data.append(CsvRow(main_photo, description, [p.strip() for p in comment_photos if p.strip()]))
+    
+    print(f"📊 Всего загружено записей: {len(csv_data)}")
+    return csv_data
+
+# ==================== ПРОКСИ-ФУНКЦИИ ДЛЯ VK ====================
+class UploadUrlExpired(Exception):
+    """Сервер загрузки отверг URL: истек срок действия или неверная подпись"""
+
+class UploadRejected(Exception):
+    """Сервер загрузки отверг сам файл (битый, слишком большой, не фото):
+    повтор с новым URL не поможет"""
+
+# Ошибки сервера загрузки, которые относятся к URL, а не к файлу
+UPLOAD_URL_ERRORS = ('SIGNATURE', 'EXPIRED', 'INVALID_URL', 'BAD_URL')
+
+def check_upload_response(response, field):
+    """Разобрать ответ сервера загрузки, отличив протухший URL от прочих ошибок"""
+    check_upload_status(response.status_code)
+    response.raise_for_status()
+    return check_upload_result(response.json(), field)
+
+def check_upload_status(status_code):
+    if status_code in (400, 403, 404, 410):
+        raise UploadUrlExpired(f"Сервер загрузки вернул HTTP {status_code}")
+
+def check_upload_result(result, field):
+    if 'error' in result:
+        error = str(result['error'])
+        if any(marker in error.upper() for marker in UPLOAD_URL_ERRORS):
+            raise UploadUrlExpired(f"Сервер загрузки: {error}")
+        raise UploadRejected(f"Сервер загрузки: {error}")
+    if result.get(field) in (None, '', '[]'):
+        raise UploadRejected(f"Сервер загрузки не принял файл (пустое поле {field})")
+    return result
+
+class StreamingMultipart:
+    """Тело multipart/form-data, которое читается из исходных файлов кусками
+    не больше UPLOAD_CHUNK_SIZE, без сборки всего запроса в памяти"""
+    def __init__(self, fields):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.parts = []   # bytes или (файл, размер)
+        for field, filename, fileobj in fields:
+            quoted = filename.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+            header = (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field}"; filename="{quoted}"\r\n'
+                f'Content-Type: image/jpeg\r\n\r\n'
+            ).encode('utf-8')
+            size = fileobj.seek(0, io.SEEK_END)
+            self.parts += [header, (fileobj, size), b'\r\n']
+        self.parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+        self.length = sum(len(p) if isinstance(p, bytes) else p[1] for p in self.parts)
+        self.seek(0)
+    
+    def __len__(self):
+        return self.length
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        # urllib3 перематывает тело перед повтором запроса
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = 0
+        self.index = 0
+        self.part_offset = 0
+        while self.index < len(self.parts):
+            part = self.parts[self.index]
+            part_size = len(part) if isinstance(part, bytes) else part[1]
+            if offset - self.position < part_size:
+                break
+            self.position += part_size
+            self.index += 1
+        self.part_offset = offset - self.position if self.index < len(self.parts) else 0
+        self.position += self.part_offset
+        return self.position
+    
+    def read(self, size=-1):
+        if size is None or size < 0 or size > UPLOAD_CHUNK_SIZE:
+            size = UPLOAD_CHUNK_SIZE
+        while self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, bytes):
+                chunk = part[self.part_offset:self.part_offset + size]
+            else:
+                fileobj, part_size = part
+                fileobj.seek(self.part_offset)
+                chunk = fileobj.read(min(size, part_size - self.part_offset))
+            if chunk:
+                self.part_offset += len(chunk)
+                self.position += len(chunk)
+                return chunk
+            self.index += 1
+            self.part_offset = 0
+        return b''
+
+def as_upload_stream(file_data):
+    """Байты или файловый объект -> файловый объект для StreamingMultipart"""
+    if isinstance(file_data, (bytes, bytearray)):
+        return io.BytesIO(file_data)
+    return file_data
+
+def post_multipart(upload_url, fields, target):
+    """Потоковая отправка файлов на сервер загрузки VK; fields - [(поле, имя, данные)],
+    target (album или wall) - метка для метрик"""
+    body = StreamingMultipart([(field, filename, as_upload_stream(data)) for field, filename, data in fields])
+    metrics.proxy_bytes.labels('out').inc(len(body))
+    # Большое тело занимает канал дольше - в очереди сессии оно и стоит больше
+    with proxy_scheduler.slot(cost=max(1, len(body) / SCHEDULER_COST_BYTES)):
+        with metrics.uploads_in_flight.track_inprogress(), metrics.vk_upload_seconds.labels(target).time(), \
+                profiling.phase(f'upload.{target}'):
+            return upload_session.post(
+                upload_url,
+                data=body,
+                headers={'Content-Type': body.content_type},
+                timeout=60
+            )
+
+def proxy_upload_to_album(upload_url, file_data, filename):
+    """Загрузка фото в альбом"""
+    return proxy_upload_many_to_album(upload_url, [(file_data, filename)])
+
+def proxy_upload_many_to_album(upload_url, files):
+    """Загрузка до ALBUM_BATCH_SIZE фото в альбом одним запросом (file1...file5)"""
+    fields = [(f'file{i}', filename, file_data) for i, (file_data, filename) in enumerate(files, 1)]
+    response = post_multipart(upload_url, fields, 'album')
+    return check_upload_response(response, 'photos_list')
+
+def proxy_upload_to_wall(upload_url, file_data, filename):
+    """Загрузка фото на стену"""
+    response = post_multipart(upload_url, [('photo', filename, file_data)], 'wall')
+    return check_upload_response(response, 'photo')
+
+def upload_server_params(access_token, album_id, group_id=None):
+    params = {
+        'access_token': access_token,
+        'v': VK_API_VERSION,
+        'album_id': album_id
+    }
+    if group_id:
+        params['group_id'] = abs(int(group_id))
+    return params
+
+def wall_upload_server_params(access_token, group_id=None):
+    params = {
+        'access_token': access_token,
+        'v': VK_API_VERSION
+    }
+    if group_id:
+        params['group_id'] = abs(int(group_id))
+    return params
+
+def save_album_photo_params(access_token, server, photos_list, hash_value, album_id, group_id=None, description=""):
+    params = {
+        'access_token': access_token,
+        'v': '5.131',
+        'album_id': album_id,
+        'server': server,
+        'photos_list': photos_list,
+        'hash': hash_value,
+    }
+    
+    if group_id:
+        params['group_id'] = abs(int(group_id))
+    
+    if description and description.strip():
+        params['caption'] = description.strip()
+    return params
+
+def edit_photo_caption_params(access_token, owner_id, photo_id, caption):
+    return {
+        'access_token': access_token,
+        'v': VK_API_VERSION,
+        'owner_id': owner_id,
+        'photo_id': photo_id,
+        'caption': caption
+    }
+
+def save_wall_photo_params(access_token, server, photo, hash_value, group_id=None):
+    params = {
+        'access_token': access_token,
+        'v': VK_API_VERSION,
+        'server': server,
+        'photo': photo,
+        'hash': hash_value
+    }
+    if group_id:
+        params['group_id'] = abs(int(group_id))
+    return params
+
+def create_comment_params(access_token, owner_id, photo_id, attachments, group_id=None):
+    # Комментарий от имени группы
+    if group_id:
+        owner_id = -abs(int(group_id))
+    
+    params = {
+        'access_token': access_token,
+        'v': VK_API_VERSION,
+        'owner_id': owner_id,
+        'photo_id': photo_id,
+        'message': '',
+        'attachments': ','.join(attachments),
+        'from_group': 1
+    }
+    if group_id:
+        params['group_id'] = abs(int(group_id))
+    return params
+
+def proxy_get_upload_server(access_token, album_id, group_id=None):
+    """Получение сервера для загрузки в альбом"""
+    return vk_call('photos.getUploadServer', upload_server_params(access_token, album_id, group_id))['upload_url']
+
+def proxy_get_wall_upload_server(access_token, group_id=None):
+    """Получение сервера для загрузки на стену"""
+    return vk_call('photos.getWallUploadServer', wall_upload_server_params(access_token, group_id))['upload_url']
+
+def proxy_save_album_photo(access_token, server, photos_list, hash_value, album_id, group_id=None, description=""):
+    """Сохранить фото в альбоме с описанием"""
+    params = save_album_photo_params(access_token, server, photos_list, hash_value, album_id, group_id, description)
+    return vk_call('photos.save', params)
+
+def proxy_edit_photo_caption(access_token, owner_id, photo_id, caption):
+    """Задать описание уже сохраненному фото"""
+    params = edit_photo_caption_params(access_token, owner_id, photo_id, caption)
+    return vk_call('photos.edit', params, http_method='POST')
+
+def proxy_save_wall_photo(access_token, server, photo, hash_value, group_id=None):
+    """Сохранить фото для стены"""
+    params = save_wall_photo_params(access_token, server, photo, hash_value, group_id)
+    return vk_call('photos.saveWallPhoto', params, http_method='POST')
+
+def proxy_create_comment(access_token, owner_id, photo_id, attachments, group_id=None):
+    """Создание комментария от имени группы"""
+    params = create_comment_params(access_token, owner_id, photo_id, attachments, group_id)
+    comment_id = vk_call('photos.createComment', params, http_method='POST')
+    return {'comment_id': comment_id}
+
+# ==================== КЭШ URL ЗАГРУЗКИ ====================
+UPLOAD_URL_TTL = int(os.environ.get('UPLOAD_URL_TTL', 600))             # секунд
+UPLOAD_URL_CACHE_SIZE = int(os.environ.get('UPLOAD_URL_CACHE_SIZE', 1000))
+
+class UploadUrlCache:
+    """URL серверов загрузки по (токен, альбом, группа) с TTL и вытеснением старых записей"""
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()   # ключ -> (url, время истечения)
+        self.urls = {}                 # url -> ключ
+        self.lock = threading.Lock()
+    
+    def get(self, key, fetch):
+        url = self.lookup(key)
+        if url is None:
+            url = fetch()
+            self.store(key, url)
+        return url
+    
+    def lookup(self, key):
+        """URL из кэша или None, если его нет или он устарел"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[0]
+        return None
+    
+    def store(self, key, url):
+        with self.lock:
+            old = self.entries.get(key)
+            if old:
+                self.urls.pop(old[0], None)
+            self.entries[key] = (url, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            self.urls[url] = key
+            while len(self.entries) > self.max_size:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.urls.pop(evicted, None)
+    
+    def owner(self, url):
+        """Токен, которым получен url (ключи кэша - (вид, токен, ...)), или None"""
+        with self.lock:
+            key = self.urls.get(url)
+            return key[1] if key else None
+    
+    def invalidate(self, key, url=None):
+        """Выбросить запись; если передан url - только если в кэше все еще он"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and (url is None or entry[0] == url):
+                del self.entries[key]
+                self.urls.pop(entry[0], None)
+
+upload_url_cache = UploadUrlCache(UPLOAD_URL_TTL, UPLOAD_URL_CACHE_SIZE)
+
+def album_url_key(config):
+    return ('album', config['ACCESS_TOKEN'], config['ALBUM_ID'], config.get('GROUP_ID'))
+
+def wall_url_key(config):
+    return ('wall', config['ACCESS_TOKEN'], config.get('GROUP_ID'))
+
+def get_album_upload_url(config):
+    return upload_url_cache.get(album_url_key(config), lambda: proxy_get_upload_server(
+        config['ACCESS_TOKEN'], 
+        config['ALBUM_ID'], 
+        config.get('GROUP_ID')
+    ))
+
+def get_wall_upload_url(config):
+    return upload_url_cache.get(wall_url_key(config), lambda: proxy_get_wall_upload_server(
+        config['ACCESS_TOKEN'], 
+        config.get('GROUP_ID')
+    ))
+
+# ==================== ПОВТОРЫ И ДУБЛИ ЗАГРУЗОК ====================
+# POST на сервер загрузки только кладет файл во временное хранилище VK, фото
+# появляется после отдельного photos.save / saveWallPhoto. Поэтому загрузку можно
+# повторить или отправить дублем на другой сервер: лишний ответ просто не сохраняется
+UPLOAD_ATTEMPTS = int(os.environ.get('UPLOAD_ATTEMPTS', 3))
+UPLOAD_RETRY_DELAY = 0.5             # пауза перед повтором после сбоя сети или 5xx, удваивается
+# Дубль уходит, когда загрузка идет дольше p95 недавних (но не раньше UPLOAD_HEDGE_MIN_DELAY)
+UPLOAD_HEDGE = os.environ.get('UPLOAD_HEDGE', '1') == '1'
+UPLOAD_HEDGE_MIN_DELAY = float(os.environ.get('UPLOAD_HEDGE_MIN_DELAY', 2))   # секунд
+UPLOAD_HEDGE_BUDGET = float(os.environ.get('UPLOAD_HEDGE_BUDGET', 0.05))      # доля загрузок с дублем
+UPLOAD_HEDGE_MIN_SAMPLES = 20        # без стольких удачных загрузок p95 не считаем
+UPLOAD_LATENCY_WINDOW = 500          # последних загрузок цели для p95
+UPLOAD_LATENCY_MB = 1024 * 1024      # время нормируется на МБ тела, но не меньше чем на 1 МБ
+
+class UploadSource:
+    """Файл загрузки, который можно открыть несколько раз: у каждого читателя своя
+    позиция, а чтение идет под общей блокировкой. Повтор и дубль читают один
+    и тот же файл (загруженный, из архива или уменьшенный) без копии в памяти"""
+    def __init__(self, file_data):
+        self.fileobj = as_upload_stream(file_data)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.size = self.fileobj.seek(0, io.SEEK_END)
+    
+    def open(self):
+        return SourceReader(self)
+
+class SourceReader:
+    """Один читатель UploadSource - файловый объект для StreamingMultipart"""
+    def __init__(self, source):
+        self.source = source
+        self.position = 0
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.source.size
+        self.position = max(0, offset)
+        return self.position
+    
+    def tell(self):
+        return self.position
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.source.size - self.position
+        with self.source.lock:
+            self.source.fileobj.seek(self.position)
+            chunk = self.source.fileobj.read(size)
+        self.position += len(chunk)
+        return chunk
+
+class UploadTracker:
+    """Исходы загрузок и недавние времена удачных по целям (album, wall): из них
+    порог для дубля, и дублей не больше UPLOAD_HEDGE_BUDGET от всех загрузок"""
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}   # цель -> deque секунд на МБ
+        self.uploads = 0
+        self.hedges = 0
+    
+    def record(self, target, outcome, seconds=None, size=0):
+        metrics.vk_upload_attempts.labels(target, outcome).inc()
+        if seconds is None:
+            return
+        with self.lock:
+            samples = self.samples.setdefault(target, deque(maxlen=self.window))
+            samples.append(seconds / max(1, size / UPLOAD_LATENCY_MB))
+    
+    def record_error(self, target, error):
+        if isinstance(error, UploadUrlExpired):
+            self.record(target, 'expired')
+        else:
+            self.record(target, 'transient' if is_transient_upload_error(error) else 'error')
+    
+    def hedge_delay(self, target, size):
+        """Через сколько секунд отправлять дубль загрузки size байт, None - без дубля"""
+        if not UPLOAD_HEDGE:
+            return None
+        with self.lock:
+            self.uploads += 1
+            samples = sorted(self.samples.get(target, ()))
+        if len(samples) < UPLOAD_HEDGE_MIN_SAMPLES:
+            return None
+        p95 = samples[math.ceil(len(samples) * 0.95) - 1]
+        return max(UPLOAD_HEDGE_MIN_DELAY, p95 * max(1, size / UPLOAD_LATENCY_MB))
+    
+    def take_hedge(self):
+        """Разрешение на дубль из бюджета"""
+        with self.lock:
+            if self.hedges + 1 > self.uploads * UPLOAD_HEDGE_BUDGET:
+                return False
+            self.hedges += 1
+            return True
+    
+    def report(self):
+        with self.lock:
+            return {
+                'uploads': self.uploads,
+                'hedges': self.hedges,
+                'samples': {target: len(samples) for target, samples in self.samples.items()}
+            }
+
+upload_tracker = UploadTracker(UPLOAD_LATENCY_WINDOW)
+# Попытки загрузки с дублем идут в своих потоках: вызывающий ждет первую удачную.
+# Одновременно к VK все равно не больше SCHEDULER_SLOTS (честная очередь в post_multipart)
+upload_attempt_executor = ThreadPoolExecutor(max_workers=SCHEDULER_SLOTS * 2, thread_name_prefix='upload')
+
+# Сбои сети и таймауты HTTP-клиента; asgi.py добавляет сюда исключения aiohttp
+TRANSIENT_UPLOAD_ERRORS = (requests.ConnectionError, requests.Timeout, ValueError)
+
+def is_transient_upload_error(error):
+    """Сбой, после которого загрузку стоит повторить с тем же URL: сеть, таймаут,
+    5xx и 429 сервера загрузки или оборванный ответ"""
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else 0
+        return status == 429 or status >= 500
+    status = getattr(error, 'status', None)   # ошибка HTTP асинхронного клиента
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, TRANSIENT_UPLOAD_ERRORS)
+
+def upload_url_for(config, target):
+    return get_album_upload_url(config) if target == 'album' else get_wall_upload_url(config)
+
+def fresh_upload_url(config, target):
+    """Новый URL мимо кэша - для дубля, который должен уйти на другой сервер"""
+    if target == 'album':
+        return proxy_get_upload_server(config['ACCESS_TOKEN'], config['ALBUM_ID'], config.get('GROUP_ID'))
+    return proxy_get_wall_upload_server(config['ACCESS_TOKEN'], config.get('GROUP_ID'))
+
+class UploadRetries:
+    """Решения о повторах одной загрузки, общие для потоков (здесь) и asyncio
+    (asgi.py): сами POST, паузы и запрос нового URL делает вызывающий"""
+    def __init__(self, config, target, files):
+        self.target = target
+        self.url_key = album_url_key(config) if target == 'album' else wall_url_key(config)
+        self.names = ', '.join(filename for _, filename in files)
+        self.attempt = 0
+    
+    def after_failure(self, error, upload_url):
+        """Пауза перед следующей попыткой, None - сдаться. После протухшего URL
+        пауза 0, а URL выброшен из кэша - вызывающий берет новый"""
+        self.attempt += 1
+        if self.attempt >= UPLOAD_ATTEMPTS:
+            return None
+        if isinstance(error, UploadUrlExpired):
+            print(f"🔄 {self.names}: {error}, запрашиваем новый URL")
+            upload_url_cache.invalidate(self.url_key, upload_url)
+            return 0
+        if not is_transient_upload_error(error):
+            return None
+        delay = UPLOAD_RETRY_DELAY * (2 ** (self.attempt - 1)) * random.uniform(0.8, 1.2)
+        print(f"⏳ {self.names}: {error}, повтор загрузки через {delay:.1f}с")
+        return delay
+    
+    def hedge(self, delay):
+        """Разрешение на дубль, когда попытка идет дольше delay секунд"""
+        if not upload_tracker.take_hedge():
+            return False
+        print(f"🐢 Загрузка {self.target} дольше {delay:.1f}с, отправляем дубль")
+        return True
+
+def upload_with_retries(config, target, upload_url, files):
+    """POST фото на сервер загрузки с повторами и дублем, до сохранения.
+    target - album (files - до ALBUM_BATCH_SIZE фото) или wall (одно фото);
+    files - [(данные, имя файла)]. Протухший URL заменяется новым, после сбоя
+    сети или 5xx загрузка повторяется с паузой; результат - ответ сервера загрузки"""
+    sources = [(UploadSource(file_data), filename) for file_data, filename in files]
+    size = sum(source.size for source, _ in sources)
+    retries = UploadRetries(config, target, files)
+    upload_url = upload_url or upload_url_for(config, target)
+    while True:
+        try:
+            return hedged_upload(config, retries, upload_url, sources, size)
+        except Exception as e:
+            delay = retries.after_failure(e, upload_url)
+            if delay is None:
+                raise
+            if isinstance(e, UploadUrlExpired):
+                upload_url = upload_url_for(config, target)
+            else:
+                time.sleep(delay)
+
+def hedged_upload(config, retries, upload_url, sources, size):
+    """Одна попытка загрузки; если она дольше p95, параллельно уходит дубль
+    на свежий сервер, и берется первый удачный ответ"""
+    target = retries.target
+    delay = upload_tracker.hedge_delay(target, size)
+    if delay is None:
+        return upload_attempt(target, upload_url, sources, size)
+    
+    primary = upload_attempt_executor.submit(
+        profiling.in_request_context(upload_attempt), target, upload_url, sources, size)
+    done, _ = wait([primary], timeout=delay)
+    if done or not retries.hedge(delay):
+        return primary.result()
+    try:
+        hedge_url = fresh_upload_url(config, target)
+    except Exception as e:
+        print(f"⚠️ Дубль загрузки не отправлен: {e}")
+        return primary.result()
+    
+    hedge = upload_attempt_executor.submit(
+        profiling.in_request_context(upload_attempt), target, hedge_url, sources, size)
+    error = None
+    for future in as_completed([primary, hedge]):
+        try:
+            result = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+        metrics.vk_upload_hedges.labels(target, 'won' if future is hedge else 'lost').inc()
+        return result
+    raise error
+
+def upload_attempt(target, upload_url, sources, size):
+    """Один POST на сервер загрузки с записью исхода и времени"""
+    files = [(source.open(), filename) for source, filename in sources]
+    started = time.monotonic()
+    try:
+        if target == 'album':
+            result = proxy_upload_many_to_album(upload_url, files)
+        else:
+            result = proxy_upload_to_wall(upload_url, *files[0])
+    except Exception as e:
+        upload_tracker.record_error(target, e)
+        raise
+    upload_tracker.record(target, 'ok', time.monotonic() - started, size)
+    return result
+
+# ==================== ПРЕДОБРАБОТКА ФОТО ====================
+# Включается в config.txt: PREPROCESS=1, MAX_SIDE=2560, JPEG_QUALITY=87
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', os.cpu_count() or 2))
+DEFAULT_MAX_SIDE = 2560
+DEFAULT_JPEG_QUALITY = 87
+
+preprocess_executor = None
+preprocess_executor_lock = threading.Lock()
+
+def get_preprocess_executor():
+    """Пул процессов создается при первой предобработке"""
+    global preprocess_executor
+    with preprocess_executor_lock:
+        if preprocess_executor is None:
+            # forkserver: дочерние процессы не наследуют потоки и соединения Flask.
+            # Под gunicorn/uvicorn они импортируют только image_preprocess, но при
+            # запуске python app.py каждый еще раз импортирует app.py как __mp_main__
+            preprocess_executor = ProcessPoolExecutor(
+                max_workers=PREPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('forkserver')
+            )
+        return preprocess_executor
+
+def reset_preprocess_executor():
+    global preprocess_executor
+    with preprocess_executor_lock:
+        if preprocess_executor is not None:
+            preprocess_executor.shutdown(wait=False, cancel_futures=True)
+            preprocess_executor = None
+
+def preprocess_settings(config):
+    """Настройки предобработки из config.txt или None, если она выключена"""
+    if config.get('PREPROCESS', '').lower() not in ('1', 'yes', 'true', 'on', 'да'):
+        return None
+    if not image_preprocess.available():
+        print("⚠️ PREPROCESS включен, но Pillow не установлен - фото отправляются как есть")
+        return None
+    max_side = int(config.get('MAX_SIDE', DEFAULT_MAX_SIDE))
+    quality = max(1, min(int(config.get('JPEG_QUALITY', DEFAULT_JPEG_QUALITY)), 95))
+    return max_side, quality
+
+def maybe_preprocess(config, stream, filename):
+    """Уменьшенная копия фото (файловый объект) или исходный поток, если
+    предобработка выключена, не удалась или не уменьшила файл. Копию закрывает
+    вызывающий - через preprocessed или close_preprocessed"""
+    settings = preprocess_settings(config)
+    if not settings:
+        return stream
+    
+    src_path = getattr(stream, 'name', None)
+    src_tmp = None
+    dst_fd, dst_path = tempfile.mkstemp(suffix='.jpg')
+    os.close(dst_fd)
+    try:
+        if not isinstance(src_path, str) or not os.path.isfile(src_path):
+            # Поток из запроса: процессу пула нужен путь, копируем кусками на диск
+            fd, src_tmp = tempfile.mkstemp()
+            with os.fdopen(fd, 'wb') as out:
+                stream.seek(0)
+                shutil.copyfileobj(stream, out, UPLOAD_CHUNK_SIZE)
+            stream.seek(0)
+            src_path = src_tmp
+        
+        with profiling.phase('preprocess'):
+            before, after = get_preprocess_executor().submit(
+                image_preprocess.preprocess_image, src_path, dst_path, *settings
+            ).result()
+        if after >= before:
+            return stream
+        
+        print(f"🗜️ {filename}: {before // 1024} КБ -> {after // 1024} КБ")
+        # Файл остается открытым после удаления записи - место освободится при закрытии
+        processed = open(dst_path, 'rb')
+        return processed
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            # Упавший процесс ломает весь пул - следующий вызов создаст новый
+            reset_preprocess_executor()
+        print(f"⚠️ {filename}: предобработка не удалась ({e}), отправляем как есть")
+        return stream
+    finally:
+        os.unlink(dst_path)
+        if src_tmp:
+            os.unlink(src_tmp)
+
+def close_preprocessed(data, stream):
+    """Закрыть уменьшенную копию; исходный поток принадлежит запросу или заданию"""
+    if data is not stream:
+        data.close()
+
+@contextmanager
+def preprocessed(config, stream, filename):
+    """maybe_preprocess, закрывающий копию после загрузки"""
+    data = maybe_preprocess(config, stream, filename)
+    try:
+        yield data
+    finally:
+        close_preprocessed(data, stream)
+
+# ==================== КАТАЛОГ ЗАГРУЖЕННЫХ ФОТО ====================
+PHOTO_CATALOG_ENABLED = os.environ.get('PHOTO_CATALOG', '1') == '1'
+PHOTO_CATALOG_DB_PATH = os.environ.get('PHOTO_CATALOG_DB_PATH', os.path.join(JOBS_DIR, 'catalog.db'))
+
+class PhotoCatalog:
+    """Уже загруженные фото по SHA-256 содержимого и месту назначения (SQLite).
+    Переживает сессии, поэтому повторные файлы не грузятся и в следующих запусках"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS photo_catalog (
+                sha256 TEXT, target TEXT, photo TEXT, created REAL,
+                PRIMARY KEY (sha256, target))
+        """)
+    
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = open_db(self.path)
+            self.local.db = db
+        return db
+    
+    def get(self, sha256, target):
+        row = self.connect().execute(
+            'SELECT photo FROM photo_catalog WHERE sha256 = ? AND target = ?', (sha256, target)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def put(self, sha256, target, photo):
+        self.connect().execute(
+            'INSERT OR REPLACE INTO photo_catalog (sha256, target, photo, created) VALUES (?, ?, ?, ?)',
+            (sha256, target, json.dumps(photo, ensure_ascii=False), time.time()))
+
+class NullPhotoCatalog:
+    """Каталог выключен: ничего не находит и не запоминает"""
+    def get(self, sha256, target):
+        return None
+    
+    def put(self, sha256, target, photo):
+        pass
+
+photo_catalog = PhotoCatalog(PHOTO_CATALOG_DB_PATH) if PHOTO_CATALOG_ENABLED else NullPhotoCatalog()
+catalog_locks = KeyedLocks()
+
+def file_sha256(stream):
+    """SHA-256 файла кусками, без чтения целиком; позиция возвращается в начало"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    with profiling.phase('hash'):
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def owner_target(config):
+    """Владелец фото: группа или пользователь токена (токен хранится только как хэш)"""
+    if config.get('GROUP_ID'):
+        return f"group{abs(int(config['GROUP_ID']))}"
+    return 'user-' + hashlib.sha256(config['ACCESS_TOKEN'].encode()).hexdigest()[:16]
+
+def caption_hash(description):
+    return hashlib.sha256((description or '').strip().encode()).hexdigest()[:16]
+
+def album_target(config, description):
+    # Описание входит в ключ: иначе строка получила бы фото с чужим описанием
+    return f"album:{owner_target(config)}:{config['ALBUM_ID']}:{caption_hash(description)}"
+
+def wall_target(config):
+    return f"wall:{owner_target(config)}"
+
+def photo_attachment(photo):
+    return f"photo{photo['owner_id']}_{photo['id']}"
+
+# ==================== ИСТОРИЯ ЗАГРУЗОК ====================
+# Повторный запуск того же CSV (обновление каталога) обрабатывает только новые
+# и измененные строки. Файл узнается по имени, размеру и времени изменения из
+# манифеста клиента - содержимое для этого читать не нужно
+UPLOAD_HISTORY_ENABLED = os.environ.get('UPLOAD_HISTORY', '1') == '1'
+HISTORY_QUERY_CHUNK = 500   # имен в одном запросе (предел переменных SQLite - 999)
+
+class UploadHistory:
+    """Что уже загружено по строкам CSV (SQLite, в базе каталога): фото альбома
+    и фото, которые уже есть в комментариях к нему. Ключ - альбом, имя главного
+    файла и описание; отпечаток файла - [размер, время изменения]"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS upload_history (
+                place TEXT, filename TEXT, caption TEXT, fingerprint TEXT,
+                photo TEXT, comments TEXT, updated REAL,
+                PRIMARY KEY (place, filename, caption))
+        """)
+    
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = open_db(self.path)
+            self.local.db = db
+        return db
+    
+    def get_many(self, place, filenames):
+        """{(имя в нижнем регистре, описание): запись} для этих главных файлов"""
+        names = sorted({name.lower() for name in filenames})
+        entries = {}
+        for i in range(0, len(names), HISTORY_QUERY_CHUNK):
+            chunk = names[i:i + HISTORY_QUERY_CHUNK]
+            rows = self.connect().execute(
+                'SELECT filename, caption, fingerprint, photo, comments FROM upload_history '
+                f'WHERE place = ? AND filename IN ({", ".join("?" * len(chunk))})', (place, *chunk))
+            for filename, caption, fingerprint, photo, comments in rows:
+                entries[(filename, caption)] = {
+                    'fingerprint': json.loads(fingerprint),
+                    'photo': json.loads(photo),
+                    'comments': json.loads(comments)    # {имя в нижнем регистре: отпечаток}
+                }
+        return entries
+    
+    def put(self, place, filename, caption, fingerprint, photo, comments):
+        self.connect().execute(
+            'INSERT OR REPLACE INTO upload_history (place, filename, caption, fingerprint, photo, comments, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (place, filename.lower(), caption, json.dumps(fingerprint), json.dumps(photo, ensure_ascii=False),
+             json.dumps(comments, ensure_ascii=False), time.time()))
+
+class NullUploadHistory:
+    """История выключена: каждая строка - новая"""
+    def get_many(self, place, filenames):
+        return {}
+    
+    def put(self, place, filename, caption, fingerprint, photo, comments):
+        pass
+
+upload_history = UploadHistory(PHOTO_CATALOG_DB_PATH) if UPLOAD_HISTORY_ENABLED else NullUploadHistory()
+
+def history_place(config):
+    return f"album:{owner_target(config)}:{config['ALBUM_ID']}"
+
+def parse_manifest(text):
+    """Манифест клиента: JSON {имя файла: [размер, время изменения в секундах]}
+    -> {имя в нижнем регистре: [размер, время]}; без манифеста - None"""
+    if not text:
+        return None
+    try:
+        return {str(name).lower(): [int(size), int(mtime)] for name, (size, mtime) in json.loads(text).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError(f"Неверный манифест файлов: {e}")
+
+def upload_plan(config, csv_data, manifest):
+    """План запуска по истории: {строка: шаг} только для строк, которые нужно
+    обработать. new - строки с таким описанием в истории нет, changed - главный
+    файл изменился, comments - главное фото уже в альбоме, догружаются только
+    новые и измененные фото для комментариев (comment_photos)"""
+    entries = upload_history.get_many(history_place(config), (row.main_photo for row in csv_data))
+    plan = {}
+    for row_index, row in enumerate(csv_data):
+        fingerprints = {name: manifest.get(name.lower()) for name in (row.main_photo, *row.comment_photos)}
+        entry = entries.get((row.main_photo.lower(), caption_hash(row.description)))
+        if entry is None or entry['fingerprint'] != fingerprints[row.main_photo]:
+            status, photo, done = ('new' if entry is None else 'changed'), None, {}
+            pending = comment_names(row)
+        else:
+            status, photo, done = 'comments', entry['photo'], entry['comments']
+            pending = [name for name in comment_names(row) if done.get(name.lower()) != fingerprints[name]]
+            if not pending:
+                continue
+        plan[row_index] = {
+            'status': status,
+            'photo': photo,
+            'comment_photos': pending,
+            'comments': done,
+            'fingerprints': fingerprints
+        }
+    return plan
+
+def plan_summary(plan, total_rows):
+    summary = {'new': 0, 'changed': 0, 'comments': 0, 'unchanged': total_rows - len(plan)}
+    for step in plan.values():
+        summary[step['status']] += 1
+    return summary
+
+def planned_row(csv_data, plan, row_index):
+    """Строка в объеме этого запуска: у строки comments - только фото, которых еще нет в комментариях"""
+    row = csv_data[row_index]
+    step = plan.get(row_index) if plan else None
+    if step and step['status'] == 'comments':
+        return CsvRow(row.main_photo, row.description, step['comment_photos'])
+    return row
+
+def planned_photo(plan, row_index):
+    """Фото альбома из истории, если главный файл строки загружать не нужно"""
+    step = plan.get(row_index) if plan else None
+    return step['photo'] if step and step['status'] == 'comments' else None
+
+def remember_row(session_id, row_index, row, photo, comment_results):
+    """Записать успешную строку в историю (только если запуск идет по манифесту)"""
+    plan = get_session_field(session_id, 'plan')
+    step = plan.get(row_index) if plan else None
+    if not step or not step['fingerprints'].get(row.main_photo):
+        return
+    fingerprints = step['fingerprints']
+    comments = dict(step['comments'])
+    for comment in comment_results:
+        for commented in comment.get('photos', []):
+            name = commented.get('name')
+            if fingerprints.get(name):
+                comments[name.lower()] = fingerprints[name]
+    upload_history.put(
+        history_place(get_session_field(session_id, 'config')), row.main_photo,
+        caption_hash(row.description), fingerprints[row.main_photo], photo, comments
+    )
+
+# ==================== ПОТОК ПРОГРЕССА (SSE) ====================
+PROGRESS_QUEUE_SIZE = int(os.environ.get('PROGRESS_QUEUE_SIZE', 100))   # событий на подписчика
+PROGRESS_KEEPALIVE = float(os.environ.get('PROGRESS_KEEPALIVE', 15))    # секунд
+# Подписчик в обычном режиме занимает поток gunicorn (их --threads 8 на процесс):
+# сверх лимита /api/progress отвечает 503 и клиент опрашивает /api/job/status
+PROGRESS_MAX_SUBSCRIBERS = int(os.environ.get('PROGRESS_MAX_SUBSCRIBERS', 4))
+PROGRESS_POLL_INTERVAL = 2   # секунд - Retry-After и совет клиенту
+# События рассылаются внутри процесса. При нескольких процессах строки пишут и
+# другие воркеры, поэтому поток раз в PROGRESS_SYNC_INTERVAL секунд сверяет
+# счетчики с хранилищем сессий (SESSION_STORE=sqlite) и шлет новый snapshot
+PROGRESS_SYNC_INTERVAL = float(os.environ.get(
+    'PROGRESS_SYNC_INTERVAL', 2 if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 else 0
+))
+# Страницы /api/results: по умолчанию и не больше
+RESULTS_PAGE_SIZE = 100
+RESULTS_PAGE_MAX = 1000
+FINALIZE_MISSING_SAMPLE = 50   # незагруженных файлов в итоговом отчете
+
+# Состояние строки в progress['rows']
+ROW_OK = 1
+ROW_FAILED = 2
+
+class Subscription:
+    """Очередь событий одного подписчика. Отправитель никогда не ждет: если
+    подписчик отстал на PROGRESS_QUEUE_SIZE событий, очередь сбрасывается,
+    а подписчик получит вместо пропущенных строк свежие счетчики"""
+    def __init__(self, size):
+        self.size = size
+        self.events = deque()
+        self.lagged = False
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+    
+    def offer(self, event):
+        with self.lock:
+            if len(self.events) >= self.size:
+                self.events.clear()
+                self.lagged = True
+            else:
+                self.events.append(event)
+        self.notify()
+    
+    def notify(self):
+        self.ready.set()
+    
+    def wait(self, timeout):
+        self.ready.wait(timeout)
+        self.ready.clear()
+    
+    def drain(self):
+        """(события, отстал ли подписчик) с прошлого вызова"""
+        with self.lock:
+            events, lagged = list(self.events), self.lagged
+            self.events.clear()
+            self.lagged = False
+        return events, lagged
+
+class ProgressBroker:
+    """Рассылка событий прогресса всем подписчикам сессии внутри процесса"""
+    def __init__(self):
+        self.subscribers = {}   # session_id -> set(Subscription)
+        self.count = 0
+        self.lock = threading.Lock()
+    
+    def subscribe(self, session_id, subscription, limit=None):
+        """None - если подписчиков в процессе уже limit"""
+        with self.lock:
+            if limit is not None and self.count >= limit:
+                return None
+            self.subscribers.setdefault(session_id, set()).add(subscription)
+            self.count += 1
+        return subscription
+    
+    def unsubscribe(self, session_id, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(session_id)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self.count -= 1
+                if not subscribers:
+                    del self.subscribers[session_id]
+    
+    def publish(self, session_id, event, data):
+        with self.lock:
+            subscribers = list(self.subscribers.get(session_id, ()))
+        for subscription in subscribers:
+            subscription.offer((event, data))
+
+progress_broker = ProgressBroker()
+
+def new_progress():
+    return {
+        'rows': bytearray(),      # состояние каждой строки: 0, ROW_OK, ROW_FAILED
+        'processed_rows': 0,
+        'successful_rows': 0,
+        'records': 0,             # записей в results
+        'latest': {},             # строка -> номер ее последней записи, если записей больше одной
+        'uploaded_files': 0,      # размер множества uploaded_files
+        'found_files': 0          # сколько файлов из required_files загружено
+    }
+
+def count_row(progress, row_index, success):
+    """Учесть результат строки в счетчиках сессии; повторная запись строки
+    (продолжение задания, повтор из браузера) не считается дважды"""
+    progress = progress or new_progress()
+    rows = progress['rows']
+    if row_index >= len(rows):
+        rows.extend(bytes(row_index + 1 - len(rows)))
+    previous = rows[row_index]
+    if not previous:
+        progress['processed_rows'] += 1
+    if previous == ROW_OK:
+        progress['successful_rows'] -= 1
+    rows[row_index] = ROW_OK if success else ROW_FAILED
+    if success:
+        progress['successful_rows'] += 1
+    progress['records'] += 1
+    if previous:
+        # Прежние записи строки в results устарели
+        progress['latest'][row_index] = progress['records']
+    return progress
+
+def count_files(progress, uploaded, found):
+    progress = progress or new_progress()
+    progress['uploaded_files'] += uploaded
+    progress['found_files'] += found
+    return progress
+
+def is_latest(result, progress):
+    """Запись results - последняя для своей строки (не перекрыта повторной)"""
+    latest = progress['latest'] if progress else {}
+    return result['row_index'] not in latest or result.get('seq') == latest[result['row_index']]
+
+def row_state(progress, row_index):
+    rows = progress['rows'] if progress else b''
+    return rows[row_index] if row_index < len(rows) else 0
+
+def progress_counters(progress, total_rows):
+    processed = progress['processed_rows'] if progress else 0
+    successful = progress['successful_rows'] if progress else 0
+    return {
+        'total_rows': total_rows,
+        'processed_rows': processed,
+        'successful_rows': successful,
+        'failed_rows': processed - successful
+    }
+
+def progress_snapshot(session_id):
+    """Текущие счетчики сессии и состояние задания, None - если сессии нет"""
+    total_rows = get_session_field(session_id, 'total_rows')
+    if total_rows is None:
+        return None
+    snapshot = progress_counters(get_session_field(session_id, 'progress'), total_rows)
+    job = get_session_field(session_id, 'job')
+    snapshot['job_status'] = job['status'] if job else None
+    return snapshot
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# ==================== КОНВЕЙЕР ОБРАБОТКИ СТРОКИ ====================
+def get_row_upload_urls(config, row, album=True):
+    """URL загрузки для строки: альбом, стена и группы фото для комментариев"""
+    album_url = get_album_upload_url(config) if album else None
+    
+    # ОДИН URL для всех комментариев в строке
+    wall_upload_url = get_wall_upload_url(config)
+    prewarm_upload_hosts(album_url, wall_upload_url)
+    
+    return album_url, wall_upload_url, split_comment_groups(row)
+
+def split_comment_groups(row):
+    """Фото для комментариев строки по 2 на комментарий"""
+    return [row.comment_photos[i:i+2] for i in range(0, len(row.comment_photos), 2)]
+
+def upload_album_photo(config, upload_url, file_data, filename, description=''):
+    """Загрузка фото в альбом и сохранение с описанием"""
+    return upload_album_photos(config, upload_url, [(file_data, filename, description)])[0]
+
+def upload_album_photos(config, upload_url, items):
+    """Загрузка фото в альбом пачкой; фото, которые уже есть в каталоге с тем же
+    содержимым и описанием, не загружаются повторно.
+    items - [(данные, имя файла, описание)], результат - фото в том же порядке"""
+    streams = [as_upload_stream(file_data) for file_data, _, _ in items]
+    keys = [(file_sha256(stream), album_target(config, description))
+            for stream, (_, _, description) in zip(streams, items)]
+    
+    with ExitStack() as stack:
+        # Параллельная загрузка того же файла ждет эту и берет результат из каталога.
+        # Ключи берем по порядку, чтобы две пачки не заблокировали друг друга
+        for key in sorted(set(keys)):
+            stack.enter_context(catalog_locks.hold(key))
+        
+        found = {}
+        pending = []
+        for key, stream, (_, filename, description) in zip(keys, streams, items):
+            if key in found or any(key == k for k, _ in pending):
+                continue
+            photo = photo_catalog.get(*key)
+            if photo:
+                print(f"♻️ {filename}: уже загружено в альбом, используем {photo_attachment(photo)}")
+                found[key] = photo
+            else:
+                pending.append((key, (stream, filename, description)))
+        
+        if pending:
+            # Каталог проверяется по исходному файлу, а уменьшаются только те, что грузим
+            items = [(stack.enter_context(preprocessed(config, stream, filename)), filename, description)
+                     for _, (stream, filename, description) in pending]
+            saved = save_album_pack(config, upload_url or get_album_upload_url(config), items)
+            for (key, _), photo in zip(pending, saved):
+                photo_catalog.put(*key, photo)
+                found[key] = photo
+    
+    return [found[key] for key in keys]
+
+def save_album_pack(config, upload_url, items):
+    """Загрузка пачки фото в альбом одним запросом и одним photos.save.
+    items - [(данные, имя файла, описание)], результат - фото в том же порядке"""
+    files = [(file_data, filename) for file_data, filename, _ in items]
+    names = ', '.join(filename for _, filename in files)
+    upload_result = upload_with_retries(config, 'album', upload_url, files)
+    
+    captions, common_caption = pack_captions(items)
+    photos = proxy_save_album_photo(
+        config['ACCESS_TOKEN'], 
+        upload_result['server'], 
+        upload_result['photos_list'],
+        upload_result['hash'], 
+        config['ALBUM_ID'], 
+        config.get('GROUP_ID'), 
+        common_caption
+    )
+    if len(photos) != len(items):
+        raise Exception(f"VK сохранил {len(photos)} фото из {len(items)}: {names}")
+    
+    if not common_caption:
+        # Правки независимы и идут разом: с execute они уходят одним запросом
+        edits = [(photo, caption) for photo, caption in zip(photos, captions) if caption]
+        vk_call_parallel([
+            (proxy_edit_photo_caption, (config['ACCESS_TOKEN'], photo['owner_id'], photo['id'], caption))
+            for photo, caption in edits
+        ])
+        for photo, caption in edits:
+            photo['text'] = caption
+    return photos
+
+def pack_captions(items):
+    """Описания фото пачки и общее описание для photos.save.
+    photos.save задает одно описание на всю пачку: если описания строк
+    различаются, сохраняем без него и проставляем каждому фото отдельно"""
+    captions = [(description or '').strip() for _, _, description in items]
+    common_caption = captions[0] if len(set(captions)) == 1 else ''
+    return captions, common_caption
+
+def upload_wall_photo(config, upload_url, file_data, filename):
+    """Загрузка фото на стену и сохранение; повторный файл берется из каталога"""
+    file_data = as_upload_stream(file_data)
+    key = (file_sha256(file_data), wall_target(config))
+    with catalog_locks.hold(key):
+        photo = photo_catalog.get(*key)
+        if photo:
+            print(f"♻️ {filename}: уже загружено на стену, используем {photo_attachment(photo)}")
+            return photo
+        
+        with preprocessed(config, file_data, filename) as data:
+            photo = save_wall_photo(config, upload_url, data, filename)
+        photo_catalog.put(*key, photo)
+        return photo
+
+def upload_wall_photos(config, upload_url, items):
+    """Загрузка нескольких фото на стену параллельно в пуле wall_executor.
+    items - [(данные, имя файла)], результат - [(фото, ошибка)] в том же порядке:
+    ошибка одного файла не мешает остальным"""
+    # Задачи идут в очередь сессии запроса, их фазы (загрузка, saveWallPhoto) - в его Server-Timing
+    futures = [wall_executor.submit(upload_wall_photo, config, upload_url, file_data, filename)
+               for file_data, filename in items]
+    results = []
+    for future in futures:
+        try:
+            results.append((future.result(), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+def comment_names(row):
+    """Фото для комментариев строки в порядке CSV, без повторов"""
+    return list(dict.fromkeys(row.comment_photos))
+
+def group_photos(group, uploaded):
+    """Загруженные фото группы комментария с именами файлов; uploaded - {имя: фото}"""
+    return [dict(uploaded[name], name=name) for name in group if uploaded.get(name)]
+
+def created_comments(previous):
+    """Комментарии, созданные прошлой попыткой пакетной загрузки (ответ с partial),
+    и имена фото в них"""
+    comments = (previous or {}).get('comment_results', [])
+    return comments, {photo['name'] for comment in comments for photo in comment['photos']}
+
+def wall_batch_report(names, results):
+    """Ответ пакетной загрузки на стену по каждому файлу в порядке CSV и {имя: фото}
+    загруженных. results - {имя: (фото, ошибка)} для переданных файлов"""
+    report, uploaded = [], {}
+    for name in names:
+        if name not in results:
+            report.append({'name': name, 'success': False, 'error': 'Файл не передан'})
+            continue
+        photo, error = results[name]
+        if error:
+            report.append({'name': name, 'success': False, 'error': str(error)})
+        else:
+            uploaded[name] = photo
+            report.append({'name': name, 'success': True, 'photo': photo, 'attachment': photo_attachment(photo)})
+    return report, uploaded
+
+def save_wall_photo(config, upload_url, file_data, filename):
+    """Загрузка фото на стену и сохранение"""
+    upload_result = upload_with_retries(config, 'wall', upload_url, [(file_data, filename)])
+    
+    save_result = proxy_save_wall_photo(
+        config['ACCESS_TOKEN'], 
+        upload_result['server'], 
+        upload_result['photo'],
+        upload_result['hash'], 
+        config.get('GROUP_ID')
+    )
+    return save_result[0]
+
+def mark_uploaded(session_id, *filenames):
+    """Отметить файлы как реально загруженные и обновить счетчики файлов"""
+    uploaded = append_session(session_id, 'uploaded_files', *filenames)
+    found = discard_session(session_id, 'missing_files', *filenames)
+    if uploaded or found:
+        update_session_field(session_id, 'progress', lambda p: count_files(p, uploaded, found))
+
+def record_result(session_id, row_index, row, main_photo_result, comment_results, errors):
+    """Записать результат обработки строки в сессию"""
+    # СОБИРАЕМ РЕАЛЬНО ЗАГРУЖЕННЫЕ ФАЙЛЫ
+    uploaded_in_row = set()
+    if main_photo_result:
+        uploaded_in_row.add(row.main_photo)
+    
+    for comment in comment_results:
+        for photo in comment.get('photos', []):
+            uploaded_in_row.add(photo.get('name'))
+    
+    # Обновляем глобальный список загруженных файлов
+    mark_uploaded(session_id, *uploaded_in_row)
+    
+    # ПРОВЕРЯЕМ, ВСЕ ЛИ ФАЙЛЫ ИЗ СТРОКИ ЗАГРУЖЕНЫ
+    expected_files = {row.main_photo, *row.comment_photos}
+    missing_files = expected_files - uploaded_in_row
+    
+    if missing_files:
+        print(f"⚠️ В строке {row_index} не хватает: {missing_files}")
+        # НЕ ДОБАВЛЯЕМ ОШИБКУ, ПРОСТО ЛОГИРУЕМ
+    
+    result = {
+        'row_index': row_index,
+        'main_photo': row.main_photo,
+        'description': row.description,
+        'success': len(errors) == 0 and main_photo_result is not None,
+        'main_photo_result': main_photo_result,
+        'comment_results': comment_results,
+        'errors': errors,
+        'uploaded_files': list(uploaded_in_row)
+    }
+    
+    # Номер записи нужен, чтобы отличить последнюю запись строки от устаревших
+    def count(progress):
+        progress = count_row(progress, row_index, result['success'])
+        result['seq'] = progress['records']
+        return progress
+    
+    progress = update_session_field(session_id, 'progress', count)
+    append_session(session_id, 'results', result)
+    if result['success']:
+        remember_row(session_id, row_index, row, main_photo_result, comment_results)
+    # В серверном режиме строки завершаются не по порядку
+    update_session_field(session_id, 'current_row', lambda current: max(current or 0, row_index + 1))
+    progress_broker.publish(session_id, 'row', {
+        'result': result,
+        **progress_counters(progress, get_session_field(session_id, 'total_rows'))
+    })
+    return result
+
+# ==================== АРХИВ ЗАДАНИЯ ====================
+# Серверный режим одним файлом: ZIP с config.txt, CSV и фото. Архив не
+# распаковывается - фото читаются из отображенного в память файла, когда
+# до них доходит очередь строки
+ARCHIVE_NAME = 'archive.zip'
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')   # сигнатура и длины имени и extra
+ZIP_UTF8_FLAG = 0x800
+ZIP_ENCRYPTED_FLAG = 0x1
+
+class MappedReader(io.RawIOBase):
+    """Файл только для чтения поверх memoryview. Им открывается сам архив
+    (zipfile нужен seekable-файл, у mmap его нет) и члены архива, сохраненные
+    без сжатия - их байты отдаются прямо из отображения, без распаковки"""
+    def __init__(self, view, name):
+        self.view = view
+        self.name = name
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise OSError(f"Отрицательная позиция: {offset}")
+        self.position = offset
+        return offset
+    
+    def readinto(self, buffer):
+        with self.view[self.position:self.position + len(buffer)] as chunk:
+            size = len(chunk)
+            buffer[:size] = chunk
+        self.position += size
+        return size
+    
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.position + size
+        with self.view[self.position:end] as chunk:
+            data = chunk.tobytes()
+        self.position += len(data)
+        return data
+    
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+def archive_member_name(info):
+    """Имя члена архива для сравнения с CSV. Без флага UTF-8 имя записано в
+    кодировке DOS: архиваторы Windows пишут кириллицу в cp866, а zipfile читает cp437"""
+    if info.flag_bits & ZIP_UTF8_FLAG:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('cp866')
+    except UnicodeError:
+        return info.filename
+
+class JobArchive:
+    """ZIP задания, отображенный в память: оглавление и чтение членов"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise zipfile.BadZipFile("Пустой файл")
+            # Отображение держит свою копию дескриптора, файл можно закрыть
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.zip = None
+        try:
+            self.zip = zipfile.ZipFile(MappedReader(self.view, path))
+        except Exception:
+            self.close()
+            raise
+    
+    def members(self):
+        """{имя файла в нижнем регистре: член архива} - папки внутри архива не важны,
+        как и при выборе папки в браузере. Служебные файлы macOS пропускаются"""
+        index = {}
+        for info in self.zip.infolist():
+            name = archive_member_name(info)
+            base = posixpath.basename(name)
+            if info.is_dir() or not base or name.startswith('__MACOSX/') or base.startswith('._'):
+                continue
+            if index.setdefault(base.lower(), info.filename) != info.filename:
+                print(f"⚠️ В архиве несколько файлов {base}, используется первый")
+        return index
+    
+    def manifest(self):
+        """Размеры и времена изменения файлов для сверки с историей загрузок,
+        как манифест от браузера"""
+        return {
+            posixpath.basename(archive_member_name(info)).lower():
+                [info.file_size, int(time.mktime(info.date_time + (0, 0, -1)))]
+            for info in self.zip.infolist() if not info.is_dir()
+        }
+    
+    def open(self, member):
+        """Член архива как файловый объект: несжатый - окно в отображении файла,
+        сжатый - поток zipfile с распаковкой на лету"""
+        info = self.zip.getinfo(member)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & ZIP_ENCRYPTED_FLAG:
+            return self.zip.open(info)
+        signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack_from(self.mmap, info.header_offset)
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Поврежден заголовок {member}")
+        start = info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+        if start + info.file_size > len(self.mmap):
+            raise zipfile.BadZipFile(f"Архив обрезан: {member}")
+        # Имя - не путь на диске: предобработка скопирует поток во временный файл
+        return MappedReader(self.view[start:start + info.file_size], os.path.join(self.path, member))
+    
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Член архива еще читается - отображение закроется вместе с ним
+            pass
+
+class ArchiveRegistry:
+    """Открытые архивы заданий процесса; архив открывается при первом чтении,
+    в том числе после перезапуска, когда задание продолжается"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.archives = {}
+    
+    def get(self, path):
+        with self.lock:
+            archive = self.archives.get(path)
+            if archive is None:
+                archive = self.archives[path] = JobArchive(path)
+            return archive
+    
+    def close(self, path):
+        with self.lock:
+            archive = self.archives.pop(path, None)
+        if archive:
+            archive.close()
+
+job_archives = ArchiveRegistry()
+
+# ==================== СЕРВЕРНЫЙ РЕЖИМ (ЗАДАНИЯ) ====================
+def job_dir(session_id):
+    return os.path.join(JOBS_DIR, secure_filename(session_id))
+
+def find_job_file(session_data, filename):
+    """Путь к загруженному на сервер файлу (без учета регистра, как в браузере)"""
+    job_files = session_data.get('job_files', {})
+    return job_files.get(filename) or job_files.get(filename.lower())
+
+def archive_member(session_data, filename):
+    """Член архива задания с этим файлом (без учета регистра и папок)"""
+    archive = session_data.get('job_archive')
+    return archive['members'].get(filename.lower()) if archive else None
+
+def has_job_file(session_data, filename):
+    return bool(find_job_file(session_data, filename) or archive_member(session_data, filename))
+
+def open_job_file(session_data, filename):
+    """Файл задания для чтения: загруженный отдельно или прямо из архива"""
+    path = find_job_file(session_data, filename)
+    if path:
+        return open(path, 'rb')
+    return job_archives.get(session_data['job_archive']['path']).open(archive_member(session_data, filename))
+
+def job_active(session_id):
+    job = get_session_field(session_id, 'job')
+    return bool(job) and job['status'] == 'running'
+
+def cleanup_job_files(session_id):
+    job_archives.close(os.path.join(job_dir(session_id), ARCHIVE_NAME))
+    shutil.rmtree(job_dir(session_id), ignore_errors=True)
+
+# Поля сессии, нужные обработке строк задания: читаются один раз на запуск
+JOB_SESSION_FIELDS = ('config', 'csv_data', 'plan', 'job_files', 'job_archive')
+
+def process_job_pack(session_id, row_indices, session_data):
+    """Обработка пачки соседних строк CSV на сервере: главные фото одним запросом
+    в альбом, затем комментарии каждой строки - те же шаги, что и в браузере.
+    Шаги, сохраненные в контрольных точках, не повторяются. Строки, до которых
+    пачка не дошла из-за ошибки вне строки, записываются неудачными - иначе
+    задание висело бы в running до JOB_STALE_AFTER.
+    session_data - поля JOB_SESSION_FIELDS, общие для всех пачек задания"""
+    done = set()
+    try:
+        process_job_rows(session_id, row_indices, session_data, done)
+    except Exception as e:
+        print(f"❌ Пачка строк {row_indices[0]}-{row_indices[-1]}: {e}")
+        fail_job_rows(session_id, [i for i in row_indices if i not in done], session_data['csv_data'], str(e))
+
+def fail_job_rows(session_id, row_indices, csv_data, error):
+    """Записать строки задания неудачными и учесть их в счетчике задания"""
+    if not row_indices or not job_active(session_id):
+        return
+    for row_index in row_indices:
+        try:
+            record_result(session_id, row_index, csv_data[row_index], None, [], [error])
+        except Exception as e:
+            print(f"❌ Строка {row_index}: результат не записан: {e}")
+    finish_job_if_done(session_id, completed=len(row_indices))
+
+def process_job_rows(session_id, row_indices, session_data, done):
+    """Тело process_job_pack; done - строки, уже записанные и учтенные в задании"""
+    if not job_active(session_id):
+        return
+    
+    # Пачка главных фото уходит одним photos.save - значит, от одного токена
+    config = row_config(session_data['config'], row_indices[0])
+    csv_data = session_data['csv_data']
+    plan = session_data.get('plan')
+    checkpoints = {row_index: checkpoint_store.load(session_id, row_index) for row_index in row_indices}
+    main_results = {}
+    errors = {row_index: [] for row_index in row_indices}
+    
+    pack = []
+    for row_index in row_indices:
+        row = csv_data[row_index]
+        if 'album' in checkpoints[row_index]:
+            main_results[row_index] = checkpoints[row_index]['album']
+            continue
+        if planned_photo(plan, row_index):
+            main_results[row_index] = planned_photo(plan, row_index)
+            continue
+        if has_job_file(session_data, row.main_photo):
+            pack.append(row_index)
+        else:
+            print(f"❌ Строка {row_index}: файл {row.main_photo} не найден")
+            errors[row_index].append(f"Файл {row.main_photo} не найден")
+    
+    if pack:
+        try:
+            with ExitStack() as stack:
+                items = [
+                    (stack.enter_context(open_job_file(session_data, csv_data[i].main_photo)),
+                     csv_data[i].main_photo, csv_data[i].description)
+                    for i in pack
+                ]
+                photos = upload_album_photos(config, get_album_upload_url(config), items)
+            for row_index, photo in zip(pack, photos):
+                checkpoint_store.save(session_id, row_index, 'album', photo)
+                main_results[row_index] = photo
+        except Exception as e:
+            # Пачка не прошла целиком - пробуем строки по одной, чтобы один
+            # плохой файл не валил соседей
+            print(f"⚠️ Пачка строк {row_indices[0]}-{row_indices[-1]} не загружена ({e}), загружаем по одной")
+            for row_index in pack:
+                row = csv_data[row_index]
+                # Токен пачки мог быть выведен из работы - строка выбирает свой заново
+                single_config = row_config(session_data['config'], row_index)
+                try:
+                    with open_job_file(session_data, row.main_photo) as f:
+                        photo = upload_album_photo(
+                            single_config, get_album_upload_url(single_config), f, row.main_photo, row.description
+                        )
+                    checkpoint_store.save(session_id, row_index, 'album', photo)
+                    main_results[row_index] = photo
+                except Exception as e:
+                    print(f"❌ Строка {row_index}: {e}")
+                    errors[row_index].append(str(e))
+    
+    for row_index in row_indices:
+        main_result = main_results.get(row_index)
+        comment_results = []
+        if main_result:
+            mark_uploaded(session_id, csv_data[row_index].main_photo)
+            try:
+                comment_results = process_row_comments(
+                    session_id, session_data, row_config(session_data['config'], row_index),
+                    row_index, main_result, checkpoints[row_index]
+                )
+            except Exception as e:
+                print(f"❌ Строка {row_index}: {e}")
+                errors[row_index].append(str(e))
+        
+        if job_active(session_id):
+            row = planned_row(csv_data, plan, row_index)
+            record_result(session_id, row_index, row, main_result, comment_results, errors[row_index])
+            finish_job_if_done(session_id, completed=1)
+            done.add(row_index)
+
+def process_row_comments(session_id, session_data, config, row_index, main_result, checkpoints):
+    """Фото для комментариев строки: все сразу параллельно на стену, затем комментарии по 2 фото"""
+    row = planned_row(session_data['csv_data'], session_data.get('plan'), row_index)
+    _, wall_upload_url, comment_groups = get_row_upload_urls(config, row, album=False)
+    
+    # Фото, которые уже в контрольных точках, и фото групп с готовым комментарием не грузим
+    pending = {name for index, group in enumerate(comment_groups)
+               if f'comment:{index}' not in checkpoints for name in group}
+    uploaded = {}
+    names = []
+    for name in comment_names(row):
+        if name not in pending:
+            continue
+        if f'wall:{name}' in checkpoints:
+            uploaded[name] = checkpoints[f'wall:{name}']
+            continue
+        if has_job_file(session_data, name):
+            names.append(name)
     
-    if start_idx < len(lines):
-        header = lines[start_idx].lower()
-        if any(x in header for x in ['файл изображения', 'файл', 'image']):
-            print(f"✅ Пропущен заголовок: {lines[start_idx][:50]}...")
-            start_idx += 1
+    with ExitStack() as stack:
+        items = [(stack.enter_context(open_job_file(session_data, name)), name) for name in names]
+        for (_, name), (photo, error) in zip(items, upload_wall_photos(config, wall_upload_url, items)):
+            if error:
+                print(f"⚠️ Строка {row_index}: {name} не загружено: {error}")
+                continue
+            checkpoint_store.save(session_id, row_index, f'wall:{name}', photo)
+            uploaded[name] = photo
+    if uploaded:
+        mark_uploaded(session_id, *uploaded)
     
-    csv_data = []
-    for i in range(start_idx, len(lines)):
-        line = lines[i].strip()
-        if not line:
+    comment_results = []
+    for group_index, group in enumerate(comment_groups):
+        comment_step = f'comment:{group_index}'
+        if comment_step in checkpoints:
+            comment_results.append(checkpoints[comment_step])
             continue
         
-        parts = line.split(delimiter)
-        if len(parts) >= 1:
-            main_photo = parts[0].strip()
-            description = parts[1].strip() if len(parts) > 1 else ''
-            comment_photos = parts[2].strip().split(';') if len(parts) > 2 and parts[2].strip() else []
-            comment_photos = [p.strip() for p in comment_photos if p.strip()]
-            
-            if main_photo:
-                csv_data.append({
-                    'main_photo': main_photo,
-                    'description': description,
-                    'comment_photos': comment_photos
-                })
-                print(f"📄 CSV строка {len(csv_data)}: {main_photo} - {description[:50]}...")
+        photos = group_photos(group, uploaded)
+        if photos:
+            attachments = [photo_attachment(p) for p in photos]
+            try:
+                proxy_create_comment(
+                    config['ACCESS_TOKEN'], 
+                    main_result['owner_id'], 
+                    main_result['id'], 
+                    attachments, 
+                    config.get('GROUP_ID')
+                )
+                comment_result = {'group': group, 'photos': photos}
+                checkpoint_store.save(session_id, row_index, comment_step, comment_result)
+                comment_results.append(comment_result)
+            except Exception as e:
+                print(f"⚠️ Строка {row_index}: комментарий не создан: {e}")
     
-    print(f"📊 Всего загружено записей: {len(csv_data)}")
-    return csv_data
+    return comment_results
 
-# ==================== ПРОКСИ-ФУНКЦИИ ДЛЯ VK ====================
-def proxy_upload_to_album(upload_url, file_data, filename):
-    """Загрузка фото в альбом"""
-    files = {'file1': (filename, file_data, 'image/jpeg')}
-    response = upload_session.post(upload_url, files=files, timeout=60)
-    response.raise_for_status()
-    return response.json()
+def finish_job_if_done(session_id, completed=0):
+    """Учесть обработанные строки и закрыть задание после последней"""
+    finished = []
+    
+    def update(job):
+        job['done'] += completed
+        job['heartbeat'] = time.time()
+        if job['status'] == 'running' and job['done'] >= job['queued']:
+            job['status'] = 'done'
+            job['finished_at'] = time.time()
+            finished.append(True)
+        return job
+    
+    update_session_field(session_id, 'job', update)
+    if finished:
+        print(f"🏁 Задание {session_id} завершено")
+        progress_broker.publish(session_id, 'job', {'job_status': 'done'})
 
-def proxy_upload_to_wall(upload_url, file_data, filename):
-    """Загрузка фото на стену"""
-    files = {'photo': (filename, file_data, 'image/jpeg')}
-    response = upload_session.post(upload_url, files=files, timeout=60)
-    response.raise_for_status()
-    return response.json()
+# ==================== МЕТРИКИ ====================
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.http_in_flight.inc()
 
-def proxy_get_upload_server(access_token, album_id, group_id=None):
-    """Получение сервера для загрузки в альбом"""
-    params = {
-        'access_token': access_token,
-        'v': VK_API_VERSION,
-        'album_id': album_id
-    }
-    if group_id:
-        params['group_id'] = abs(int(group_id))
-    
-    response = vk_session.get('https://api.vk.com/method/photos.getUploadServer', params=params, timeout=30)
-    response.raise_for_status()
-    result = response.json()
-    if 'error' in result:
-        raise Exception(f"VK Error: {result['error']['error_msg']}")
-    return result['response']['upload_url']
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.http_requests.labels(endpoint, request.method, str(response.status_code)).inc()
+    metrics.http_request_seconds.labels(endpoint).observe(time.perf_counter() - g.request_started)
+    if request.mimetype == 'multipart/form-data' and request.content_length:
+        metrics.proxy_bytes.labels('in').inc(request.content_length)
+    return response
 
-def proxy_get_wall_upload_server(access_token, group_id=None):
-    """Получение сервера для загрузки на стену"""
-    params = {
-        'access_token': access_token,
-        'v': VK_API_VERSION
-    }
-    if group_id:
-        params['group_id'] = abs(int(group_id))
-    
-    response = vk_session.get('https://api.vk.com/method/photos.getWallUploadServer', params=params, timeout=30)
-    response.raise_for_status()
-    result = response.json()
-    if 'error' in result:
-        raise Exception(f"VK Error: {result['error']['error_msg']}")
-    return result['response']['upload_url']
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'request_started' in g:
+        metrics.http_in_flight.dec()
 
-def proxy_save_album_photo(access_token, server, photos_list, hash_value, album_id, group_id=None, description=""):
-    """Сохранить фото в альбоме с описанием"""
-    params = {
-        'access_token': access_token,
-        'v': '5.131',
-        'album_id': album_id,
-        'server': server,
-        'photos_list': photos_list,
-        'hash': hash_value,
-    }
-    
-    if group_id:
-        params['group_id'] = abs(int(group_id))
-    
-    if description and description.strip():
-        params['caption'] = description.strip()
+@app.route('/metrics')
+def export_metrics():
+    body, content_type = metrics.render()
+    return body, 200, {'Content-Type': content_type}
+
+# ==================== ВРЕМЯ ЗАПРОСОВ И ПРОФИЛИРОВАНИЕ ====================
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+TIMING_LOG_MIN_MS = float(os.environ.get('TIMING_LOG_MIN_MS', 0))   # отрицательное - не писать в лог
+# Без ADMIN_TOKEN маршруты /api/admin/* выключены
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_MAX_REQUESTS = 1000
+ADMIN_ENDPOINTS = {'admin_profile_start', 'admin_profile_report', 'admin_scheduler'}
+
+@app.before_request
+def start_request_timing():
+    g.timing = profiling.start_request()
+    if request.endpoint not in ADMIN_ENDPOINTS:
+        g.profile = profiling.profile_capture.begin(request.endpoint)
+
+@app.after_request
+def report_request_timing(response):
+    timing = g.get('timing')
+    if timing is None:
+        return response
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timing.header()
+    elapsed = timing.elapsed_ms()
+    if 0 <= TIMING_LOG_MIN_MS <= elapsed:
+        print('⏱️ ' + json.dumps({
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(elapsed, 1),
+            'phases': timing.as_dict()
+        }, ensure_ascii=False))
+    return response
+
+@app.teardown_request
+def finish_request_timing(error=None):
+    if g.get('profile') is not None:
+        profiling.profile_capture.end(g.profile)
+    profiling.finish_request()
+
+def admin_denied():
+    """Ответ с отказом или None, если запрос с верным ADMIN_TOKEN (Authorization: Bearer)"""
+    if not ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': 'Не найдено'}), 404
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'success': False, 'error': 'Нет доступа'}), 403
+    return None
+
+@app.route('/api/admin/profile', methods=['POST'])
+def admin_profile_start():
+    """Профилировать следующие N запросов этого процесса: requests (по умолчанию 20),
+    mode - sample (выборка стеков) или cprofile, interval - шаг выборки в секундах,
+    endpoint - только запросы этого маршрута"""
+    denied = admin_denied()
+    if denied:
+        return denied
     
-    response = vk_session.get('https://api.vk.com/method/photos.save', params=params, timeout=30)
-    response.raise_for_status()
-    result = response.json()
+    data = request.get_json(silent=True) or request.form
+    mode = data.get('mode', 'sample')
+    try:
+        count = int(data.get('requests', 20))
+        interval = float(data.get('interval', 0.005))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'requests и interval должны быть числами'}), 400
+    if mode not in profiling.ProfileCapture.MODES:
+        return jsonify({'success': False, 'error': f"mode: {' или '.join(profiling.ProfileCapture.MODES)}"}), 400
+    if not 1 <= count <= PROFILE_MAX_REQUESTS or not 0.001 <= interval <= 1:
+        return jsonify({'success': False, 'error': f'requests от 1 до {PROFILE_MAX_REQUESTS}, interval от 0.001 до 1'}), 400
     
-    if 'error' in result:
-        raise Exception(f"VK Error: {result['error']['error_msg']}")
-    return result['response']
+    profiling.profile_capture.start(count, mode, interval, data.get('endpoint') or None)
+    print(f"🔬 Профилирование ({mode}) следующих {count} запросов")
+    return jsonify({'success': True, **profiling.profile_capture.report(limit=0)})
 
-def proxy_save_wall_photo(access_token, server, photo, hash_value, group_id=None):
-    """Сохранить фото для стены"""
-    params = {
-        'access_token': access_token,
-        'v': VK_API_VERSION,
-        'server': server,
-        'photo': photo,
-        'hash': hash_value
-    }
-    if group_id:
-        params['group_id'] = abs(int(group_id))
+@app.route('/api/admin/profile', methods=['GET'])
+def admin_profile_report():
+    """Собранный профиль, в том числе до конца захвата. limit - строк в отчете,
+    format=collapsed - стеки выборки текстом для flamegraph.pl / speedscope"""
+    denied = admin_denied()
+    if denied:
+        return denied
     
-    response = vk_session.post('https://api.vk.com/method/photos.saveWallPhoto', data=params, timeout=30)
-    response.raise_for_status()
-    result = response.json()
-    if 'error' in result:
-        raise Exception(f"VK Error: {result['error']['error_msg']}")
-    return result['response']
+    if request.args.get('format') == 'collapsed':
+        return profiling.profile_capture.collapsed(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    limit = request.args.get('limit', 40, type=int)
+    return jsonify({'success': True, **profiling.profile_capture.report(limit=limit)})
 
-def proxy_create_comment(access_token, owner_id, photo_id, attachments, group_id=None):
-    """Создание комментария от имени группы"""
-    if group_id:
-        owner_id = -abs(int(group_id))
+@app.route('/api/admin/scheduler', methods=['GET'])
+def admin_scheduler():
+    """Честные очереди: занятые места, очередь и ожидание каждой сессии"""
+    denied = admin_denied()
+    if denied:
+        return denied
     
-    params = {
-        'access_token': access_token,
-        'v': VK_API_VERSION,
-        'owner_id': owner_id,
-        'photo_id': photo_id,
-        'message': '',
-        'attachments': ','.join(attachments),
-        'from_group': 1
-    }
-    if group_id:
-        params['group_id'] = abs(int(group_id))
+    return jsonify({
+        'success': True,
+        'schedulers': {scheduler.name: scheduler.report()
+                       for scheduler in (proxy_scheduler, job_executor, wall_executor)}
+    })
+
+# ==================== ДОПУСК ЗАГРУЗОК ====================
+# Каждая загрузка держит до MAX_CONTENT_LENGTH (в памяти по куску, остальное на
+# диске) и поток, пока файл не уйдет в VK. При всплеске лишние запросы получают
+# 429 с Retry-After еще до чтения тела - по заголовку Content-Length
+ADMISSION_MAX_BYTES = int(os.environ.get('ADMISSION_MAX_BYTES', 256 * 1024 * 1024))   # тел в обработке
+ADMISSION_MAX_REQUESTS = int(os.environ.get('ADMISSION_MAX_REQUESTS', 16))            # загрузок в обработке
+ADMISSION_RATE_WINDOW = 30      # секунд: за сколько последних завершений считаем скорость разбора
+ADMISSION_RETRY_MIN = 1         # секунд в Retry-After
+ADMISSION_RETRY_MAX = 60
+ADMISSION_RETRY_DEFAULT = 5     # пока не завершилась ни одна загрузка и скорость неизвестна
+ADMISSION_ENDPOINTS = {
+    'proxy_upload_album', 'proxy_upload_album_batch', 'proxy_upload_wall', 'proxy_upload_wall_batch',
+    'job_upload_files'
+}
+
+class AdmissionControl:
+    """Бюджет загрузок в обработке: байт тел и числа запросов. Запрос принимается,
+    если после него бюджет не превышен; один запрос принимается всегда, каким бы
+    большим он ни был. Retry-After - сколько при текущей скорости разбора
+    освобождается место под отклоненный запрос"""
+    def __init__(self, max_bytes, max_requests):
+        self.max_bytes = max_bytes
+        self.max_requests = max_requests
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.requests = 0
+        self.finished = deque()   # (время завершения, байт) за ADMISSION_RATE_WINDOW
+        metrics.admission_bytes.set_function(lambda: self.bytes)
+        metrics.admission_requests.set_function(lambda: self.requests)
     
-    response = vk_session.post('https://api.vk.com/method/photos.createComment', data=params, timeout=30)
-    response.raise_for_status()
-    result = response.json()
+    def admit(self, size):
+        """None - запрос принят (потом обязателен release), иначе (причина, секунд до повтора)"""
+        with self.lock:
+            if self.requests:
+                if self.requests + 1 > self.max_requests:
+                    return 'requests', self.retry_after(0, 1)
+                if self.bytes + size > self.max_bytes:
+                    return 'bytes', self.retry_after(self.bytes + size - self.max_bytes, 0)
+            self.bytes += size
+            self.requests += 1
+            return None
     
-    if 'error' in result:
-        raise Exception(f"VK Error: {result['error']['error_msg']}")
+    def release(self, size):
+        with self.lock:
+            self.bytes -= size
+            self.requests -= 1
+            self.finished.append((time.monotonic(), size))
     
-    return {'comment_id': result['response']}
+    def retry_after(self, excess_bytes, excess_requests):
+        """Секунды до освобождения excess_bytes байт и excess_requests мест (под self.lock)"""
+        now = time.monotonic()
+        while self.finished and now - self.finished[0][0] > ADMISSION_RATE_WINDOW:
+            self.finished.popleft()
+        if not self.finished:
+            return ADMISSION_RETRY_DEFAULT
+        span = max(now - self.finished[0][0], 1.0)
+        byte_rate = sum(size for _, size in self.finished) / span
+        request_rate = len(self.finished) / span
+        seconds = max(excess_bytes / byte_rate if byte_rate else 0, excess_requests / request_rate)
+        return min(max(math.ceil(seconds), ADMISSION_RETRY_MIN), ADMISSION_RETRY_MAX)
+
+upload_admission = AdmissionControl(ADMISSION_MAX_BYTES, ADMISSION_MAX_REQUESTS)
+
+def request_body_size():
+    """Размер тела по Content-Length; без него (chunked) - наибольший допустимый"""
+    return request.content_length if request.content_length is not None else request.max_content_length
+
+@app.before_request
+def admit_upload():
+    if request.endpoint not in ADMISSION_ENDPOINTS:
+        return None
+    size = request_body_size()
+    if size is not None and request.max_content_length is not None and size > request.max_content_length:
+        return None   # слишком большое тело Flask отклонит сам (413)
+    rejected = upload_admission.admit(size or 0)
+    if rejected is None:
+        g.admitted = size or 0
+        return None
+    reason, retry_after = rejected
+    metrics.admission_rejected.labels(request.endpoint, reason).inc()
+    response = jsonify({'success': False, 'error': 'Сервер перегружен, повторите позже', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    # Тело не прочитано - соединение нельзя использовать для следующего запроса
+    response.headers['Connection'] = 'close'
+    return response
+
+@app.teardown_request
+def release_upload(error=None):
+    if 'admitted' in g:
+        upload_admission.release(g.pop('admitted'))
 
 # ==================== ОСНОВНЫЕ МАРШРУТЫ ====================
+def request_session_id():
+    """id сессии запроса: из адреса, полей формы или JSON"""
+    if request.view_args and 'session_id' in request.view_args:
+        return request.view_args['session_id']
+    if request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        return request.form.get('session_id')
+    if request.is_json:
+        data = request.get_json(silent=True)
+        return data.get('session_id') if isinstance(data, dict) else None
+    return None
+
+@app.before_request
+def schedule_request():
+    """Обращения к VK этого запроса встают в очередь его сессии с ее весом"""
+    session_id = request_session_id()
+    priority = get_session_field(session_id, 'priority', 1.0) if session_id else 1.0
+    set_flow(session_id, priority)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -272,70 +3329,133 @@ def test_vk():
             return jsonify({'success': False, 'error': 'Не найден config.txt'}), 400
         
         config = parse_config(config_content)
-        token = config.get('ACCESS_TOKEN')
-        if not token:
+        tokens = config_tokens(config)
+        if not tokens:
             return jsonify({'success': False, 'error': 'Нет ACCESS_TOKEN'}), 400
         
-        params = {'access_token': token, 'v': VK_API_VERSION}
-        response = vk_session.get('https://api.vk.com/method/users.get', params=params, timeout=10)
-        result = response.json()
+        # Проверяем каждый токен пула; достаточно одного рабочего
+        checked = []
+        for token, weight in tokens:
+            params = {'access_token': token, 'v': VK_API_VERSION}
+            try:
+                users = vk_call('users.get', params, timeout=10)
+                checked.append({'token': token_label(token), 'weight': weight, 'user': users[0] if users else None})
+            except VKError as e:
+                checked.append({'token': token_label(token), 'weight': weight, 'error': e.message})
         
-        if 'error' in result:
-            return jsonify({'success': False, 'error': result['error']['error_msg']}), 400
+        working = [item for item in checked if 'error' not in item]
+        if not working:
+            return jsonify({'success': False, 'error': checked[0]['error'], 'tokens': checked}), 400
         
-        return jsonify({'success': True, 'user': result['response'][0]})
+        return jsonify({'success': True, 'user': working[0]['user'], 'tokens': checked})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def is_config_name(filename):
+    filename = filename.lower()
+    return filename == 'config.txt' or (filename.endswith('.txt') and 'config' in filename)
+
+def is_csv_name(filename):
+    return filename.lower().endswith('.csv')
+
+def config_error(config):
+    """Почему по этому config.txt нельзя загружать, или None"""
+    if 'ACCESS_TOKEN' not in config or 'ALBUM_ID' not in config:
+        return 'Нет ACCESS_TOKEN или ALBUM_ID'
+    if len(config_tokens(config)) > 1 and not config.get('GROUP_ID'):
+        # Альбом пользователя доступен только его токену, общий альбом бывает только у группы
+        return 'Для нескольких токенов нужен GROUP_ID'
+    try:
+        config_priority(config)
+    except ValueError:
+        return 'PRIORITY должен быть числом'
+    return None
+
+def csv_required_files(csv_data, plan=None):
+    """Файлы, нужные для загрузки: все из CSV или только для строк плана"""
+    required_files = set()
+    if plan is None:
+        for row in csv_data:
+            required_files.add(row.main_photo)
+            required_files.update(row.comment_photos)
+        return required_files
+    for row_index, step in plan.items():
+        if step['status'] != 'comments':
+            required_files.add(csv_data[row_index].main_photo)
+        required_files.update(step['comment_photos'])
+    return required_files
+
+def create_upload_session(config, csv_data, session_id=None, manifest=None, **extra):
+    """Новая сессия по разобранным config.txt и CSV -> (id сессии, нужные файлы, план).
+    С манифестом файлов клиента сессия обрабатывает только строки плана по истории"""
+    plan = upload_plan(config, csv_data, manifest) if manifest is not None else None
+    required_files = csv_required_files(csv_data, plan)
+    session_id = session_id or uuid.uuid4().hex
+    session_data = {
+        'config': config,
+        'csv_data': csv_data,
+        'required_files': list(required_files),
+        'required_count': len(required_files),
+        'missing_files': set(required_files),   # убывает по мере загрузки
+        'total_rows': len(csv_data),
+        'current_row': 0,
+        'results': [],
+        'start_time': time.time(),
+        'uploaded_files': set(),  # ОТСЛЕЖИВАЕМ РЕАЛЬНО ЗАГРУЖЕННЫЕ ФАЙЛЫ
+        'plan': plan,
+        'plan_summary': plan_summary(plan, len(csv_data)) if plan is not None else None,
+        'priority': config_priority(config),
+        **extra
+    }
+    set_session(session_id, session_data)
+    return session_id, required_files, plan
+
+def plan_response(plan, total_rows):
+    """План для клиента: счетчики и номера строк к обработке, без плана - None"""
+    if plan is None:
+        return None
+    return {**plan_summary(plan, total_rows), 'rows': sorted(plan)}
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
     try:
         config_content = None
-        csv_content = None
+        csv_stream = None
         
         for file in request.files.getlist('files'):
-            filename = file.filename.lower()
-            if filename == 'config.txt' or (filename.endswith('.txt') and 'config' in filename):
+            if is_config_name(file.filename):
                 config_content = file.read()
-            elif filename.endswith('.csv'):
-                csv_content = file.read()
+            elif is_csv_name(file.filename):
+                # CSV разбирается прямо из временного файла, не читая его в память
+                csv_stream = file.stream
         
-        if not config_content or not csv_content:
+        if not config_content or csv_stream is None:
             return jsonify({'success': False, 'error': 'Не найдены config.txt или CSV файл'}), 400
         
         config = parse_config(config_content)
-        if 'ACCESS_TOKEN' not in config or 'ALBUM_ID' not in config:
-            return jsonify({'success': False, 'error': 'Нет ACCESS_TOKEN или ALBUM_ID'}), 400
+        error = config_error(config)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        try:
+            # Размеры и времена изменения фото: по ним строки сверяются с историей
+            manifest = parse_manifest(request.form.get('manifest'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        csv_data = parse_csv(csv_content)
+        csv_data = parse_csv(csv_stream)
         if not csv_data:
             return jsonify({'success': False, 'error': 'CSV пуст'}), 400
         
-        required_files = set()
-        for row in csv_data:
-            required_files.add(row['main_photo'])
-            required_files.update(row['comment_photos'])
-        
-        session_id = str(int(time.time() * 1000))
-        session_data = {
-            'config': config,
-            'csv_data': csv_data,
-            'required_files': list(required_files),
-            'total_rows': len(csv_data),
-            'current_row': 0,
-            'results': [],
-            'start_time': time.time(),
-            'uploaded_files': set()  # ОТСЛЕЖИВАЕМ РЕАЛЬНО ЗАГРУЖЕННЫЕ ФАЙЛЫ
-        }
-        set_session(session_id, session_data)
+        session_id, required_files, plan = create_upload_session(config, csv_data, manifest=manifest)
         
         return jsonify({
             'success': True,
             'session_id': session_id,
             'total_rows': len(csv_data),
             'required_files': list(required_files),
-            'required_count': len(required_files)
+            'required_count': len(required_files),
+            'plan': plan_response(plan, len(csv_data))
         })
         
     except Exception as e:
@@ -344,44 +3464,32 @@ def analyze():
 @app.route('/api/get-upload-urls/<session_id>/<int:row_index>', methods=['GET'])
 def get_upload_urls(session_id, row_index):
     try:
-        session_data = get_session(session_id)
-        if not session_data:
+        config = get_session_field(session_id, 'config')
+        if not config:
             return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
         
-        csv_data = session_data.get('csv_data', [])
+        csv_data = get_session_field(session_id, 'csv_data', [])
         if row_index >= len(csv_data):
             return jsonify({'success': False, 'error': 'Неверный индекс'}), 400
         
-        row = csv_data[row_index]
-        config = session_data.get('config', {})
-        
-        album_url = proxy_get_upload_server(
-            config['ACCESS_TOKEN'], 
-            config['ALBUM_ID'], 
-            config.get('GROUP_ID')
-        )
+        plan = get_session_field(session_id, 'plan')
+        row = planned_row(csv_data, plan, row_index)
+        photo = planned_photo(plan, row_index)
         
-        # ОДИН URL для всех комментариев в строке
-        wall_upload_url = proxy_get_wall_upload_server(
-            config['ACCESS_TOKEN'], 
-            config.get('GROUP_ID')
+        # URL загрузки выдаются от токена строки, им же потом сохраняются фото
+        album_url, wall_upload_url, comment_groups = get_row_upload_urls(
+            row_config(config, row_index), row, album=photo is None
         )
-        
-        comment_urls = []
-        for i in range(0, len(row['comment_photos']), 2):
-            group = row['comment_photos'][i:i+2]
-            comment_urls.append({
-                'group': group,
-                'upload_url': wall_upload_url
-            })
+        comment_urls = [{'group': group, 'upload_url': wall_upload_url} for group in comment_groups]
         
         return jsonify({
             'success': True,
             'row_index': row_index,
-            'description': row['description'],
+            'description': row.description,
             'main_photo': {
-                'filename': row['main_photo'],
-                'upload_url': album_url
+                'filename': row.main_photo,
+                'upload_url': album_url,
+                'photo': photo   # уже в альбоме по истории - загружать не нужно
             },
             'comment_groups': comment_urls,
             'wall_upload_url': wall_upload_url  # Отправляем отдельно для удобства
@@ -391,6 +3499,7 @@ def get_upload_urls(session_id, row_index):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/proxy/upload-album', methods=['POST'])
+@idempotent
 def proxy_upload_album():
     try:
         session_id = request.form.get('session_id')
@@ -402,35 +3511,60 @@ def proxy_upload_album():
             return jsonify({'success': False, 'error': 'Нет файла'}), 400
         
         file = request.files['file']
-        file_data = file.read()
+        file_data = file.stream
         
-        session_data = get_session(session_id)
-        if not session_data:
+        config = get_session_field(session_id, 'config')
+        if not config:
             return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
         
-        config = session_data.get('config', {})
-        
-        upload_result = proxy_upload_to_album(upload_url, file_data, filename)
-        save_result = proxy_save_album_photo(
-            config['ACCESS_TOKEN'], 
-            upload_result['server'], 
-            upload_result['photos_list'],
-            upload_result['hash'], 
-            config['ALBUM_ID'], 
-            config.get('GROUP_ID'), 
-            description
-        )
+        config, upload_url = upload_config(config, upload_url, f"file:{filename}")
+        photo = upload_album_photo(config, upload_url, file_data, filename, description)
         
         # ОТМЕЧАЕМ ФАЙЛ КАК ЗАГРУЖЕННЫЙ
-        with session_lock:
-            session_data.setdefault('uploaded_files', set()).add(filename)
+        mark_uploaded(session_id, filename)
+        
+        return jsonify({'success': True, 'photo': photo})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/proxy/upload-album-batch', methods=['POST'])
+@idempotent
+def proxy_upload_album_batch():
+    """Главные фото нескольких строк одним запросом загрузки и одним photos.save"""
+    try:
+        session_id = request.form.get('session_id')
+        upload_url = request.form.get('upload_url')
+        files = request.files.getlist('files')
+        filenames = request.form.getlist('filenames')
+        descriptions = request.form.getlist('descriptions')
+        
+        if not files:
+            return jsonify({'success': False, 'error': 'Нет файлов'}), 400
+        if len(files) > ALBUM_BATCH_SIZE:
+            return jsonify({'success': False, 'error': f'Не больше {ALBUM_BATCH_SIZE} файлов за раз'}), 400
+        if len(filenames) != len(files):
+            return jsonify({'success': False, 'error': 'Число имен не совпадает с числом файлов'}), 400
+        descriptions += [''] * (len(files) - len(descriptions))
+        
+        config = get_session_field(session_id, 'config')
+        if not config:
+            return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+        
+        config, upload_url = upload_config(config, upload_url, f"file:{filenames[0]}")
+        items = [(file.stream, filename, description) for file, filename, description in zip(files, filenames, descriptions)]
+        photos = upload_album_photos(config, upload_url or get_album_upload_url(config), items)
         
-        return jsonify({'success': True, 'photo': save_result[0]})
+        # ОТМЕЧАЕМ ФАЙЛЫ КАК ЗАГРУЖЕННЫЕ
+        mark_uploaded(session_id, *filenames)
+        
+        return jsonify({'success': True, 'photos': photos})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/proxy/upload-wall', methods=['POST'])
+@idempotent
 def proxy_upload_wall():
     try:
         session_id = request.form.get('session_id')
@@ -441,33 +3575,103 @@ def proxy_upload_wall():
             return jsonify({'success': False, 'error': 'Нет файла'}), 400
         
         file = request.files['file']
-        file_data = file.read()
+        file_data = file.stream
         
-        session_data = get_session(session_id)
-        if not session_data:
+        config = get_session_field(session_id, 'config')
+        if not config:
             return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
         
-        config = session_data.get('config', {})
-        
-        upload_result = proxy_upload_to_wall(upload_url, file_data, filename)
-        save_result = proxy_save_wall_photo(
-            config['ACCESS_TOKEN'], 
-            upload_result['server'], 
-            upload_result['photo'],
-            upload_result['hash'], 
-            config.get('GROUP_ID')
-        )
+        config, upload_url = upload_config(config, upload_url, f"file:{filename}")
+        photo = upload_wall_photo(config, upload_url, file_data, filename)
         
         # ОТМЕЧАЕМ ФАЙЛ КАК ЗАГРУЖЕННЫЙ
-        with session_lock:
-            session_data.setdefault('uploaded_files', set()).add(filename)
+        mark_uploaded(session_id, filename)
+        
+        return jsonify({'success': True, 'photo': photo})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/proxy/upload-wall-batch', methods=['POST'])
+@idempotent
+def proxy_upload_wall_batch():
+    """Все фото для комментариев строки одним запросом: загрузка на стену параллельно,
+    ответ по каждому файлу в порядке CSV. Если переданы owner_id и photo_id главного
+    фото, сразу создаются и комментарии по 2 фото"""
+    try:
+        session_id = request.form.get('session_id')
+        row_index = request.form.get('row_index', type=int)
+        upload_url = request.form.get('upload_url')
+        owner_id = request.form.get('owner_id')
+        photo_id = request.form.get('photo_id')
+        files = request.files.getlist('files')
+        filenames = request.form.getlist('filenames')
+        
+        if len(filenames) != len(files):
+            return jsonify({'success': False, 'error': 'Число имен не совпадает с числом файлов'}), 400
+        
+        config = get_session_field(session_id, 'config')
+        if not config:
+            return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+        
+        csv_data = get_session_field(session_id, 'csv_data', [])
+        if row_index is None or not 0 <= row_index < len(csv_data):
+            return jsonify({'success': False, 'error': 'Неверный индекс'}), 400
+        
+        row = planned_row(csv_data, get_session_field(session_id, 'plan'), row_index)
+        names = comment_names(row)
+        unknown = set(filenames) - set(names)
+        if unknown:
+            return jsonify({'success': False, 'error': f"Файлы не из строки {row_index}: {', '.join(sorted(unknown))}"}), 400
         
-        return jsonify({'success': True, 'photo': save_result[0]})
+        config, upload_url = upload_config(config, upload_url, f"row:{row_index}")
+        _, wall_upload_url, comment_groups = get_row_upload_urls(config, row, album=False)
+        received = dict(zip(filenames, files))
+        items = [(received[name].stream, name) for name in names if name in received]
+        results = dict(zip(
+            (name for _, name in items),
+            upload_wall_photos(config, upload_url or wall_upload_url, items)
+        ))
+        
+        photos, uploaded = wall_batch_report(names, results)
+        if uploaded:
+            mark_uploaded(session_id, *uploaded)
+        
+        comment_results, comment_errors = [], []
+        if owner_id and photo_id:
+            previous, commented = created_comments(g.get('idempotent_previous'))
+            comment_results.extend(previous)
+            for group in comment_groups:
+                # Фото, уже прикрепленные прошлой попыткой, второй раз не прикрепляются
+                group_result = [photo for photo in group_photos(group, uploaded) if photo['name'] not in commented]
+                if not group_result:
+                    continue
+                try:
+                    result = proxy_create_comment(
+                        config['ACCESS_TOKEN'], 
+                        owner_id, 
+                        photo_id, 
+                        [photo_attachment(p) for p in group_result], 
+                        config.get('GROUP_ID')
+                    )
+                    comment_results.append({'group': group, 'photos': group_result, 'comment_id': result.get('comment_id')})
+                except Exception as e:
+                    comment_errors.append({'group': group, 'error': str(e)})
+        
+        return jsonify({
+            'success': True,
+            'photos': photos,
+            'comment_results': comment_results,
+            'comment_errors': comment_errors,
+            # Не все переданные файлы загрузились - повтор с тем же ключом их догрузит
+            'partial': len(uploaded) < len(items)
+        })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/proxy/create-comment', methods=['POST'])
+@idempotent
 def proxy_create_comment_endpoint():
     try:
         data = request.json
@@ -476,11 +3680,11 @@ def proxy_create_comment_endpoint():
         photo_id = data.get('photo_id')
         attachments = data.get('attachments', [])
         
-        session_data = get_session(session_id)
-        if not session_data:
+        config = get_session_field(session_id, 'config')
+        if not config:
             return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
-        
-        config = session_data.get('config', {})
+        # Комментарий от имени группы (from_group) может оставить любой токен-администратор
+        config = token_config(config, f"photo:{owner_id}_{photo_id}")
         group_id = config.get('GROUP_ID')
         
         result = proxy_create_comment(
@@ -497,6 +3701,7 @@ def proxy_create_comment_endpoint():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/save-result', methods=['POST'])
+@idempotent
 def save_result():
     try:
         data = request.json
@@ -506,47 +3711,12 @@ def save_result():
         comment_results = data.get('comment_results', [])
         errors = data.get('errors', [])
         
-        session_data = get_session(session_id)
-        if not session_data:
+        csv_data = get_session_field(session_id, 'csv_data')
+        if not csv_data:
             return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
         
-        row = session_data['csv_data'][row_index]
-        
-        # СОБИРАЕМ РЕАЛЬНО ЗАГРУЖЕННЫЕ ФАЙЛЫ
-        uploaded_in_row = set()
-        if main_photo_result:
-            uploaded_in_row.add(row['main_photo'])
-        
-        for comment in comment_results:
-            for photo in comment.get('photos', []):
-                uploaded_in_row.add(photo.get('name'))
-        
-        # Обновляем глобальный список загруженных файлов
-        with session_lock:
-            session_data.setdefault('uploaded_files', set()).update(uploaded_in_row)
-        
-        # ПРОВЕРЯЕМ, ВСЕ ЛИ ФАЙЛЫ ИЗ СТРОКИ ЗАГРУЖЕНЫ
-        expected_files = set([row['main_photo']] + row['comment_photos'])
-        missing_files = expected_files - uploaded_in_row
-        
-        if missing_files:
-            print(f"⚠️ В строке {row_index} не хватает: {missing_files}")
-            # НЕ ДОБАВЛЯЕМ ОШИБКУ, ПРОСТО ЛОГИРУЕМ
-        
-        result = {
-            'row_index': row_index,
-            'main_photo': row['main_photo'],
-            'description': row['description'],
-            'success': len(errors) == 0 and main_photo_result is not None,
-            'main_photo_result': main_photo_result,
-            'comment_results': comment_results,
-            'errors': errors,
-            'uploaded_files': list(uploaded_in_row)
-        }
-        
-        session_data.setdefault('results', []).append(result)
-        session_data['current_row'] = row_index + 1
-        set_session(session_id, session_data)
+        row = planned_row(csv_data, get_session_field(session_id, 'plan'), row_index)
+        record_result(session_id, row_index, row, main_photo_result, comment_results, errors)
         
         return jsonify({'success': True})
         
@@ -555,64 +3725,404 @@ def save_result():
 
 @app.route('/api/finalize/<session_id>', methods=['GET'])
 def finalize(session_id):
+    """Итоговый отчет из счетчиков, которые ведутся по ходу загрузки"""
     try:
-        session_data = get_session(session_id)
-        if not session_data:
+        total_rows = get_session_field(session_id, 'total_rows')
+        if total_rows is None:
             return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
         
-        results = session_data.get('results', [])
-        csv_data = session_data.get('csv_data', [])
-        required_files = set(session_data.get('required_files', []))
-        
-        # ИСПОЛЬЗУЕМ РЕАЛЬНО ЗАГРУЖЕННЫЕ ФАЙЛЫ ИЗ СЕССИИ
-        uploaded_files = session_data.get('uploaded_files', set())
-        
-        successful = sum(1 for r in results if r.get('success'))
-        
-        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ПО РЕЗУЛЬТАТАМ
-        for r in results:
-            if r.get('main_photo_result'):
-                uploaded_files.add(r['main_photo'])
-            for c in r.get('comment_results', []):
-                for p in c.get('photos', []):
-                    uploaded_files.add(p.get('name'))
-        
-        missing_files = required_files - uploaded_files
+        progress = get_session_field(session_id, 'progress')
+        counters = progress_counters(progress, total_rows)
+        required_count = get_session_field(session_id, 'required_count', 0)
+        uploaded_count = progress['uploaded_files'] if progress else 0
+        missing_count = required_count - (progress['found_files'] if progress else 0)
+        # Только начало списка, не читая множество целиком; весь список по алфавиту -
+        # страницами в /api/results/<session_id>/missing
+        missing_files = session_store.head(session_id, 'missing_files', FINALIZE_MISSING_SAMPLE) if missing_count else []
         
         # ЛОГИРУЕМ ПОДРОБНОСТИ
         print(f"\n📊 ИТОГОВЫЙ ОТЧЕТ:")
-        print(f"  Всего требуется: {len(required_files)}")
-        print(f"  Загружено: {len(uploaded_files)}")
-        print(f"  Не хватает: {len(missing_files)}")
+        print(f"  Всего требуется: {required_count}")
+        print(f"  Загружено: {uploaded_count}")
+        print(f"  Не хватает: {missing_count}")
         if missing_files:
-            print(f"  Список: {sorted(missing_files)}")
+            print(f"  Список: {missing_files}")
         
-        elapsed = time.time() - session_data.get('start_time', time.time())
+        elapsed = time.time() - get_session_field(session_id, 'start_time', time.time())
+        processed = counters['processed_rows']
+        plan = get_session_field(session_id, 'plan_summary')
         
         return jsonify({'success': True, 'report': {
             'session_id': session_id,
             'statistics': {
-                'total_rows': len(csv_data),
-                'processed_rows': len(results),
-                'successful_rows': successful,
-                'failed_rows': len(results) - successful,
+                'total_rows': total_rows,
+                'processed_rows': processed,
+                'successful_rows': counters['successful_rows'],
+                'failed_rows': counters['failed_rows'],
+                'unchanged_rows': plan['unchanged'] if plan else 0,
                 'total_time': f"{elapsed:.1f}с",
-                'avg_time_per_row': f"{elapsed/len(results):.1f}с" if results else "0с"
+                'avg_time_per_row': f"{elapsed/processed:.1f}с" if processed else "0с"
             },
             'files': {
-                'required_count': len(required_files),
-                'uploaded_count': len(uploaded_files),
-                'missing_count': len(missing_files),
-                'missing_files': sorted(list(missing_files))[:50]
+                'required_count': required_count,
+                'uploaded_count': uploaded_count,
+                'missing_count': missing_count,
+                'missing_files': missing_files,
+                'missing_url': f'/api/results/{session_id}/missing'
             }
         }})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/results/<session_id>', methods=['GET'])
+def results_page(session_id):
+    """Результаты строк страницами по журналу results: offset и limit считаются
+    в записях журнала, устаревшие записи повторно обработанных строк пропускаются"""
+    total_rows = get_session_field(session_id, 'total_rows')
+    if total_rows is None:
+        return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+    
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', RESULTS_PAGE_SIZE, type=int), 1), RESULTS_PAGE_MAX)
+    progress = get_session_field(session_id, 'progress')
+    entries = session_store.page(session_id, 'results', offset, limit)
+    
+    return jsonify({
+        'success': True,
+        'offset': offset,
+        'next_offset': offset + len(entries) if len(entries) == limit else None,
+        'results': [r for r in entries if is_latest(r, progress)],
+        **progress_counters(progress, total_rows)
+    })
+
+@app.route('/api/results/<session_id>/missing', methods=['GET'])
+def missing_files_page(session_id):
+    """Файлы из CSV, которые так и не были загружены, по алфавиту"""
+    if get_session_field(session_id, 'total_rows') is None:
+        return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+    
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', RESULTS_PAGE_SIZE, type=int), 1), RESULTS_PAGE_MAX)
+    missing = sorted(session_store.collection(session_id, 'missing_files'))
+    return jsonify({
+        'success': True,
+        'missing_count': len(missing),
+        'offset': offset,
+        'next_offset': offset + limit if offset + limit < len(missing) else None,
+        'missing_files': missing[offset:offset + limit]
+    })
+
+@app.route('/api/results/<session_id>/export', methods=['GET'])
+def export_results(session_id):
+    """Журнал обработки целиком: format=jsonl (по результату строки на строку)
+    или csv (строка CSV и ID фото в VK). Отдается потоком, по странице за раз"""
+    export_format = request.args.get('format', 'jsonl')
+    if export_format not in ('jsonl', 'csv'):
+        return jsonify({'success': False, 'error': 'format: jsonl или csv'}), 400
+    if get_session_field(session_id, 'total_rows') is None:
+        return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+    progress = get_session_field(session_id, 'progress')
+    
+    def latest():
+        offset = 0
+        while True:
+            entries = session_store.page(session_id, 'results', offset, RESULTS_PAGE_MAX)
+            for result in entries:
+                if is_latest(result, progress):
+                    yield result
+            if len(entries) < RESULTS_PAGE_MAX:
+                return
+            offset += len(entries)
+    
+    def jsonl():
+        for result in latest():
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+    
+    def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM - чтобы Excel открыл файл в UTF-8
+        writer.writerow(['\ufeffrow', 'main_photo', 'description', 'success', 'photo', 'comment_photos', 'errors'])
+        for result in latest():
+            main = result.get('main_photo_result')
+            comment_photos = [photo_attachment(p) for c in result.get('comment_results', []) for p in c.get('photos', [])]
+            writer.writerow([
+                result['row_index'] + 1,
+                result['main_photo'],
+                result['description'],
+                int(bool(result['success'])),
+                photo_attachment(main) if main else '',
+                ' '.join(comment_photos),
+                '; '.join(result.get('errors', []))
+            ])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    body, mimetype = (jsonl(), 'application/x-ndjson') if export_format == 'jsonl' else (csv_lines(), 'text/csv')
+    filename = f"results_{session_id[:8]}.{export_format}"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/api/job/files/<session_id>', methods=['POST'])
+def job_upload_files(session_id):
+    """Прием фотографий для серверного режима (можно несколькими запросами)"""
+    try:
+        required_files = get_session_field(session_id, 'required_files')
+        if required_files is None:
+            return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+        
+        # Принимаем только файлы из CSV, имена сравниваем без учета регистра
+        required = {name.lower(): name for name in required_files}
+        target_dir = job_dir(session_id)
+        os.makedirs(target_dir, exist_ok=True)
+        
+        received = 0
+        saved = {}
+        for file in request.files.getlist('files'):
+            name = os.path.basename(file.filename or '')
+            canonical = required.get(name.lower())
+            if not canonical:
+                continue
+            
+            path = os.path.join(target_dir, f"{uuid.uuid4().hex}{os.path.splitext(name)[1]}")
+            file.save(path)
+            saved[canonical] = path
+            saved[canonical.lower()] = path
+            received += 1
+        
+        job_files = update_session_field(session_id, 'job_files', lambda job_files: {**(job_files or {}), **saved})
+        missing = [name for name in required_files if name not in job_files]
+        
+        return jsonify({
+            'success': True,
+            'received': received,
+            'missing_count': len(missing),
+            'missing_files': sorted(missing)[:50]
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/job/archive', methods=['POST'])
+def job_upload_archive():
+    """Серверный режим одним файлом: ZIP с config.txt, CSV и всеми фото (поле
+    archive формы или тело запроса целиком). Архив сохраняется как есть, без
+    распаковки; сессия создается, только если в нем есть все файлы из CSV"""
+    session_id = uuid.uuid4().hex
+    target_dir = job_dir(session_id)
+    path = os.path.join(target_dir, ARCHIVE_NAME)
+    
+    def reject(error, status=400, **extra):
+        cleanup_job_files(session_id)
+        return jsonify({'success': False, 'error': error, **extra}), status
+    
+    try:
+        os.makedirs(target_dir, exist_ok=True)
+        upload = request.files.get('archive')
+        if upload:
+            upload.save(path, UPLOAD_CHUNK_SIZE)
+        else:
+            with open(path, 'wb') as out:
+                shutil.copyfileobj(request.stream, out, UPLOAD_CHUNK_SIZE)
+        
+        archive = job_archives.get(path)
+        members = archive.members()
+        config_names = [name for name in members.values() if is_config_name(posixpath.basename(name))]
+        csv_names = [name for name in members.values() if is_csv_name(posixpath.basename(name))]
+        if not config_names or not csv_names:
+            return reject('В архиве нет config.txt или CSV файла')
+        if len(csv_names) > 1:
+            return reject(f"В архиве несколько CSV: {', '.join(csv_names[:5])}")
+        
+        config = parse_config(archive.zip.read(config_names[0]))
+        error = config_error(config)
+        if error:
+            return reject(error)
+        with archive.open(csv_names[0]) as csv_stream:
+            csv_data = parse_csv(csv_stream)
+        if not csv_data:
+            return reject('CSV пуст')
+        
+        # Все проверяется до старта: задание не должно споткнуться на середине
+        missing = sorted(name for name in csv_required_files(csv_data) if name.lower() not in members)
+        if missing:
+            return reject(f"В архиве нет {len(missing)} файлов из CSV",
+                          missing_count=len(missing), missing_files=missing[:50])
+        
+        session_id, required_files, plan = create_upload_session(
+            config, csv_data, session_id, manifest=archive.manifest(),
+            job_archive={'path': path, 'members': members}
+        )
+        print(f"📦 Архив задания {session_id}: {len(members)} файлов, {len(csv_data)} строк")
+        
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'total_rows': len(csv_data),
+            'required_files': list(required_files),
+            'required_count': len(required_files),
+            'missing_count': 0,
+            'missing_files': [],
+            'plan': plan_response(plan, len(csv_data))
+        })
+        
+    except HTTPException:
+        cleanup_job_files(session_id)
+        raise
+    except zipfile.BadZipFile as e:
+        return reject(f"Не ZIP-архив: {e}")
+    except Exception as e:
+        return reject(str(e), 500)
+
+@app.route('/api/job/start/<session_id>', methods=['POST'])
+def job_start(session_id):
+    """Запуск обработки всего CSV на сервере пулом обработчиков"""
+    return launch_job(session_id, resume=False)
+
+@app.route('/api/job/resume/<session_id>', methods=['POST'])
+def job_resume(session_id):
+    """Продолжение после сбоя: неуспешные строки проходят заново, начиная
+    с первого несохраненного шага, успешные не трогаются"""
+    return launch_job(session_id, resume=True)
+
+def launch_job(session_id, resume):
+    try:
+        total_rows = get_session_field(session_id, 'total_rows')
+        if total_rows is None:
+            return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+        
+        progress = get_session_field(session_id, 'progress')
+        plan = get_session_field(session_id, 'plan')
+        if resume:
+            rows = [i for i in range(total_rows) if row_state(progress, i) != ROW_OK]
+        else:
+            rows = [i for i in range(total_rows) if not row_state(progress, i)]
+        if plan is not None:
+            # Строки без изменений по истории не обрабатываются
+            rows = [i for i in rows if i in plan]
+        started = []
+        
+        def start(job):
+            # Задание, которое давно не подавало признаков жизни, считаем
+            # упавшим вместе с процессом - его можно продолжить
+            alive = job and time.time() - job.get('heartbeat', job['started_at']) < JOB_STALE_AFTER
+            if job and job['status'] == 'running' and (alive or not resume):
+                return job
+            started.append(True)
+            now = time.time()
+            return {
+                'status': 'running',
+                'queued': len(rows),
+                'done': 0,
+                'started_at': now,
+                'heartbeat': now,
+                'finished_at': None
+            }
+        
+        update_session_field(session_id, 'job', start)
+        if not started:
+            return jsonify({'success': False, 'error': 'Задание уже выполняется'}), 409
+        
+        # Соседние строки идут пачками: главные фото пачки - один запрос загрузки.
+        # Поля сессии читаются здесь один раз и общие для всех пачек
+        session_data = get_session_fields(session_id, *JOB_SESSION_FIELDS)
+        for i in range(0, len(rows), ALBUM_BATCH_SIZE):
+            job_executor.submit(process_job_pack, session_id, rows[i:i + ALBUM_BATCH_SIZE], session_data)
+        finish_job_if_done(session_id)
+        
+        action = 'продолжено' if resume else 'запущено'
+        print(f"🚀 Задание {session_id} {action}: {len(rows)} строк, обработчиков: {JOB_WORKERS}")
+        return jsonify({'success': True, 'queued_rows': len(rows), 'workers': JOB_WORKERS})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/job/status/<session_id>', methods=['GET'])
+def job_status(session_id):
+    total_rows = get_session_field(session_id, 'total_rows')
+    if total_rows is None:
+        return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+    
+    job = get_session_field(session_id, 'job')
+    if not job:
+        return jsonify({'success': False, 'error': 'Задание не запущено'}), 404
+    
+    tokens = config_tokens(get_session_field(session_id, 'config') or {})
+    return jsonify({
+        'success': True,
+        'status': job['status'],
+        'tokens': token_health.report(tokens) if len(tokens) > 1 else [],
+        'scheduler': {scheduler.name: scheduler.session_stats(session_id)
+                      for scheduler in (job_executor, proxy_scheduler)},
+        **progress_counters(get_session_field(session_id, 'progress'), total_rows)
+    })
+
+@app.route('/api/progress/<session_id>', methods=['GET'])
+def progress_stream(session_id):
+    """Прогресс сессии потоком Server-Sent Events: сначала snapshot со счетчиками,
+    затем row на каждую записанную строку и job при завершении задания"""
+    snapshot = progress_snapshot(session_id)
+    if snapshot is None:
+        return jsonify({'success': False, 'error': 'Сессия не найдена'}), 404
+    
+    subscription = progress_broker.subscribe(
+        session_id, Subscription(PROGRESS_QUEUE_SIZE), PROGRESS_MAX_SUBSCRIBERS
+    )
+    if subscription is None:
+        # EventSource на ответ не 200 не переподключается - клиент переходит на опрос
+        response = jsonify({
+            'success': False,
+            'error': 'Слишком много подписчиков, опрашивайте статус задания',
+            'poll': f'/api/job/status/{session_id}',
+            'interval': PROGRESS_POLL_INTERVAL
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(PROGRESS_POLL_INTERVAL)
+        return response
+    
+    def stream():
+        last = snapshot
+        try:
+            yield sse_event('snapshot', snapshot)
+            while True:
+                subscription.wait(PROGRESS_SYNC_INTERVAL or PROGRESS_KEEPALIVE)
+                events, lagged = subscription.drain()
+                if lagged:
+                    # Пропущенные строки не досылаем - только актуальные счетчики
+                    current = progress_snapshot(session_id)
+                    events = [('snapshot', current)] if current else [('closed', {})]
+                elif not events and PROGRESS_SYNC_INTERVAL:
+                    # Строки, записанные другими процессами, видны только в хранилище
+                    current = progress_snapshot(session_id)
+                    if current != last:
+                        events = [('snapshot', current)] if current else [('closed', {})]
+                for event, data in events:
+                    yield sse_event(event, data)
+                    if event == 'snapshot':
+                        last = data
+                    if event == 'closed':
+                        return
+                if not events:
+                    if get_session_field(session_id, 'total_rows') is None:
+                        yield sse_event('closed', {})
+                        return
+                    # Комментарий держит соединение и обнаруживает ушедших клиентов
+                    yield ': keepalive\n\n'
+        finally:
+            progress_broker.unsubscribe(session_id, subscription)
+    
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/cancel/<session_id>', methods=['POST'])
 def cancel(session_id):
+    # Обработчики задания останавливаются, когда не находят сессию
     delete_session(session_id)
+    cleanup_job_files(session_id)
+    checkpoint_store.delete_session(session_id)
+    progress_broker.publish(session_id, 'closed', {})
     return jsonify({'success': True})
 
 # ==================== ЗАПУСК ====================
@@ -0,0 +1,767 @@
+"""Асинхронный режим сервера (ASGI).
+
+Загрузки фото и вызовы VK обслуживаются в asyncio: пока файл идет на сервер
+загрузки VK, поток не занят, и один процесс держит сотни загрузок одновременно.
+Маршруты и формат ответов те же, что у app.py; все остальные маршруты
+передаются Flask-приложению через пул потоков.
+
+Запуск: uvicorn asgi:application (или SERVER_MODE=async ./start.sh)
+"""
+import os
+import json
+import time
+import random
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import wraps
+
+import aiohttp
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as core
+import metrics
+
+# Одновременных соединений с API VK и с серверами загрузки на процесс
+ASYNC_VK_CONNECTIONS = int(os.environ.get('ASYNC_VK_CONNECTIONS', 50))
+ASYNC_UPLOAD_CONNECTIONS = int(os.environ.get('ASYNC_UPLOAD_CONNECTIONS', 500))
+# Сколько секунд держать свободное соединение: серверы загрузки остаются горячими между строками
+ASYNC_KEEPALIVE = float(os.environ.get('ASYNC_KEEPALIVE', 60))
+# Потоки для маршрутов, которые остались во Flask
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 8))
+# Как у create_session_with_retries: повтор при обрыве соединения и 5xx
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.2
+HTTP_RETRY_STATUSES = (500, 502, 503, 504)
+
+vk_session = None
+upload_session = None
+
+# Сбои aiohttp, после которых загрузку стоит повторить (app.is_transient_upload_error)
+core.TRANSIENT_UPLOAD_ERRORS += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+# ==================== HTTP-КЛИЕНТ ====================
+async def fetch(session, http_method, url, timeout, make_body=None, **kwargs):
+    """HTTP-запрос с повторами, возвращает (статус, тело).
+    make_body создает тело заново для каждой попытки"""
+    for attempt in range(HTTP_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(HTTP_RETRY_BACKOFF * (2 ** (attempt - 1)))
+        if make_body:
+            kwargs['data'] = make_body()
+        try:
+            async with session.request(http_method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+                if response.status in HTTP_RETRY_STATUSES and attempt < HTTP_RETRIES:
+                    continue
+                return response.status, await response.read()
+        except aiohttp.ClientConnectionError:
+            if attempt == HTTP_RETRIES:
+                raise
+
+class HTTPStatusError(Exception):
+    """Ответ с кодом 4xx/5xx; status различает app.is_transient_upload_error"""
+    def __init__(self, status, url):
+        super().__init__(f"HTTP {status} для {url.split('?')[0]}")
+        self.status = status
+
+def raise_for_status(status, url):
+    if status >= 400:
+        raise HTTPStatusError(status, url)
+
+# ==================== ВЫЗОВЫ VK ====================
+async def vk_request(method, params, http_method='GET', timeout=30):
+    """Один вызов метода VK через тот же ограничитель частоты, что и в app.py.
+    Пакеты execute здесь не собираются: их отправляет поток по таймеру"""
+    delay = core.vk_rate_limiter.bucket(params.get('access_token')).reserve()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    
+    url = f"{core.VK_API_URL}/{method}"
+    params = {key: str(value) for key, value in params.items()}
+    with metrics.vk_request_seconds.labels(method).time():
+        if http_method == 'POST':
+            status, body = await fetch(vk_session, 'POST', url, timeout, data=params)
+        else:
+            status, body = await fetch(vk_session, 'GET', url, timeout, params=params)
+    raise_for_status(status, url)
+    
+    result = json.loads(body)
+    if 'error' in result:
+        raise core.VKError(result['error'].get('error_code'), result['error'].get('error_msg'))
+    return result
+
+async def vk_call(method, params, http_method='GET', timeout=30):
+    """Вызов метода VK с повтором и паузой при ошибках 6 и 9,
+    в честной очереди сессии (proxy_scheduler из app.py)"""
+    async with core.proxy_scheduler.aslot():
+        with metrics.vk_call_seconds.labels(method).time():
+            return await vk_call_with_retries(method, params, http_method, timeout)
+
+async def vk_call_with_retries(method, params, http_method, timeout):
+    for attempt in range(core.VK_MAX_RETRIES + 1):
+        try:
+            result = (await vk_request(method, params, http_method, timeout))['response']
+            core.token_health.record_success(params.get('access_token'))
+            return result
+        except core.VKError as e:
+            metrics.vk_errors.labels(method, str(e.code)).inc()
+            core.token_health.record_error(params.get('access_token'), e.code)
+            alternative = core.replacement_token(params.get('access_token'), e.code)
+            if alternative and method in core.TOKEN_BOUND_METHODS:
+                raise
+            if alternative:
+                print(f"🔀 {method}: токен {core.token_label(params['access_token'])} выведен, повтор с {core.token_label(alternative)}")
+                params = dict(params, access_token=alternative)
+                continue
+            base_delay = core.VK_RETRY_CODES.get(e.code)
+            if base_delay is None or attempt == core.VK_MAX_RETRIES:
+                raise
+            delay = base_delay * (2 ** attempt) * random.uniform(0.8, 1.2)
+            core.vk_rate_limiter.penalize(params.get('access_token'), delay)
+            print(f"⏳ {method}: код VK {e.code}, повтор через {delay:.1f}с")
+
+async def post_multipart(upload_url, fields, field):
+    """Потоковая отправка файлов на сервер загрузки VK; fields - [(поле, имя, данные)].
+    Повторы и дубли - в upload_with_retries"""
+    body = core.StreamingMultipart([(name, filename, core.as_upload_stream(data)) for name, filename, data in fields])
+    
+    async def chunks():
+        body.seek(0)
+        while True:
+            # Файл может лежать на диске - читаем его не в цикле событий
+            chunk = await asyncio.to_thread(body.read)
+            if not chunk:
+                break
+            yield chunk
+    
+    headers = {'Content-Type': body.content_type, 'Content-Length': str(len(body))}
+    target = 'album' if field == 'photos_list' else 'wall'
+    metrics.proxy_bytes.labels('out').inc(len(body))
+    async with core.proxy_scheduler.aslot(cost=max(1, len(body) / core.SCHEDULER_COST_BYTES)):
+        with metrics.uploads_in_flight.track_inprogress(), metrics.vk_upload_seconds.labels(target).time():
+            status, content = await fetch(upload_session, 'POST', upload_url, 60, make_body=chunks, headers=headers)
+    core.check_upload_status(status)
+    raise_for_status(status, upload_url)
+    return core.check_upload_result(json.loads(content), field)
+
+# ==================== URL ЗАГРУЗКИ ====================
+async def cached_upload_url(key, method, params):
+    url = core.upload_url_cache.lookup(key)
+    if url is None:
+        url = (await vk_call(method, params))['upload_url']
+        core.upload_url_cache.store(key, url)
+    return url
+
+async def get_album_upload_url(config):
+    params = core.upload_server_params(config['ACCESS_TOKEN'], config['ALBUM_ID'], config.get('GROUP_ID'))
+    return await cached_upload_url(core.album_url_key(config), 'photos.getUploadServer', params)
+
+async def get_wall_upload_url(config):
+    params = core.wall_upload_server_params(config['ACCESS_TOKEN'], config.get('GROUP_ID'))
+    return await cached_upload_url(core.wall_url_key(config), 'photos.getWallUploadServer', params)
+
+async def upload_url_for(config, target):
+    return await (get_album_upload_url(config) if target == 'album' else get_wall_upload_url(config))
+
+async def fresh_upload_url(config, target):
+    """Новый URL мимо кэша - для дубля, который должен уйти на другой сервер"""
+    if target == 'album':
+        params = core.upload_server_params(config['ACCESS_TOKEN'], config['ALBUM_ID'], config.get('GROUP_ID'))
+        return (await vk_call('photos.getUploadServer', params))['upload_url']
+    params = core.wall_upload_server_params(config['ACCESS_TOKEN'], config.get('GROUP_ID'))
+    return (await vk_call('photos.getWallUploadServer', params))['upload_url']
+
+async def get_row_upload_urls(config, row, album=True):
+    if album:
+        album_url, wall_upload_url = await asyncio.gather(get_album_upload_url(config), get_wall_upload_url(config))
+    else:
+        album_url, wall_upload_url = None, await get_wall_upload_url(config)
+    return album_url, wall_upload_url, core.split_comment_groups(row)
+
+# ==================== ПОВТОРЫ И ДУБЛИ ЗАГРУЗОК ====================
+async def upload_with_retries(config, target, upload_url, files):
+    """Как app.upload_with_retries: решения о повторах принимает тот же
+    app.UploadRetries, а паузы и дубль идут в цикле событий"""
+    sources = [(core.UploadSource(file_data), filename) for file_data, filename in files]
+    size = sum(source.size for source, _ in sources)
+    retries = core.UploadRetries(config, target, files)
+    upload_url = upload_url or await upload_url_for(config, target)
+    while True:
+        try:
+            return await hedged_upload(config, retries, upload_url, sources, size)
+        except Exception as e:
+            delay = retries.after_failure(e, upload_url)
+            if delay is None:
+                raise
+            if isinstance(e, core.UploadUrlExpired):
+                upload_url = await upload_url_for(config, target)
+            else:
+                await asyncio.sleep(delay)
+
+async def hedged_upload(config, retries, upload_url, sources, size):
+    """Как app.hedged_upload; проигравшая попытка отменяется"""
+    target = retries.target
+    delay = core.upload_tracker.hedge_delay(target, size)
+    if delay is None:
+        return await upload_attempt(target, upload_url, sources, size)
+    
+    attempts = [asyncio.ensure_future(upload_attempt(target, upload_url, sources, size))]
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if done or not retries.hedge(delay):
+            return await attempts[0]
+        try:
+            hedge_url = await fresh_upload_url(config, target)
+        except Exception as e:
+            print(f"⚠️ Дубль загрузки не отправлен: {e}")
+            return await attempts[0]
+        
+        attempts.append(asyncio.ensure_future(upload_attempt(target, hedge_url, sources, size)))
+        pending, error = set(attempts), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception():
+                    error = error or attempt.exception()
+                    continue
+                metrics.vk_upload_hedges.labels(target, 'won' if attempt is attempts[1] else 'lost').inc()
+                return attempt.result()
+        raise error
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+async def upload_attempt(target, upload_url, sources, size):
+    """Один POST на сервер загрузки с записью исхода и времени"""
+    if target == 'album':
+        fields = [(f'file{i}', filename, source.open()) for i, (source, filename) in enumerate(sources, 1)]
+    else:
+        fields = [('photo', filename, source.open()) for source, filename in sources]
+    started = time.monotonic()
+    try:
+        result = await post_multipart(upload_url, fields, 'photos_list' if target == 'album' else 'photo')
+    except Exception as e:
+        core.upload_tracker.record_error(target, e)
+        raise
+    core.upload_tracker.record(target, 'ok', time.monotonic() - started, size)
+    return result
+
+# ==================== КОНВЕЙЕР ЗАГРУЗКИ ====================
+class AsyncKeyedLocks:
+    """Как KeyedLocks из app.py, но ожидание не блокирует цикл событий"""
+    def __init__(self):
+        self.locks = {}   # ключ -> [lock, число владельцев]
+    
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+catalog_locks = AsyncKeyedLocks()
+idempotency_locks = AsyncKeyedLocks()
+
+async def upload_album_photos(config, upload_url, items):
+    """То же, что app.upload_album_photos: повторные фото берутся из каталога,
+    остальные загружаются одной пачкой"""
+    streams = [core.as_upload_stream(file_data) for file_data, _, _ in items]
+    hashes = await asyncio.gather(*(asyncio.to_thread(core.file_sha256, stream) for stream in streams))
+    keys = [(sha256, core.album_target(config, description))
+            for sha256, (_, _, description) in zip(hashes, items)]
+    
+    async with AsyncExitStack() as stack:
+        for key in sorted(set(keys)):
+            await stack.enter_async_context(catalog_locks.hold(key))
+        
+        found = {}
+        pending = []
+        for key, stream, (_, filename, description) in zip(keys, streams, items):
+            if key in found or any(key == k for k, _ in pending):
+                continue
+            photo = await asyncio.to_thread(core.photo_catalog.get, *key)
+            if photo:
+                print(f"♻️ {filename}: уже загружено в альбом, используем {core.photo_attachment(photo)}")
+                found[key] = photo
+            else:
+                pending.append((key, (stream, filename, description)))
+        
+        if pending:
+            processed = await asyncio.gather(*(
+                asyncio.to_thread(core.maybe_preprocess, config, stream, filename)
+                for _, (stream, filename, _) in pending))
+            for data, (_, (stream, _, _)) in zip(processed, pending):
+                stack.callback(core.close_preprocessed, data, stream)
+            items = [(data, filename, description)
+                     for data, (_, (_, filename, description)) in zip(processed, pending)]
+            saved = await save_album_pack(config, upload_url or await get_album_upload_url(config), items)
+            for (key, _), photo in zip(pending, saved):
+                await asyncio.to_thread(core.photo_catalog.put, *key, photo)
+                found[key] = photo
+    
+    return [found[key] for key in keys]
+
+async def save_album_pack(config, upload_url, items):
+    """Загрузка пачки фото в альбом одним запросом и одним photos.save"""
+    files = [(file_data, filename) for file_data, filename, _ in items]
+    names = ', '.join(filename for _, filename in files)
+    upload_result = await upload_with_retries(config, 'album', upload_url, files)
+    
+    captions, common_caption = core.pack_captions(items)
+    photos = await vk_call('photos.save', core.save_album_photo_params(
+        config['ACCESS_TOKEN'],
+        upload_result['server'],
+        upload_result['photos_list'],
+        upload_result['hash'],
+        config['ALBUM_ID'],
+        config.get('GROUP_ID'),
+        common_caption
+    ))
+    if len(photos) != len(items):
+        raise Exception(f"VK сохранил {len(photos)} фото из {len(items)}: {names}")
+    
+    if not common_caption:
+        edits = []
+        for photo, caption in zip(photos, captions):
+            if caption:
+                params = core.edit_photo_caption_params(config['ACCESS_TOKEN'], photo['owner_id'], photo['id'], caption)
+                edits.append(vk_call('photos.edit', params, http_method='POST'))
+                photo['text'] = caption
+        await asyncio.gather(*edits)
+    return photos
+
+async def upload_wall_photo(config, upload_url, file_data, filename):
+    """Загрузка фото на стену и сохранение; повторный файл берется из каталога"""
+    file_data = core.as_upload_stream(file_data)
+    key = (await asyncio.to_thread(core.file_sha256, file_data), core.wall_target(config))
+    async with catalog_locks.hold(key):
+        photo = await asyncio.to_thread(core.photo_catalog.get, *key)
+        if photo:
+            print(f"♻️ {filename}: уже загружено на стену, используем {core.photo_attachment(photo)}")
+            return photo
+        
+        processed = await asyncio.to_thread(core.maybe_preprocess, config, file_data, filename)
+        try:
+            upload_result = await upload_with_retries(config, 'wall', upload_url, [(processed, filename)])
+        finally:
+            core.close_preprocessed(processed, file_data)
+        
+        photo = (await vk_call('photos.saveWallPhoto', core.save_wall_photo_params(
+            config['ACCESS_TOKEN'],
+            upload_result['server'],
+            upload_result['photo'],
+            upload_result['hash'],
+            config.get('GROUP_ID')
+        ), http_method='POST'))[0]
+        await asyncio.to_thread(core.photo_catalog.put, *key, photo)
+        return photo
+
+async def upload_wall_photos(config, upload_url, items):
+    """Загрузка фото на стену параллельно, не больше WALL_UPLOAD_WORKERS сразу.
+    items - [(данные, имя файла)], результат - [(фото, ошибка)] в том же порядке"""
+    semaphore = asyncio.Semaphore(core.WALL_UPLOAD_WORKERS)
+    
+    async def upload(file_data, filename):
+        async with semaphore:
+            return await upload_wall_photo(config, upload_url, file_data, filename)
+    
+    results = await asyncio.gather(*(upload(file_data, filename) for file_data, filename in items),
+                                   return_exceptions=True)
+    return [(None, result) if isinstance(result, Exception) else (result, None) for result in results]
+
+# ==================== МАРШРУТЫ ====================
+def error(message, status):
+    return JSONResponse({'success': False, 'error': message}, status)
+
+def too_large(request):
+    limit = core.app.config['MAX_CONTENT_LENGTH']
+    return int(request.headers.get('content-length') or 0) > limit
+
+async def session_config(session_id):
+    """Конфиг сессии; как app.schedule_request, ставит дальнейшие обращения
+    к VK запроса в очередь этой сессии с ее весом"""
+    fields = await asyncio.to_thread(core.get_session_fields, session_id, 'config', 'priority')
+    core.set_flow(session_id, fields.get('priority', 1.0))
+    return fields.get('config')
+
+def observed(view):
+    """Те же метрики запросов, что и у маршрутов Flask"""
+    @wraps(view)
+    async def wrapper(request):
+        started = time.perf_counter()
+        metrics.http_in_flight.inc()
+        status = 500
+        try:
+            response = await view(request)
+            status = response.status_code
+            return response
+        finally:
+            metrics.http_in_flight.dec()
+            metrics.http_requests.labels(view.__name__, request.method, str(status)).inc()
+            metrics.http_request_seconds.labels(view.__name__).observe(time.perf_counter() - started)
+            content_length = int(request.headers.get('content-length') or 0)
+            if request.headers.get('content-type', '').startswith('multipart/form-data') and content_length:
+                metrics.proxy_bytes.labels('in').inc(content_length)
+    return wrapper
+
+def admitted(view):
+    """Как app.admit_upload: при превышенном бюджете загрузок 429 с Retry-After до чтения тела"""
+    @wraps(view)
+    async def wrapper(request):
+        if too_large(request):
+            return await view(request)
+        size = int(request.headers.get('content-length') or core.app.config['MAX_CONTENT_LENGTH'])
+        rejected = core.upload_admission.admit(size)
+        if rejected:
+            reason, retry_after = rejected
+            metrics.admission_rejected.labels(view.__name__, reason).inc()
+            return JSONResponse(
+                {'success': False, 'error': 'Сервер перегружен, повторите позже', 'retry_after': retry_after},
+                429, headers={'Retry-After': str(retry_after), 'Connection': 'close'})
+        try:
+            return await view(request)
+        finally:
+            core.upload_admission.release(size)
+    return wrapper
+
+def idempotent(view):
+    """Как app.idempotent: повтор с тем же Idempotency-Key получает сохраненный ответ"""
+    @wraps(view)
+    async def wrapper(request):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return await view(request)
+        
+        key = f"{request.url.path}:{key}"
+        async with idempotency_locks.hold(key):
+            saved = await asyncio.to_thread(core.checkpoint_store.get_response, key)
+            if saved:
+                return JSONResponse(saved[1], saved[0], headers={'Idempotent-Replayed': 'true'})
+            
+            request.state.idempotent_previous = await asyncio.to_thread(core.previous_partial_response, key)
+            response = await view(request)
+            if 200 <= response.status_code < 300 and isinstance(response, JSONResponse):
+                await asyncio.to_thread(core.save_idempotent_response, key, response.status_code, json.loads(response.body))
+            return response
+    return wrapper
+
+async def get_upload_urls(request):
+    try:
+        session_id = request.path_params['session_id']
+        row_index = request.path_params['row_index']
+        config = await session_config(session_id)
+        if not config:
+            return error('Сессия не найдена', 404)
+        
+        csv_data = await asyncio.to_thread(core.get_session_field, session_id, 'csv_data', [])
+        if row_index >= len(csv_data):
+            return error('Неверный индекс', 400)
+        
+        plan = await asyncio.to_thread(core.get_session_field, session_id, 'plan')
+        row = core.planned_row(csv_data, plan, row_index)
+        photo = core.planned_photo(plan, row_index)
+        album_url, wall_upload_url, comment_groups = await get_row_upload_urls(
+            core.row_config(config, row_index), row, album=photo is None
+        )
+        comment_urls = [{'group': group, 'upload_url': wall_upload_url} for group in comment_groups]
+        
+        return JSONResponse({
+            'success': True,
+            'row_index': row_index,
+            'description': row.description,
+            'main_photo': {
+                'filename': row.main_photo,
+                'upload_url': album_url,
+                'photo': photo
+            },
+            'comment_groups': comment_urls,
+            'wall_upload_url': wall_upload_url
+        })
+    
+    except Exception as e:
+        return error(str(e), 500)
+
+@idempotent
+async def proxy_upload_album(request):
+    if too_large(request):
+        return error('Слишком большой запрос', 413)
+    try:
+        async with request.form() as form:
+            session_id = form.get('session_id')
+            filename = form.get('filename')
+            upload_url = form.get('upload_url')
+            description = form.get('description', '')
+            
+            file = form.get('file')
+            if not isinstance(file, UploadFile):
+                return error('Нет файла', 400)
+            
+            config = await session_config(session_id)
+            if not config:
+                return error('Сессия не найдена', 404)
+            
+            config, upload_url = core.upload_config(config, upload_url, f"file:{filename}")
+            photo = (await upload_album_photos(config, upload_url, [(file.file, filename, description)]))[0]
+        
+        await asyncio.to_thread(core.mark_uploaded, session_id, filename)
+        return JSONResponse({'success': True, 'photo': photo})
+    
+    except Exception as e:
+        return error(str(e), 500)
+
+@idempotent
+async def proxy_upload_album_batch(request):
+    if too_large(request):
+        return error('Слишком большой запрос', 413)
+    try:
+        async with request.form(max_files=core.ALBUM_BATCH_SIZE + 1) as form:
+            session_id = form.get('session_id')
+            upload_url = form.get('upload_url')
+            files = [file for file in form.getlist('files') if isinstance(file, UploadFile)]
+            filenames = form.getlist('filenames')
+            descriptions = form.getlist('descriptions')
+            
+            if not files:
+                return error('Нет файлов', 400)
+            if len(files) > core.ALBUM_BATCH_SIZE:
+                return error(f'Не больше {core.ALBUM_BATCH_SIZE} файлов за раз', 400)
+            if len(filenames) != len(files):
+                return error('Число имен не совпадает с числом файлов', 400)
+            descriptions += [''] * (len(files) - len(descriptions))
+            
+            config = await session_config(session_id)
+            if not config:
+                return error('Сессия не найдена', 404)
+            
+            config, upload_url = core.upload_config(config, upload_url, f"file:{filenames[0]}")
+            items = [(file.file, filename, description) for file, filename, description in zip(files, filenames, descriptions)]
+            photos = await upload_album_photos(config, upload_url or await get_album_upload_url(config), items)
+        
+        await asyncio.to_thread(core.mark_uploaded, session_id, *filenames)
+        return JSONResponse({'success': True, 'photos': photos})
+    
+    except Exception as e:
+        return error(str(e), 500)
+
+@idempotent
+async def proxy_upload_wall(request):
+    if too_large(request):
+        return error('Слишком большой запрос', 413)
+    try:
+        async with request.form() as form:
+            session_id = form.get('session_id')
+            filename = form.get('filename')
+            upload_url = form.get('upload_url')
+            
+            file = form.get('file')
+            if not isinstance(file, UploadFile):
+                return error('Нет файла', 400)
+            
+            config = await session_config(session_id)
+            if not config:
+                return error('Сессия не найдена', 404)
+            
+            config, upload_url = core.upload_config(config, upload_url, f"file:{filename}")
+            photo = await upload_wall_photo(config, upload_url, file.file, filename)
+        
+        await asyncio.to_thread(core.mark_uploaded, session_id, filename)
+        return JSONResponse({'success': True, 'photo': photo})
+    
+    except Exception as e:
+        return error(str(e), 500)
+
+@idempotent
+async def proxy_upload_wall_batch(request):
+    if too_large(request):
+        return error('Слишком большой запрос', 413)
+    try:
+        async with request.form() as form:
+            session_id = form.get('session_id')
+            row_index = form.get('row_index')
+            upload_url = form.get('upload_url')
+            owner_id = form.get('owner_id')
+            photo_id = form.get('photo_id')
+            files = [file for file in form.getlist('files') if isinstance(file, UploadFile)]
+            filenames = form.getlist('filenames')
+            
+            if len(filenames) != len(files):
+                return error('Число имен не совпадает с числом файлов', 400)
+            
+            config = await session_config(session_id)
+            if not config:
+                return error('Сессия не найдена', 404)
+            
+            csv_data = await asyncio.to_thread(core.get_session_field, session_id, 'csv_data', [])
+            if not (row_index or '').isdigit() or int(row_index) >= len(csv_data):
+                return error('Неверный индекс', 400)
+            
+            row_index = int(row_index)
+            plan = await asyncio.to_thread(core.get_session_field, session_id, 'plan')
+            row = core.planned_row(csv_data, plan, row_index)
+            names = core.comment_names(row)
+            unknown = set(filenames) - set(names)
+            if unknown:
+                return error(f"Файлы не из строки {row_index}: {', '.join(sorted(unknown))}", 400)
+            
+            config, upload_url = core.upload_config(config, upload_url, f"row:{row_index}")
+            received = dict(zip(filenames, files))
+            items = [(received[name].file, name) for name in names if name in received]
+            results = dict(zip(
+                (name for _, name in items),
+                await upload_wall_photos(config, upload_url or await get_wall_upload_url(config), items)
+            ))
+        
+        photos, uploaded = core.wall_batch_report(names, results)
+        if uploaded:
+            await asyncio.to_thread(core.mark_uploaded, session_id, *uploaded)
+        
+        comment_results, comment_errors = [], []
+        if owner_id and photo_id:
+            previous, commented = core.created_comments(getattr(request.state, 'idempotent_previous', None))
+            comment_results.extend(previous)
+            for group in core.split_comment_groups(row):
+                # Фото, уже прикрепленные прошлой попыткой, второй раз не прикрепляются
+                group_result = [photo for photo in core.group_photos(group, uploaded) if photo['name'] not in commented]
+                if not group_result:
+                    continue
+                params = core.create_comment_params(
+                    config['ACCESS_TOKEN'],
+                    owner_id,
+                    photo_id,
+                    [core.photo_attachment(p) for p in group_result],
+                    config.get('GROUP_ID')
+                )
+                try:
+                    comment_id = await vk_call('photos.createComment', params, http_method='POST')
+                    comment_results.append({'group': group, 'photos': group_result, 'comment_id': comment_id})
+                except Exception as e:
+                    comment_errors.append({'group': group, 'error': str(e)})
+        
+        return JSONResponse({
+            'success': True,
+            'photos': photos,
+            'comment_results': comment_results,
+            'comment_errors': comment_errors,
+            'partial': len(uploaded) < len(items)
+        })
+    
+    except Exception as e:
+        return error(str(e), 500)
+
+@idempotent
+async def proxy_create_comment(request):
+    try:
+        data = await request.json()
+        session_id = data.get('session_id')
+        
+        config = await session_config(session_id)
+        if not config:
+            return error('Сессия не найдена', 404)
+        config = core.token_config(config, f"photo:{data.get('owner_id')}_{data.get('photo_id')}")
+        
+        params = core.create_comment_params(
+            config['ACCESS_TOKEN'],
+            data.get('owner_id'),
+            data.get('photo_id'),
+            data.get('attachments', []),
+            config.get('GROUP_ID')
+        )
+        comment_id = await vk_call('photos.createComment', params, http_method='POST')
+        return JSONResponse({'success': True, 'comment_id': comment_id})
+    
+    except Exception as e:
+        return error(str(e), 500)
+
+class AsyncSubscription(core.Subscription):
+    """Подписка на прогресс, которую ждет корутина, а не поток: события
+    публикуются из потоков обработчиков и будят цикл событий"""
+    def __init__(self, size):
+        super().__init__(size)
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+    
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.ready.set)
+    
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.ready.clear()
+
+async def progress_stream(request):
+    """Как /api/progress во Flask, но подписчик не занимает поток,
+    поэтому PROGRESS_MAX_SUBSCRIBERS здесь не действует"""
+    session_id = request.path_params['session_id']
+    snapshot = await asyncio.to_thread(core.progress_snapshot, session_id)
+    if snapshot is None:
+        return error('Сессия не найдена', 404)
+    
+    subscription = core.progress_broker.subscribe(session_id, AsyncSubscription(core.PROGRESS_QUEUE_SIZE))
+    
+    async def stream():
+        last = snapshot
+        try:
+            yield core.sse_event('snapshot', snapshot)
+            while True:
+                await subscription.wait(core.PROGRESS_SYNC_INTERVAL or core.PROGRESS_KEEPALIVE)
+                events, lagged = subscription.drain()
+                if lagged:
+                    current = await asyncio.to_thread(core.progress_snapshot, session_id)
+                    events = [('snapshot', current)] if current else [('closed', {})]
+                elif not events and core.PROGRESS_SYNC_INTERVAL:
+                    current = await asyncio.to_thread(core.progress_snapshot, session_id)
+                    if current != last:
+                        events = [('snapshot', current)] if current else [('closed', {})]
+                for event, data in events:
+                    yield core.sse_event(event, data)
+                    if event == 'snapshot':
+                        last = data
+                    if event == 'closed':
+                        return
+                if not events:
+                    if await asyncio.to_thread(core.get_session_field, session_id, 'total_rows') is None:
+                        yield core.sse_event('closed', {})
+                        return
+                    yield ': keepalive\n\n'
+        finally:
+            core.progress_broker.unsubscribe(session_id, subscription)
+    
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@asynccontextmanager
+async def lifespan(_):
+    global vk_session, upload_session
+    vk_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=ASYNC_VK_CONNECTIONS, keepalive_timeout=ASYNC_KEEPALIVE))
+    upload_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=ASYNC_UPLOAD_CONNECTIONS, keepalive_timeout=ASYNC_KEEPALIVE))
+    try:
+        yield
+    finally:
+        await vk_session.close()
+        await upload_session.close()
+
+application = Starlette(
+    routes=[
+        Route('/api/get-upload-urls/{session_id}/{row_index:int}', observed(get_upload_urls), methods=['GET']),
+        Route('/api/proxy/upload-album', observed(admitted(proxy_upload_album)), methods=['POST']),
+        Route('/api/proxy/upload-album-batch', observed(admitted(proxy_upload_album_batch)), methods=['POST']),
+        Route('/api/proxy/upload-wall', observed(admitted(proxy_upload_wall)), methods=['POST']),
+        Route('/api/proxy/upload-wall-batch', observed(admitted(proxy_upload_wall_batch)), methods=['POST']),
+        Route('/api/proxy/create-comment', observed(proxy_create_comment), methods=['POST']),
+        Route('/api/progress/{session_id}', progress_stream, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(core.app, workers=ASGI_WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,249 @@
+"""Локальная замена API VK для нагрузочных тестов.
+
+Реализует users.get, photos.getUploadServer, photos.getWallUploadServer,
+photos.save, photos.saveWallPhoto, photos.edit, photos.createComment, execute
+и серверы загрузки. Задержки, лимит размера файла и ошибки настраиваются.
+
+    python bench/fake_vk.py --port 8765 --latency 0.05 --upload-latency 0.2 --error-6 0.02
+    VK_API_URL=http://127.0.0.1:8765/method gunicorn app:app ...
+
+Статистика вызовов: GET /_stats
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+SECRET = b'fake-vk'
+
+
+class FakeVKConfig:
+    def __init__(self, latency=0.0, upload_latency=0.0, jitter=0.2, max_upload_bytes=50 * 1024 * 1024,
+                 error_6=0.0, error_9=0.0, error_5xx=0.0, expire=0.0, upload_url_ttl=3600, upload_hosts=1,
+                 bad_tokens=()):
+        self.latency = latency                    # секунд на вызов метода
+        self.upload_latency = upload_latency      # секунд на загрузку файла
+        self.jitter = jitter                      # доля случайного разброса задержки
+        self.max_upload_bytes = max_upload_bytes  # больше - HTTP 413
+        self.error_6 = error_6                    # доля вызовов с ошибкой 6 (слишком часто)
+        self.error_9 = error_9                    # доля вызовов с ошибкой 9 (flood control)
+        self.error_5xx = error_5xx                # доля запросов с HTTP 502/503
+        self.expire = expire                      # доля загрузок с протухшим URL
+        self.upload_url_ttl = upload_url_ttl      # через сколько секунд URL загрузки протухает
+        self.upload_hosts = upload_hosts          # серверов загрузки: 127.0.0.1 ... 127.0.0.N
+        self.bad_tokens = set(bad_tokens)         # токены, на которые API отвечает ошибкой 5
+
+
+def create_app(config):
+    app = Flask('fake_vk')
+    ids = itertools.count(1000)
+    stats = Counter()
+    lock = threading.Lock()
+
+    def count(name):
+        with lock:
+            stats[name] += 1
+
+    def pause(seconds):
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - config.jitter, 1 + config.jitter))
+
+    def sign(*parts):
+        return hmac.new(SECRET, '|'.join(map(str, parts)).encode(), hashlib.sha256).hexdigest()[:16]
+
+    def user_of(token):
+        # URL загрузки, как и в VK, привязан к пользователю токена
+        return hashlib.sha256(token.encode()).hexdigest()[:8]
+
+    def upload_url(kind, owner_id, album_id, user):
+        expires = int(time.time() + config.upload_url_ttl)
+        sig = sign(kind, owner_id, album_id, expires, user)
+        host = request.host
+        if config.upload_hosts > 1:
+            # Разные хосты, как шарды pu.vk.com; сервер должен слушать 0.0.0.0
+            host = f"127.0.0.{random.randint(1, config.upload_hosts)}:{request.host.rsplit(':', 1)[1]}"
+        return f"http://{host}/upload/{kind}?owner={owner_id}&album={album_id}&user={user}&exp={expires}&sig={sig}"
+
+    def owner(params):
+        group_id = params.get('group_id')
+        return -abs(int(group_id)) if group_id else 1
+
+    def error(code, message):
+        count(f'error:{code}')
+        return {'error': {'error_code': code, 'error_msg': message}}
+
+    def call(method, params):
+        """Один метод API: {'response': ...} или {'error': ...}"""
+        roll = random.random()
+        if roll < config.error_6:
+            return error(6, 'Too many requests per second')
+        if roll < config.error_6 + config.error_9:
+            return error(9, 'Flood control')
+        count(method)
+        count(f"token:{params['access_token'][-6:]}")
+        user = user_of(params['access_token'])
+
+        if method == 'users.get':
+            return {'response': [{'id': 1, 'first_name': 'Fake', 'last_name': 'User'}]}
+        if method == 'photos.getUploadServer':
+            return {'response': {'upload_url': upload_url('album', owner(params), params.get('album_id', ''), user),
+                                 'album_id': params.get('album_id')}}
+        if method == 'photos.getWallUploadServer':
+            return {'response': {'upload_url': upload_url('wall', owner(params), '', user)}}
+        if method == 'photos.save':
+            if sign('saved', params.get('server'), params.get('photos_list'), user) != params.get('hash'):
+                return error(121, 'Invalid hash')
+            photos = json.loads(params['photos_list'])
+            return {'response': [{'id': next(ids), 'owner_id': owner(params), 'album_id': params.get('album_id'),
+                                  'text': params.get('caption', ''), 'size': photo['size']} for photo in photos]}
+        if method == 'photos.saveWallPhoto':
+            if sign('saved', params.get('server'), params.get('photo'), user) != params.get('hash'):
+                return error(121, 'Invalid hash')
+            photo = json.loads(params['photo'])
+            return {'response': [{'id': next(ids), 'owner_id': owner(params), 'size': photo['size']}]}
+        if method == 'photos.edit':
+            return {'response': 1}
+        if method == 'photos.createComment':
+            if not params.get('attachments'):
+                return error(100, 'One of the parameters specified was missing or invalid')
+            return {'response': next(ids)}
+        return error(3, f'Unknown method passed: {method}')
+
+    def execute(code, token):
+        """return [API.method({...}), ...]; - как делает VKBatcher"""
+        decoder = json.JSONDecoder()
+        results, errors = [], []
+        position = code.find('API.')
+        while position != -1:
+            start = code.index('(', position)
+            method = code[position + 4:start]
+            args, end = decoder.raw_decode(code, start + 1)
+            result = call(method, dict({k: str(v) for k, v in args.items()}, access_token=token))
+            if 'error' in result:
+                results.append(False)
+                errors.append(dict(method=method, **result['error']))
+            else:
+                results.append(result['response'])
+            position = code.find('API.', end)
+        response = {'response': results}
+        if errors:
+            response['execute_errors'] = errors
+        return response
+
+    @app.route('/method/<method>', methods=['GET', 'POST'])
+    def api(method):
+        pause(config.latency)
+        if random.random() < config.error_5xx:
+            count('http:503')
+            return 'Service Unavailable', 503
+        params = request.values.to_dict()
+        if not params.get('access_token'):
+            return jsonify(error(5, 'User authorization failed: no access_token passed.'))
+        if params['access_token'] in config.bad_tokens:
+            return jsonify(error(5, 'User authorization failed: invalid access_token (4).'))
+        if method == 'execute':
+            count('execute')
+            return jsonify(execute(params.get('code', ''), params['access_token']))
+        return jsonify(call(method, params))
+
+    @app.route('/upload/<kind>', methods=['POST'])
+    def upload(kind):
+        if request.content_length and request.content_length > config.max_upload_bytes:
+            count('http:413')
+            return 'Request Entity Too Large', 413
+        pause(config.upload_latency)
+        if random.random() < config.error_5xx:
+            count('http:502')
+            return 'Bad Gateway', 502
+
+        args = request.args
+        expired = int(args.get('exp', 0)) < time.time() or random.random() < config.expire
+        signature = sign(kind, args.get('owner'), args.get('album'), args.get('exp'), args.get('user'))
+        if expired or signature != args.get('sig'):
+            count('upload:expired')
+            return jsonify({'error': 'ERR_UPLOAD_BAD_SIGNATURE: upload url expired'})
+
+        count(f'upload:{kind}')
+        server = random.randint(100000, 999999)
+        if kind == 'album':
+            files = [f for name, f in sorted(request.files.items()) if name.startswith('file')][:5]
+            photos_list = json.dumps([{'name': f.filename, 'size': len(f.read())} for f in files])
+            return jsonify({'server': server, 'photos_list': photos_list, 'aid': args.get('album'),
+                            'hash': sign('saved', server, photos_list, args.get('user'))})
+        file = request.files.get('photo')
+        if file is None:
+            return jsonify({'server': server, 'photo': '[]', 'hash': ''})
+        photo = json.dumps({'name': file.filename, 'size': len(file.read())})
+        return jsonify({'server': server, 'photo': photo, 'hash': sign('saved', server, photo, args.get('user'))})
+
+    @app.route('/_stats')
+    def get_stats():
+        with lock:
+            return jsonify(dict(stats))
+
+    return app
+
+
+def serve(config, host='127.0.0.1', port=8765):
+    """Запустить сервер в фоновом потоке, вернуть объект сервера (shutdown() - остановить).
+    Сервер werkzeug закрывает соединение после каждого ответа, для замеров
+    переиспользования соединений нужен main() - он запускает gunicorn"""
+    server = make_server(host, port, create_app(config), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_gunicorn(app, host, port, threads):
+    """gunicorn с потоками держит keep-alive, как настоящие серверы VK"""
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            settings = {'bind': f'{host}:{port}', 'workers': 1, 'worker_class': 'gthread',
+                        'threads': threads, 'keepalive': 75, 'timeout': 0, 'loglevel': 'warning'}
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальная замена API VK')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='секунд на вызов метода')
+    parser.add_argument('--upload-latency', type=float, default=0.0, help='секунд на загрузку')
+    parser.add_argument('--max-upload-mb', type=float, default=50)
+    parser.add_argument('--error-6', type=float, default=0.0, help='доля ошибок 6')
+    parser.add_argument('--error-9', type=float, default=0.0, help='доля ошибок 9')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='доля ответов 5xx')
+    parser.add_argument('--expire', type=float, default=0.0, help='доля загрузок с протухшим URL')
+    parser.add_argument('--upload-url-ttl', type=float, default=3600)
+    parser.add_argument('--threads', type=int, default=64, help='одновременных запросов')
+    parser.add_argument('--bad-tokens', default='', help='токены через запятую, на которые ответ - ошибка 5')
+    parser.add_argument('--upload-hosts', type=int, default=1, help='серверов загрузки (нужен --host 0.0.0.0)')
+    args = parser.parse_args()
+
+    config = FakeVKConfig(
+        latency=args.latency, upload_latency=args.upload_latency,
+        max_upload_bytes=int(args.max_upload_mb * 1024 * 1024),
+        error_6=args.error_6, error_9=args.error_9, error_5xx=args.error_5xx,
+        expire=args.expire, upload_url_ttl=args.upload_url_ttl, upload_hosts=args.upload_hosts,
+        bad_tokens=[token for token in args.bad_tokens.split(',') if token])
+    print(f"Fake VK: http://{args.host}:{args.port}/method")
+    run_gunicorn(create_app(config), args.host, args.port, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""Сквозной нагрузочный тест: app.py против локальной замены VK (fake_vk.py).
+
+Запускает fake_vk и сервер приложения отдельными процессами, создает CSV и
+синтетические фото и прогоняет строки так же, как это делает браузер
+(или через серверный режим). В конце печатает строк в секунду, p50/p99 по
+каждому маршруту и пиковую память процесса приложения.
+
+    python bench/run_benchmark.py --rows 200 --comments 4 --concurrency 8
+    python bench/run_benchmark.py --server async --concurrency 64 --upload-latency 0.3 --rate-limit 1000
+    python bench/run_benchmark.py --mode job --rows 500 --error-6 0.02 --expire 0.01
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url}: процесс завершился с кодом {process.returncode}')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url}: сервер не поднялся за {timeout}с')
+
+
+def process_tree(pid):
+    """pid и все его потомки (Linux, /proc)"""
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children[ppid].append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+
+def rss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Пиковая суммарная память процесса и его потомков"""
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            self.stopped.wait(self.interval)
+
+
+class Recorder:
+    """Время ответа по маршрутам"""
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def request(self, route, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session().request(method, url, timeout=300, **kwargs)
+            data = response.json() if response.headers.get('Content-Type', '').startswith('application/json') else {}
+            ok = response.ok and data.get('success', True)
+        except (requests.RequestException, ValueError):
+            response, data, ok = None, {}, False
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.timings[route].append(elapsed)
+            if not ok:
+                self.errors[route] += 1
+        return data
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def fake_photo(size):
+    # Сервер-заглушка не разбирает изображения: достаточно уникальных байт с заголовком JPEG
+    return b'\xff\xd8\xff\xe0' + os.urandom(max(size - 4, 0))
+
+
+def make_csv(rows, comments):
+    lines = ['Файл изображения|Описание|Фото для комментариев']
+    for i in range(rows):
+        photos = ';'.join(f'row{i}_c{j}.jpg' for j in range(comments))
+        lines.append(f'row{i}.jpg|Описание товара {i}|{photos}')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def analyze(base, recorder, args):
+    config = f'ACCESS_TOKENS={args.tokens}\nALBUM_ID=1\nGROUP_ID=1\n'.encode()
+    files = [('files', ('config.txt', config)), ('files', ('bench.csv', make_csv(args.rows, args.comments)))]
+    data = recorder.request('analyze', 'POST', f'{base}/api/analyze', files=files)
+    if not data.get('session_id'):
+        raise RuntimeError(f'analyze не прошел: {data}')
+    return data
+
+
+def run_row(base, recorder, session_id, row_index, args):
+    """Одна строка - те же запросы, что делает index.html"""
+    urls = recorder.request('get-upload-urls', 'GET', f'{base}/api/get-upload-urls/{session_id}/{row_index}')
+    if not urls.get('success'):
+        return
+    main = urls['main_photo']
+    key = uuid.uuid4().hex
+    album = recorder.request('upload-album', 'POST', f'{base}/api/proxy/upload-album', data={
+        'session_id': session_id, 'filename': main['filename'],
+        'upload_url': main['upload_url'], 'description': urls['description']
+    }, files={'file': (main['filename'], fake_photo(args.image_size))}, headers={'Idempotency-Key': f'{key}-album'})
+    photo = album.get('photo')
+
+    if not photo:
+        comment_results = []
+    elif args.wall == 'batch':
+        comment_results = upload_comments_batch(base, recorder, session_id, row_index, urls, photo, key, args)
+    else:
+        comment_results = upload_comments_single(base, recorder, session_id, urls, photo, key, args)
+
+    recorder.request('save-result', 'POST', f'{base}/api/save-result', json={
+        'session_id': session_id, 'row_index': row_index, 'main_photo_result': photo,
+        'comment_results': comment_results, 'errors': [] if photo else ['upload-album']
+    })
+
+
+def upload_comments_batch(base, recorder, session_id, row_index, urls, photo, key, args):
+    names = list(dict.fromkeys(name for group in urls['comment_groups'] for name in group['group']))
+    if not names:
+        return []
+    files = [('files', (name, fake_photo(args.image_size))) for name in names]
+    data = recorder.request('upload-wall-batch', 'POST', f'{base}/api/proxy/upload-wall-batch', data={
+        'session_id': session_id, 'row_index': row_index, 'upload_url': urls['wall_upload_url'],
+        'owner_id': photo['owner_id'], 'photo_id': photo['id'], 'filenames': names
+    }, files=files, headers={'Idempotency-Key': f'{key}-wall-batch'})
+    return data.get('comment_results', [])
+
+
+def upload_comments_single(base, recorder, session_id, urls, photo, key, args):
+    comment_results = []
+    for group_index, group in enumerate(urls['comment_groups']):
+        attachments, photos = [], []
+        for name in group['group']:
+            wall = recorder.request('upload-wall', 'POST', f'{base}/api/proxy/upload-wall', data={
+                'session_id': session_id, 'filename': name, 'upload_url': group['upload_url']
+            }, files={'file': (name, fake_photo(args.image_size))}, headers={'Idempotency-Key': f'{key}-wall-{name}'})
+            if wall.get('photo'):
+                attachments.append(f"photo{wall['photo']['owner_id']}_{wall['photo']['id']}")
+                photos.append(dict(wall['photo'], name=name))
+        if attachments:
+            recorder.request('create-comment', 'POST', f'{base}/api/proxy/create-comment', json={
+                'session_id': session_id, 'owner_id': photo['owner_id'],
+                'photo_id': photo['id'], 'attachments': attachments
+            }, headers={'Idempotency-Key': f'{key}-comment-{group_index}'})
+            comment_results.append({'group': group['group'], 'photos': photos})
+    return comment_results
+
+
+def run_browser(base, recorder, args):
+    session = analyze(base, recorder, args)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda i: run_row(base, recorder, session['session_id'], i, args), range(args.rows)))
+    elapsed = time.perf_counter() - started
+    recorder.request('finalize', 'GET', f"{base}/api/finalize/{session['session_id']}")
+    return elapsed
+
+
+def run_job(base, recorder, args):
+    session = analyze(base, recorder, args)
+    session_id = session['session_id']
+    started = time.perf_counter()
+    names = session['required_files']
+    for i in range(0, len(names), 50):
+        files = [('files', (name, fake_photo(args.image_size))) for name in names[i:i + 50]]
+        recorder.request('job-files', 'POST', f'{base}/api/job/files/{session_id}', files=files)
+    recorder.request('job-start', 'POST', f'{base}/api/job/start/{session_id}')
+    while recorder.request('job-status', 'GET', f'{base}/api/job/status/{session_id}').get('status') == 'running':
+        time.sleep(0.2)
+    elapsed = time.perf_counter() - started
+    recorder.request('finalize', 'GET', f'{base}/api/finalize/{session_id}')
+    return elapsed
+
+
+def start_fake_vk(args, port):
+    command = [sys.executable, os.path.join(ROOT, 'bench', 'fake_vk.py'), '--port', str(port),
+               '--latency', str(args.latency), '--upload-latency', str(args.upload_latency),
+               '--error-6', str(args.error_6), '--error-9', str(args.error_9),
+               '--error-5xx', str(args.error_5xx), '--expire', str(args.expire),
+               '--upload-hosts', str(args.upload_hosts), '--bad-tokens', args.bad_tokens]
+    if args.upload_hosts > 1:
+        command += ['--host', '0.0.0.0']
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_app(args, port, vk_port, jobs_dir):
+    env = dict(os.environ, VK_API_URL=f'http://127.0.0.1:{vk_port}/method', JOBS_DIR=jobs_dir, PORT=str(port))
+    if args.rate_limit:
+        # Настоящий VK держит 3 запроса/с на токен; выше - чтобы мерить сам сервис, а не ограничитель
+        env.update(VK_RATE_LIMIT=str(args.rate_limit), VK_RATE_BURST=str(max(int(args.rate_limit), 1)))
+    if args.server == 'async':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                   '--port', str(port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+                   '--workers', '1', '--threads', str(args.threads), '--timeout', '0']
+    log = open(os.path.join(jobs_dir, 'app.log'), 'wb')
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def pool_stats(base):
+    """Счетчики пулов соединений сервиса из /metrics: {(пул, hit|miss|prewarmed|discarded): число}"""
+    stats = defaultdict(float)
+    for line in requests.get(f'{base}/metrics').text.splitlines():
+        if line.startswith('http_pool_requests_total{'):
+            labels = dict(item.split('=', 1) for item in line[line.index('{') + 1:line.index('}')].split(','))
+            stats[(labels['pool'].strip('"'), labels['result'].strip('"'))] += float(line.rsplit(' ', 1)[1])
+        for name in ('prewarmed', 'discarded'):
+            if line.startswith(f'http_pool_{name}_total{{'):
+                pool = line.split('pool="', 1)[1].split('"', 1)[0]
+                stats[(pool, name)] += float(line.rsplit(' ', 1)[1])
+    return {f'{pool}:{kind}': int(value) for (pool, kind), value in sorted(stats.items())}
+
+
+def report(args, recorder, elapsed, peak_rss, vk_stats, connections):
+    print(f"\nСервер: {args.server}, режим: {args.mode} ({args.wall}), строк: {args.rows}, "
+          f"фото на строку: {1 + args.comments}, параллельно: {args.concurrency}")
+    print(f"Время: {elapsed:.2f}с, строк в секунду: {args.rows / elapsed:.2f}")
+    print(f"Пиковая память приложения: {peak_rss / 1024 / 1024:.1f} МБ\n")
+    print(f"{'маршрут':<18}{'запросов':>9}{'ошибок':>8}{'p50, мс':>10}{'p99, мс':>10}")
+    for route, values in recorder.timings.items():
+        print(f"{route:<18}{len(values):>9}{recorder.errors[route]:>8}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}")
+    print(f"\nВызовы fake VK: {json.dumps(vk_stats, ensure_ascii=False, sort_keys=True)}")
+    print(f"Соединения сервиса: {json.dumps(connections, sort_keys=True)}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'server': args.server, 'mode': args.mode, 'rows': args.rows, 'elapsed': elapsed,
+                'rows_per_sec': args.rows / elapsed, 'peak_rss': peak_rss, 'vk_calls': vk_stats,
+                'connections': connections,
+                'routes': {route: {'count': len(values), 'errors': recorder.errors[route],
+                                   'p50': percentile(values, 50), 'p99': percentile(values, 99)}
+                           for route, values in recorder.timings.items()}
+            }, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест app.py против fake VK')
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=4, help='фото для комментариев в строке')
+    parser.add_argument('--image-kb', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=8, help='строк одновременно (browser)')
+    parser.add_argument('--wall', choices=('batch', 'single'), default='batch',
+                        help='фото для комментариев: одним запросом или по одному (browser)')
+    parser.add_argument('--mode', choices=('browser', 'job'), default='browser')
+    parser.add_argument('--server', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--threads', type=int, default=8, help='потоков gunicorn (sync)')
+    parser.add_argument('--latency', type=float, default=0.03)
+    parser.add_argument('--upload-latency', type=float, default=0.1)
+    parser.add_argument('--error-6', type=float, default=0.0)
+    parser.add_argument('--error-9', type=float, default=0.0)
+    parser.add_argument('--error-5xx', type=float, default=0.0)
+    parser.add_argument('--expire', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, help='VK_RATE_LIMIT приложения (по умолчанию как в app.py)')
+    parser.add_argument('--tokens', default='bench', help='ACCESS_TOKENS для config.txt: t1:2,t2')
+    parser.add_argument('--bad-tokens', default='', help='токены, на которые fake VK отвечает ошибкой 5')
+    parser.add_argument('--upload-hosts', type=int, default=1, help='серверов загрузки у fake VK')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    args = parser.parse_args()
+    args.image_size = args.image_kb * 1024
+
+    jobs_dir = tempfile.mkdtemp(prefix='vk_bench_')
+    vk_port, app_port = free_port(), free_port()
+    fake_vk = start_fake_vk(args, vk_port)
+    app = start_app(args, app_port, vk_port, jobs_dir)
+    try:
+        wait_ready(f'http://127.0.0.1:{vk_port}/_stats', fake_vk)
+        wait_ready(f'http://127.0.0.1:{app_port}/health', app)
+        sampler = RssSampler(app.pid)
+        sampler.start()
+
+        recorder = Recorder()
+        run = run_job if args.mode == 'job' else run_browser
+        elapsed = run(f'http://127.0.0.1:{app_port}', recorder, args)
+
+        sampler.stopped.set()
+        sampler.join()
+        vk_stats = requests.get(f'http://127.0.0.1:{vk_port}/_stats').json()
+        connections = pool_stats(f'http://127.0.0.1:{app_port}') if args.server == 'sync' else {}
+        report(args, recorder, elapsed, sampler.peak, vk_stats, connections)
+    finally:
+        app.terminate()
+        fake_vk.terminate()
+        app.wait()
+        fake_vk.wait()
+    print(f"Лог приложения: {os.path.join(jobs_dir, 'app.log')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Подготовка фото перед загрузкой: поворот по EXIF, уменьшение и пережатие в JPEG.
+
+Функции выполняются в отдельных процессах (ProcessPoolExecutor), поэтому модуль
+не импортирует app. Под gunicorn и uvicorn процессы пула Flask не загружают; при
+запуске python app.py forkserver импортирует в них app.py как __mp_main__.
+"""
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен - предобработка недоступна
+    Image = None
+
+
+def available():
+    return Image is not None
+
+
+def preprocess_image(src_path, dst_path, max_side, quality):
+    """Записать в dst_path уменьшенную копию src_path.
+    Возвращает (исходный размер, новый размер) в байтах"""
+    with Image.open(src_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(dst_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return os.path.getsize(src_path), os.path.getsize(dst_path)
@@ -0,0 +1,93 @@
+"""Метрики сервиса в формате Prometheus, отдаются на /metrics.
+
+По ним видно, где узкое место, когда падает скорость: в ответах VK
+(vk_call_*, vk_request_*, vk_errors_total), в канале до серверов загрузки
+(vk_upload_*, proxy_bytes_total, http_retries_total) или в своих потоках
+(http_requests_in_flight, job_queue_depth, scheduler_*).
+"""
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from urllib3.util.retry import Retry
+
+# Метка host - вид хоста, а не имя: серверов загрузки VK (pu.vk.com, pu-*.userapi.com)
+# много, и с именем в метке число рядов росло бы без предела
+API_HOSTS = {'api.vk.com'}                      # app.py добавляет хост VK_API_URL
+UPLOAD_HOST_SUFFIXES = ('vk.com', 'userapi.com', 'vkuserphoto.ru', 'vk.me')
+
+# Секунды: от быстрых вызовов API до загрузки большого фото (timeout=60)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+vk_call_seconds = Histogram(
+    'vk_call_duration_seconds', 'Вызов метода VK целиком: очередь ограничителя, execute и повторы',
+    ['method'], buckets=LATENCY_BUCKETS)
+vk_request_seconds = Histogram(
+    'vk_request_duration_seconds', 'Один HTTP-запрос к API VK (execute - пакет вызовов)',
+    ['method'], buckets=LATENCY_BUCKETS)
+vk_upload_seconds = Histogram(
+    'vk_upload_duration_seconds', 'POST файлов на сервер загрузки VK',
+    ['target'], buckets=LATENCY_BUCKETS)
+vk_errors = Counter('vk_errors_total', 'Ошибки API VK по методу и коду', ['method', 'code'])
+http_retries = Counter('http_retries_total', 'Неудачные попытки HTTP-запросов к VK, на которых сработал повтор',
+                       ['host', 'reason'])
+proxy_bytes = Counter('proxy_bytes_total', 'Байты фото: in - от браузера, out - на серверы загрузки VK',
+                      ['direction'])
+vk_token_ejections = Counter('vk_token_ejections_total', 'Токены, выведенные из работы: auth - недействителен, '
+                             'flood - flood control или дневной лимит', ['reason'])
+vk_tokens_ejected = Gauge('vk_tokens_ejected', 'Токены, выведенные из работы прямо сейчас')
+http_pool_requests = Counter(
+    'http_pool_requests_total', 'Запросы к VK: hit - по открытому соединению, miss - с новым подключением (TCP и TLS); '
+    'host - api, upload или other',
+    ['pool', 'host', 'result'])
+http_pool_prewarmed = Counter('http_pool_prewarmed_total', 'Соединения, открытые заранее', ['pool', 'host'])
+http_pool_discarded = Counter('http_pool_discarded_total', 'Соединения, закрытые после запроса: пул хоста полон',
+                              ['pool', 'host'])
+http_pool_evictions = Counter('http_pool_evictions_total', 'Пулы хостов, закрытые ради пула нового хоста', ['pool'])
+vk_upload_attempts = Counter('vk_upload_attempts_total', 'Попытки POST на сервер загрузки: ok, expired - URL протух, '
+                            'transient - сеть, таймаут или 5xx (повторяется), error', ['target', 'outcome'])
+vk_upload_hedges = Counter('vk_upload_hedges_total', 'Дубли медленных загрузок: won - дубль ответил первым, '
+                           'lost - первым ответил исходный запрос', ['target', 'result'])
+uploads_in_flight = Gauge('vk_uploads_in_flight', 'Загрузки на серверы VK, идущие прямо сейчас')
+
+http_requests = Counter('http_requests_total', 'Запросы к сервису', ['endpoint', 'method', 'status'])
+http_request_seconds = Histogram('http_request_duration_seconds', 'Время обработки запроса',
+                                 ['endpoint'], buckets=LATENCY_BUCKETS)
+http_in_flight = Gauge('http_requests_in_flight', 'Запросы в обработке (занятые потоки)')
+
+admission_bytes = Gauge('admission_bytes_in_flight', 'Байты тел загрузок, принятых в обработку')
+admission_requests = Gauge('admission_requests_in_flight', 'Загрузки, принятые в обработку')
+admission_rejected = Counter('admission_rejected_total', 'Загрузки, отклоненные с 429: bytes - нет места под тело, '
+                             'requests - много загрузок в обработке', ['endpoint', 'reason'])
+
+active_sessions = Gauge('sessions_active', 'Сессии в хранилище')
+job_queue_depth = Gauge('job_queue_depth', 'Пачки строк серверного режима, ждущие свободного потока')
+scheduler_queue_depth = Gauge('scheduler_queue_depth', 'Заявки всех сессий в честной очереди: job - пачки строк, '
+                              'wall - фото для комментариев, vk - обращения к VK', ['scheduler'])
+scheduler_busy = Gauge('scheduler_busy', 'Занятые места честной очереди', ['scheduler'])
+scheduler_wait_seconds = Histogram('scheduler_wait_seconds', 'Ожидание места в честной очереди',
+                                   ['scheduler'], buckets=(0.001, 0.01, 0.05, *LATENCY_BUCKETS))
+
+
+def host_class(host):
+    """api, upload или other - значение метки host"""
+    host = (host or '').lower()
+    if host in API_HOSTS:
+        return 'api'
+    if any(host == suffix or host.endswith('.' + suffix) for suffix in UPLOAD_HOST_SUFFIXES):
+        return 'upload'
+    return 'other'
+
+
+class CountingRetry(Retry):
+    """Retry из urllib3, который считает каждую неудачную попытку"""
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        host = getattr(_pool, 'host', None) or ''
+        if response is not None:
+            reason = f'status_{response.status}'
+        else:
+            reason = type(error).__name__ if error else 'other'
+        http_retries.labels(host_class(host), reason).inc()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def render():
+    """Тело ответа /metrics и его Content-Type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
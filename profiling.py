@@ -0,0 +1,217 @@
+"""Разбивка времени запроса по фазам и профилирование по запросу администратора.
+
+Фазы (разбор тела запроса, загрузка на сервер VK, вызовы API, ожидание
+ограничителя частоты, блокировки, хранилище сессий) копятся в контексте
+запроса и уходят клиенту в заголовке Server-Timing и одной JSON-строкой в лог.
+Профилировщик включается на следующие N запросов процесса без перезапуска:
+cProfile или выборка стеков.
+"""
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    """Фазы одного запроса: имя -> [миллисекунды, число вызовов]. Фазы из потоков
+    пула (фото для комментариев) складываются, поэтому их сумма бывает больше
+    времени запроса. Вложенные фазы (ограничитель внутри вызова VK) входят в обе"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += seconds * 1000
+            entry[1] += 1
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def header(self):
+        """Значение Server-Timing: фазы по убыванию времени и total"""
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1][0])
+        parts = [f'{name};dur={ms:.1f}' + (f';desc="x{count}"' if count > 1 else '')
+                 for name, (ms, count) in phases]
+        parts.append(f'total;dur={self.elapsed_ms():.1f}')
+        return ', '.join(parts)
+
+    def as_dict(self):
+        with self.lock:
+            return {name: {'ms': round(ms, 1), 'count': count} for name, (ms, count) in self.phases.items()}
+
+
+def start_request():
+    timing = RequestTiming()
+    _current.set(timing)
+    return timing
+
+
+def finish_request():
+    _current.set(None)
+
+
+@contextmanager
+def phase(name):
+    """Учесть время блока в фазе name текущего запроса (вне запроса - ничего)"""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - started)
+
+
+def in_request_context(fn):
+    """fn для пула потоков: фазы из потока попадут в запрос, который его запустил.
+    Контекст копируется на каждый вызов - один контекст нельзя войти из двух потоков"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def stack_key(frame):
+    """Стек в свернутом виде для flamegraph: от корня к листу через ';'"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class ProfileCapture:
+    """Профиль следующих N запросов процесса.
+
+    cprofile - точные времена функций, но запрос заметно замедляется; одновременно
+    профилируется один запрос, параллельные в захват не попадают.
+    sample - раз в interval секунд снимаются стеки потоков, занятых захваченными
+    запросами; накладные расходы почти нулевые, годится для боевого сервера"""
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.reset(0, 'sample', 0.005, None)
+
+    def reset(self, requests, mode, interval, endpoint):
+        self.requested = requests
+        self.remaining = requests
+        self.captured = 0
+        self.mode = mode
+        self.interval = interval
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stats = None          # pstats.Stats, mode=cprofile
+        self.profiling = False
+        self.threads = {}          # id потока -> endpoint, mode=sample
+        self.stacks = Counter()
+        self.samples = 0
+
+    def start(self, requests, mode='sample', interval=0.005, endpoint=None):
+        """Начать новый захват (прежний результат сбрасывается)"""
+        with self.lock:
+            self.reset(requests, mode, interval, endpoint)
+            if mode == 'sample' and not (self.sampler and self.sampler.is_alive()):
+                self.sampler = threading.Thread(target=self.sample_loop, name='profile-sampler', daemon=True)
+                self.sampler.start()
+
+    def begin(self, endpoint):
+        """Начало запроса: ручка захвата или None, если запрос не профилируется"""
+        with self.lock:
+            if self.remaining <= 0 or (self.endpoint and endpoint != self.endpoint):
+                return None
+            if self.mode == 'cprofile':
+                if self.profiling:
+                    return None
+                self.profiling = True
+            self.remaining -= 1
+            if self.mode == 'sample':
+                handle = threading.get_ident()
+                self.threads[handle] = endpoint
+                return handle
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def end(self, handle):
+        if isinstance(handle, cProfile.Profile):
+            handle.disable()
+        with self.lock:
+            if isinstance(handle, cProfile.Profile):
+                self.profiling = False
+                if self.stats is None:
+                    self.stats = pstats.Stats(handle)
+                else:
+                    self.stats.add(handle)
+            else:
+                self.threads.pop(handle, None)
+            self.captured += 1
+            if self.captured >= self.requested:
+                self.finished_at = time.time()
+
+    def sample_loop(self):
+        while True:
+            with self.lock:
+                if self.mode != 'sample' or (self.remaining <= 0 and not self.threads):
+                    self.sampler = None
+                    return
+                threads = list(self.threads)
+                interval = self.interval
+            frames = sys._current_frames()
+            keys = [stack_key(frames[thread]) for thread in threads if thread in frames]
+            with self.lock:
+                self.stacks.update(keys)
+                self.samples += len(keys)
+            del frames
+            time.sleep(interval)
+
+    def collapsed(self):
+        """Все стеки в формате flamegraph.pl / speedscope: 'стек число' по строке"""
+        with self.lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def report(self, limit=40):
+        with self.lock:
+            result = {
+                'status': 'done' if self.finished_at else ('running' if self.requested else 'idle'),
+                'mode': self.mode,
+                'endpoint': self.endpoint,
+                'requested': self.requested,
+                'captured': self.captured,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at
+            }
+            if self.mode == 'cprofile':
+                out = io.StringIO()
+                if self.stats is not None:
+                    self.stats.stream = out
+                    self.stats.sort_stats('cumulative').print_stats(limit)
+                result['profile'] = out.getvalue()
+                return result
+            # Собственное время функции - сколько раз она была листом стека
+            leaves = Counter()
+            for stack, count in self.stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            result['samples'] = self.samples
+            result['interval'] = self.interval
+            result['top_functions'] = [{'function': name, 'samples': count} for name, count in leaves.most_common(limit)]
+            result['top_stacks'] = [{'stack': stack, 'samples': count} for stack, count in self.stacks.most_common(limit)]
+            return result
+
+
+profile_capture = ProfileCapture()
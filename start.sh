@@ -1,2 +1,7 @@
 #!/bin/bash
-gunicorn app:app --bind 0.0.0.0:$PORT --workers 1 --threads 8 --timeout 0
\ No newline at end of file
+# SERVER_MODE=async - загрузки в asyncio (нужен requirements-async.txt)
+if [ "$SERVER_MODE" = "async" ]; then
+    exec uvicorn asgi:application --host 0.0.0.0 --port $PORT --workers ${WEB_CONCURRENCY:-1}
+fi
+# Несколько процессов (WEB_CONCURRENCY > 1) - только вместе с SESSION_STORE=sqlite
+gunicorn app:app --bind 0.0.0.0:$PORT --workers ${WEB_CONCURRENCY:-1} --threads 8 --timeout 0
@@ -0,0 +1,63 @@
+"""Общие фикстуры: сервер-заглушка VK (bench/fake_vk.py) в отдельном процессе.
+
+Отдельный процесс нужен, чтобы разбор принятых файлов заглушкой не попадал
+в замеры памяти тестов.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeVK:
+    def __init__(self, base):
+        self.base = base
+
+    def stats(self):
+        """Счетчики заглушки: вызовы методов (в том числе внутри execute), execute, загрузки"""
+        return requests.get(f'{self.base}/_stats', timeout=5).json()
+
+
+@pytest.fixture(scope='session')
+def fake_vk():
+    port = free_port()
+    code = (
+        'import sys, time\n'
+        f'sys.path.insert(0, {os.path.join(ROOT, "bench")!r})\n'
+        'import fake_vk\n'
+        f'fake_vk.serve(fake_vk.FakeVKConfig(), port={port})\n'
+        'time.sleep(3600)\n'
+    )
+    process = subprocess.Popen([sys.executable, '-c', code])
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                pytest.fail('Сервер-заглушка не запустился')
+            time.sleep(0.1)
+    base = f'http://127.0.0.1:{port}'
+    original = app.VK_API_URL
+    app.VK_API_URL = f'{base}/method'
+    yield FakeVK(base)
+    app.VK_API_URL = original
+    process.kill()
+    process.wait()
@@ -0,0 +1,46 @@
+"""Пачка главных фото с разными описаниями: один photos.save, а правки описаний
+уходят разом и складываются VKBatcher в один execute."""
+import io
+import os
+
+import pytest
+from prometheus_client import REGISTRY
+
+import app
+
+METHODS = ('photos.save', 'photos.edit', 'execute')
+
+pytestmark = pytest.mark.skipif(app.vk_batcher is None, reason='execute выключен (VK_BATCH_SIZE, VK_BATCH_WINDOW)')
+
+
+def requests_sent():
+    """HTTP-запросы к API VK по методам (execute - один запрос на пакет)"""
+    return {method: REGISTRY.get_sample_value('vk_request_duration_seconds_count', {'method': method}) or 0
+            for method in METHODS}
+
+
+def save_pack(captions):
+    config = {'ACCESS_TOKEN': 'captions-token', 'ALBUM_ID': '5', 'GROUP_ID': '7'}
+    items = [(io.BytesIO(os.urandom(256)), f'{i}.jpg', caption) for i, caption in enumerate(captions)]
+    before = requests_sent()
+    photos = app.save_album_pack(config, None, items)
+    after = requests_sent()
+    return photos, {method: after[method] - before[method] for method in METHODS}
+
+
+def test_mixed_captions_are_edited_in_one_execute(fake_vk):
+    captions = [f'описание {i}' for i in range(app.ALBUM_BATCH_SIZE)]
+    edits_before = fake_vk.stats().get('photos.edit', 0)
+
+    photos, sent = save_pack(captions)
+
+    assert [photo['text'] for photo in photos] == captions
+    assert fake_vk.stats().get('photos.edit', 0) - edits_before == len(captions)
+    assert sent == {'photos.save': 1, 'photos.edit': 0, 'execute': 1}
+
+
+def test_common_caption_needs_no_edits(fake_vk):
+    photos, sent = save_pack(['общее'] * app.ALBUM_BATCH_SIZE)
+
+    assert [photo['text'] for photo in photos] == ['общее'] * app.ALBUM_BATCH_SIZE
+    assert sent == {'photos.save': 1, 'photos.edit': 0, 'execute': 0}
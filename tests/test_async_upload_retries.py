@@ -0,0 +1,79 @@
+"""Повторы и дубли загрузок в асинхронном режиме идут через общий app.UploadRetries."""
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('starlette')
+
+import app  # noqa: E402
+import asgi  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+
+CONFIG = {'ACCESS_TOKEN': 't', 'ALBUM_ID': '5', 'GROUP_ID': '7'}
+
+
+def attempts(target, outcome):
+    return REGISTRY.get_sample_value('vk_upload_attempts_total', {'target': target, 'outcome': outcome}) or 0
+
+
+def fake_post(monkeypatch, answer):
+    calls = []
+
+    async def post_multipart(upload_url, fields, field):
+        calls.append(upload_url)
+        # Каждая попытка читает файл своим читателем с начала
+        assert [data.read() for _, _, data in fields] == [b'photo']
+        return await answer(len(calls), upload_url)
+
+    monkeypatch.setattr(asgi, 'post_multipart', post_multipart)
+    monkeypatch.setattr(app, 'UPLOAD_RETRY_DELAY', 0.01)
+    return calls
+
+
+def test_transient_error_is_retried(monkeypatch):
+    async def answer(call, upload_url):
+        if call == 1:
+            raise asgi.HTTPStatusError(502, upload_url)
+        return {'server': 1, 'photo': 'p', 'hash': 'h'}
+
+    calls = fake_post(monkeypatch, answer)
+    monkeypatch.setattr(app.upload_tracker, 'hedge_delay', lambda target, size: None)
+    transient, ok = attempts('wall', 'transient'), attempts('wall', 'ok')
+    result = asyncio.run(asgi.upload_with_retries(CONFIG, 'wall', 'http://u/1', [(b'photo', 'a.jpg')]))
+    assert result['photo'] == 'p'
+    assert calls == ['http://u/1', 'http://u/1']
+    assert attempts('wall', 'transient') == transient + 1
+    assert attempts('wall', 'ok') == ok + 1
+
+
+def test_client_error_is_not_retried(monkeypatch):
+    async def answer(call, upload_url):
+        raise asgi.HTTPStatusError(413, upload_url)
+
+    calls = fake_post(monkeypatch, answer)
+    monkeypatch.setattr(app.upload_tracker, 'hedge_delay', lambda target, size: None)
+    with pytest.raises(asgi.HTTPStatusError):
+        asyncio.run(asgi.upload_with_retries(CONFIG, 'wall', 'http://u/1', [(b'photo', 'a.jpg')]))
+    assert len(calls) == 1
+
+
+def test_slow_upload_is_hedged(monkeypatch):
+    async def answer(call, upload_url):
+        if upload_url == 'http://slow':
+            await asyncio.sleep(5)
+        return {'server': 1, 'photos_list': '[1]', 'hash': upload_url}
+
+    async def fresh_upload_url(config, target):
+        return 'http://fast'
+
+    calls = fake_post(monkeypatch, answer)
+    monkeypatch.setattr(asgi, 'fresh_upload_url', fresh_upload_url)
+    monkeypatch.setattr(app.upload_tracker, 'hedge_delay', lambda target, size: 0.05)
+    monkeypatch.setattr(app.upload_tracker, 'take_hedge', lambda: True)
+    won = REGISTRY.get_sample_value('vk_upload_hedges_total', {'target': 'album', 'result': 'won'}) or 0
+    result = asyncio.run(asyncio.wait_for(
+        asgi.upload_with_retries(CONFIG, 'album', 'http://slow', [(b'photo', 'a.jpg')]), 2))
+    assert result['hash'] == 'http://fast'
+    assert calls == ['http://slow', 'http://fast']
+    assert REGISTRY.get_sample_value('vk_upload_hedges_total', {'target': 'album', 'result': 'won'}) == won + 1
@@ -0,0 +1,38 @@
+"""Кодировка CSV: короткие названия товаров в windows-1251 не должны портиться."""
+import pytest
+
+import app
+
+NAMES = ['Шапка', 'Юбка', 'Пальто', 'Куртка', 'Платье', 'Шарф', 'Джинсы', 'Свитер']
+
+
+def rows(content):
+    return [row.description for row in app.parse_csv(content)]
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_short_cp1251_names(name):
+    content = f'фото.jpg|{name}|\n'.encode('cp1251')
+    assert app.detect_encoding(content) == 'windows-1251'
+    assert rows(content) == [name]
+
+
+def test_all_names_in_one_file():
+    text = ''.join(f'{i}.jpg|{name}|\n' for i, name in enumerate(NAMES))
+    assert rows(text.encode('cp1251')) == NAMES
+
+
+@pytest.mark.parametrize('encoding, expected', [
+    ('utf-8', 'utf-8'), ('utf-8-sig', 'utf-8-sig'), ('utf-16', 'utf-16'),
+])
+def test_unicode_encodings(encoding, expected):
+    content = f'фото.jpg|{NAMES[0]}|\n'.encode(encoding)
+    assert app.detect_encoding(content) == expected
+    assert rows(content) == [NAMES[0]]
+
+
+def test_long_koi8r_file():
+    text = ''.join(f'{i}.jpg|{NAMES[i % len(NAMES)]} зимнее, размер {i}|\n' for i in range(100))
+    content = text.encode('koi8-r')
+    assert app.detect_encoding(content) == 'koi8-r'
+    assert rows(content)[1] == 'Юбка зимнее, размер 1'
@@ -0,0 +1,59 @@
+"""Асинхронный вход в честную очередь (FairScheduler.aslot)."""
+import asyncio
+import threading
+
+import app
+
+
+def test_aslot_shares_capacity_with_threads():
+    scheduler = app.FairScheduler('test_aslot', 1, 1)
+    order = []
+
+    async def main():
+        busy = threading.Event()
+        done = threading.Event()
+
+        def thread_holder():
+            with scheduler.slot():
+                busy.set()
+                done.wait(5)
+            order.append('thread')
+
+        threading.Thread(target=thread_holder).start()
+        await asyncio.to_thread(busy.wait, 5)
+
+        async def waiter():
+            async with scheduler.aslot():
+                order.append('async')
+
+        task = asyncio.create_task(waiter())
+        await asyncio.sleep(0.05)
+        assert not task.done()   # место занято потоком
+        done.set()               # освобождает место из другого потока
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+    assert order == ['thread', 'async']
+    assert scheduler.free == 1
+
+
+def test_cancelled_aslot_waiter_gives_slot_back():
+    scheduler = app.FairScheduler('test_aslot_cancel', 1, 1)
+
+    async def main():
+        async def hold(seconds):
+            async with scheduler.aslot():
+                await asyncio.sleep(seconds)
+
+        holder = asyncio.create_task(hold(0.05))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(hold(0))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await holder
+        # Место, отданное отмененной заявке, возвращается - следующий проходит
+        await asyncio.wait_for(hold(0), 1)
+
+    asyncio.run(main())
+    assert scheduler.free == 1
+    assert not scheduler.flows
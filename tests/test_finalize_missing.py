@@ -0,0 +1,37 @@
+"""Итоговый отчет берет начало списка незагруженных файлов, не читая множество целиком."""
+import uuid
+
+import pytest
+
+import app
+
+MISSING = {f'photo{i:04}.jpg' for i in range(500)}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, monkeypatch, tmp_path):
+    if request.param == 'sqlite':
+        monkeypatch.setattr(app, 'session_store', app.SQLiteSessionStore(str(tmp_path / 'sessions.db'), 3600))
+    return app.session_store
+
+
+def test_finalize_samples_missing_files(store, monkeypatch):
+    session_id = str(uuid.uuid4())
+    app.set_session(session_id, {
+        'total_rows': 1,
+        'required_count': len(MISSING),
+        'missing_files': set(MISSING),
+    })
+
+    def collection(session_id, key):
+        raise AssertionError('finalize читает множество целиком')
+
+    monkeypatch.setattr(store, 'collection', collection)
+    try:
+        files = app.app.test_client().get(f'/api/finalize/{session_id}').get_json()['report']['files']
+        assert files['missing_count'] == len(MISSING)
+        assert len(files['missing_files']) == app.FINALIZE_MISSING_SAMPLE
+        assert set(files['missing_files']) <= MISSING
+        assert files['missing_url'] == f'/api/results/{session_id}/missing'
+    finally:
+        app.delete_session(session_id)
@@ -0,0 +1,44 @@
+"""Уменьшенные копии фото закрываются после загрузки, а не ждут сборщика мусора."""
+import io
+import os
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+import app  # noqa: E402
+
+CONFIG = {'ACCESS_TOKEN': 'preprocess-token', 'ALBUM_ID': '5', 'GROUP_ID': '7',
+          'PREPROCESS': '1', 'MAX_SIDE': '64'}
+
+
+def photo():
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (800, 600), os.urandom(800 * 600 * 3)).save(buffer, 'JPEG', quality=95)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def copies(monkeypatch):
+    made = []
+    maybe_preprocess = app.maybe_preprocess
+
+    def tracked(config, stream, filename):
+        data = maybe_preprocess(config, stream, filename)
+        assert data is not stream, 'фото не уменьшилось'
+        made.append(data)
+        return data
+
+    monkeypatch.setattr(app, 'maybe_preprocess', tracked)
+    return made
+
+
+def test_wall_copy_is_closed(fake_vk, copies):
+    app.upload_wall_photo(CONFIG, None, photo(), 'wall.jpg')
+    assert len(copies) == 1 and copies[0].closed
+
+
+def test_album_copies_are_closed(fake_vk, copies):
+    app.upload_album_photos(CONFIG, None, [(photo(), f'{i}.jpg', '') for i in range(3)])
+    assert len(copies) == 3 and all(copy.closed for copy in copies)
@@ -0,0 +1,58 @@
+"""Лимит подписчиков /api/progress и сверка счетчиков с хранилищем."""
+import uuid
+
+import app
+
+
+def new_session(total_rows=3):
+    session_id = str(uuid.uuid4())
+    app.set_session(session_id, {'total_rows': total_rows, 'progress': app.new_progress()})
+    return session_id
+
+
+def test_subscribers_over_limit_fall_back_to_polling(monkeypatch):
+    monkeypatch.setattr(app, 'PROGRESS_MAX_SUBSCRIBERS', 1)
+    session_id = new_session()
+    client = app.app.test_client()
+    try:
+        first = client.get(f'/api/progress/{session_id}', buffered=False)
+        assert first.status_code == 200
+        assert next(first.response).startswith(b'event: snapshot')
+
+        second = client.get(f'/api/progress/{session_id}')
+        assert second.status_code == 503
+        assert second.headers['Retry-After'] == str(app.PROGRESS_POLL_INTERVAL)
+        assert second.get_json()['poll'] == f'/api/job/status/{session_id}'
+
+        # Закрытый поток освобождает место
+        first.close()
+        assert app.progress_broker.count == 0
+        third = client.get(f'/api/progress/{session_id}', buffered=False)
+        assert third.status_code == 200
+        third.close()
+    finally:
+        app.delete_session(session_id)
+
+
+def test_stream_picks_up_rows_written_by_other_process(monkeypatch):
+    monkeypatch.setattr(app, 'PROGRESS_SYNC_INTERVAL', 0.05)
+    session_id = new_session()
+    client = app.app.test_client()
+    try:
+        response = client.get(f'/api/progress/{session_id}', buffered=False)
+        events = iter(response.response)
+        assert next(events).startswith(b'event: snapshot')
+
+        # Другой воркер пишет строку прямо в хранилище, минуя брокер этого процесса
+        def count(progress):
+            progress['processed_rows'] += 1
+            progress['successful_rows'] += 1
+            return progress
+        app.update_session_field(session_id, 'progress', count)
+
+        event = next(events)
+        assert event.startswith(b'event: snapshot')
+        assert b'"processed_rows": 1' in event
+        response.close()
+    finally:
+        app.delete_session(session_id)
@@ -0,0 +1,24 @@
+"""Сессия, удаленная хранилищем по TTL, не отдает закэшированные поля."""
+import uuid
+
+import app
+
+
+def test_swept_session_is_not_served_from_field_cache(monkeypatch):
+    session_id = str(uuid.uuid4())
+    app.set_session(session_id, {
+        'config': {'ACCESS_TOKEN': 't', 'ALBUM_ID': '5'},
+        'csv_data': [app.CsvRow('a.jpg', 'описание', [])],
+        'total_rows': 1,
+    })
+    assert app.get_session_field(session_id, 'csv_data')   # поле попало в кэш
+
+    monkeypatch.setattr(app.session_store, 'ttl', -1)
+    monkeypatch.setattr(app.session_store, 'last_sweep', 0)
+    app.session_store.maybe_sweep()
+
+    assert app.get_session_field(session_id, 'csv_data') is None
+    response = app.app.test_client().post('/api/save-result', json={
+        'session_id': session_id, 'row_index': 0, 'main_photo_result': None,
+    })
+    assert response.status_code == 404
@@ -0,0 +1,45 @@
+"""Потоковая пересылка фото: пиковая память на загрузку большого файла
+не зависит от его размера и остается в пределах нескольких кусков UPLOAD_CHUNK_SIZE.
+"""
+import io
+import os
+import tempfile
+import tracemalloc
+
+import pytest
+
+import app
+
+FILE_SIZE = 30 * 1024 * 1024
+PEAK_CHUNKS = 8   # допустимый пик в кусках UPLOAD_CHUNK_SIZE
+
+
+@pytest.fixture
+def big_file():
+    with tempfile.TemporaryFile() as file:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(FILE_SIZE // len(chunk)):
+            file.write(chunk)
+        file.seek(0)
+        yield file
+
+
+def upload(upload_url, fileobj):
+    response = app.post_multipart(upload_url, [('photo', 'big.jpg', fileobj)], 'wall')
+    return app.check_upload_response(response, 'photo')
+
+
+def test_peak_memory_is_bounded_by_chunk_size(fake_vk, big_file):
+    upload_url = app.proxy_get_wall_upload_server('token')
+    # Прогрев: соединение, импорты и кэши не относятся к размеру файла
+    upload(upload_url, io.BytesIO(b'x' * 1024))
+
+    tracemalloc.start()
+    try:
+        result = upload(upload_url, big_file)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert '"size": %d' % FILE_SIZE in result['photo']
+    assert peak < PEAK_CHUNKS * app.UPLOAD_CHUNK_SIZE, f'пик {peak} байт'
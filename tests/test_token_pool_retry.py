@@ -0,0 +1,41 @@
+"""После ошибки 9 вызов повторяется соседним токеном пула, а не ждет паузу."""
+import time
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    flooded, healthy = f'flooded-{uuid.uuid4().hex}', f'healthy-{uuid.uuid4().hex}'
+    calls = []
+
+    def vk_send(method, params, http_method='GET', timeout=30):
+        calls.append(params['access_token'])
+        if params['access_token'] == flooded:
+            raise app.VKError(9, 'Flood control')
+        return {'ok': True}
+
+    monkeypatch.setattr(app, 'vk_send', vk_send)
+    config = {'ACCESS_TOKENS': f'{flooded},{healthy}', 'ALBUM_ID': '5', 'GROUP_ID': '7'}
+    app.token_config(config, 'row:0')   # пул становится известен, как при обработке строки
+    return flooded, healthy, calls
+
+
+def test_flooded_token_is_replaced(pool):
+    flooded, healthy, calls = pool
+    started = time.monotonic()
+    assert app.vk_call('photos.createComment', {'access_token': flooded}) == {'ok': True}
+    assert calls == [flooded, healthy]
+    assert time.monotonic() - started < 1
+
+
+def test_upload_bound_method_fails_fast(pool):
+    flooded, _, calls = pool
+    started = time.monotonic()
+    with pytest.raises(app.VKError):
+        app.vk_call('photos.save', {'access_token': flooded})
+    assert calls == [flooded]
+    assert time.monotonic() - started < 1
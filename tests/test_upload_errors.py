@@ -0,0 +1,49 @@
+"""Ошибка сервера загрузки про сам файл не вызывает запрос нового URL и повторы,
+а протухший URL заменяется новым."""
+import pytest
+
+import app
+
+CONFIG = {'ACCESS_TOKEN': 'upload-errors-token', 'ALBUM_ID': '5', 'GROUP_ID': '7'}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Ответы сервера загрузки по очереди и счетчики попыток и новых URL"""
+    state = {'answers': [], 'posts': [], 'urls': 0}
+
+    def upload_to_wall(upload_url, file_data, filename):
+        state['posts'].append(upload_url)
+        return app.check_upload_result(state['answers'].pop(0), 'photo')
+
+    def upload_url_for(config, target):
+        state['urls'] += 1
+        return f"http://upload/{state['urls']}"
+
+    monkeypatch.setattr(app, 'proxy_upload_to_wall', upload_to_wall)
+    monkeypatch.setattr(app, 'upload_url_for', upload_url_for)
+    monkeypatch.setattr(app.upload_tracker, 'hedge_delay', lambda target, size: None)
+    return state
+
+
+def upload():
+    return app.upload_with_retries(CONFIG, 'wall', 'http://upload/0', [(b'photo', 'a.jpg')])
+
+
+@pytest.mark.parametrize('answer', [
+    {'error': 'ERR_UPLOAD_BAD_IMAGE_SIZE: photo too big'},
+    {'server': 1, 'photo': '[]', 'hash': 'h'},
+])
+def test_rejected_file_fails_fast(server, answer):
+    server['answers'] = [answer]
+    with pytest.raises(app.UploadRejected):
+        upload()
+    assert server['posts'] == ['http://upload/0']
+    assert server['urls'] == 0
+
+
+def test_expired_url_is_replaced(server):
+    server['answers'] = [{'error': 'ERR_UPLOAD_BAD_SIGNATURE: upload url expired'},
+                         {'server': 1, 'photo': 'p', 'hash': 'h'}]
+    assert upload()['photo'] == 'p'
+    assert server['posts'] == ['http://upload/0', 'http://upload/1']
@@ -0,0 +1,62 @@
+"""Повтор пакетной загрузки на стену после частичного сбоя догружает файлы,
+а не получает сохраненный ответ с ошибкой."""
+import io
+import os
+import uuid
+
+import app
+
+
+def test_partial_failure_is_not_replayed(fake_vk, monkeypatch):
+    session_id = str(uuid.uuid4())
+    names = ['a.jpg', 'b.jpg', 'c.jpg']
+    app.set_session(session_id, {
+        'config': {'ACCESS_TOKEN': 'wall-batch-token', 'ALBUM_ID': '5', 'GROUP_ID': '7'},
+        'csv_data': [app.CsvRow('main.jpg', 'описание', names)],
+        'plan': None,
+    })
+    contents = {name: os.urandom(512) for name in names}
+    save_wall_photo = app.save_wall_photo
+    failing = {'c.jpg'}
+
+    def flaky_save(config, upload_url, file_data, filename):
+        if filename in failing:
+            raise Exception('сбой загрузки')
+        return save_wall_photo(config, upload_url, file_data, filename)
+
+    monkeypatch.setattr(app, 'save_wall_photo', flaky_save)
+    client = app.app.test_client()
+    headers = {'Idempotency-Key': f'{session_id}:0:wall-batch'}
+
+    def send():
+        data = {
+            'session_id': session_id, 'row_index': '0', 'owner_id': '-7', 'photo_id': '1',
+            'filenames': names,
+            'files': [(io.BytesIO(contents[name]), name) for name in names],
+        }
+        return client.post('/api/proxy/upload-wall-batch', data=data, headers=headers,
+                           content_type='multipart/form-data')
+
+    comments_before = fake_vk.stats().get('photos.createComment', 0)
+    try:
+        first = send()
+        body = first.get_json()
+        assert body['partial'] is True
+        assert [photo['success'] for photo in body['photos']] == [True, True, False]
+        assert [len(comment['photos']) for comment in body['comment_results']] == [2]
+
+        failing.clear()
+        retry = send()
+        assert 'Idempotent-Replayed' not in retry.headers
+        body = retry.get_json()
+        assert body['partial'] is False
+        assert all(photo['success'] for photo in body['photos'])
+        # Первый комментарий взят из прошлой попытки, создан только комментарий с c.jpg
+        assert [[photo['name'] for photo in comment['photos']] for comment in body['comment_results']] == \
+            [['a.jpg', 'b.jpg'], ['c.jpg']]
+        assert fake_vk.stats().get('photos.createComment', 0) - comments_before == 2
+
+        # Полный ответ сохранен: следующий повтор получает его без загрузки
+        assert send().headers.get('Idempotent-Replayed') == 'true'
+    finally:
+        app.delete_session(session_id)